@@ -49,14 +49,19 @@ __credits__  = "SLAC"
 #
 #  For the detailed API see the documentation for class PNetlogger.
 
-import datetime, getpass, md5, os, random, re, socket, sys, time, urlparse
+import atexit, datetime, errno, fcntl, getpass, md5, os, random, re, select, socket, sys
+import tempfile, threading, time, urlparse
 
 import PipelineNetloggerConfig as Config
+import pipeline
 
 # The default port to use for the ISOC logging gateway.
 DEFAULT_PORT = 15502
 
 
+# Severity levels, least severe first.
+_LEVEL_NAMES = ['DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL']
+
 # Types of configuration available. Given to PNetlogger.getLogger().
 class Flavor(object):
     PROD = "PROD"
@@ -78,7 +83,15 @@ def _metalog(level):
     # arguments will go into the dictionary passed to the log message
     # formatter.
 
+    # The level is the same for every message, so its line and its rank
+    # are worked out here rather than per call.
+    levelNo = _LEVEL_NAMES.index(level)
+    levelLine = "s LEVEL: %s\n" % level
+
     def log(self, evnt, msg, tgt="", timestamp=None, scid=-1, link="", **kwargs):
+        # Messages below the threshold are dropped before any other work.
+        if levelNo < self._logLevel:
+            return
         # Start the dictionary of log message items with all the "tag_"
         # keyword items.
         items = dict((k, v) for k, v in kwargs.iteritems() if k.startswith("tag_"))
@@ -98,12 +111,10 @@ def _metalog(level):
                           TGT=tgt,
                           SCID=scid,
                           LINK=link,
-                          LEVEL=level,
                           UTCTIMESTAMP=_dt.fromDatetime(timestamp),
                           )
                      )
-        items.update(self._meta)
-        msg = self._format(items)
+        msg = self._format(items, levelLine)
         # Send the new message.
         self._appender.append(msg)
 
@@ -191,10 +202,13 @@ class PNetlogger(object):
         """
         # We'll use our NetlogdAppender to send the message strings
         # to the netlogd.
-        self._appender = _NetlogdAppender(netlogDest)
+        if Config.BATCHING:
+            self._appender = _BatchingNetlogdAppender(netlogDest)
+        else:
+            self._appender = _NetlogdAppender(netlogDest)
 
         # Set the logging level.
-        self._levelNames = ['DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL']
+        self._levelNames = _LEVEL_NAMES
         self._logLevel = None
         self.setLevel(netlogLevel)
 
@@ -205,6 +219,12 @@ class PNetlogger(object):
                        'PID'  : os.getpid(),
                        'GRIDID'  : _uuid(),
                        }
+        # It never changes, so render it once for all messages.
+        self._metaText = "".join(_dictLines(self._meta))
+
+        # In a pipeline job, report the message counts when it ends.
+        if os.environ.get("PIPELINE_SUMMARY"):
+            atexit.register(self.writeSummary)
 
     def setLevel(self, netlogLevel):
         """!@brief Set the level threshold.
@@ -212,10 +232,30 @@ class PNetlogger(object):
         logged. One of 'DEBUG', 'INFO', 'WARN', 'ERROR', or 'FATAL'.
         """
         try:
-            self._loglevel = self._levelNames.index(netlogLevel.upper())
+            self._logLevel = self._levelNames.index(netlogLevel.upper())
         except ValueError:
             raise ValueError("'%s' is not a valid level name." % netlogLevel)
 
+    def flush(self):
+        """!@brief Send any messages still waiting to be batched."""
+        self._appender.flush()
+
+    def stats(self):
+        """!@brief Return a dictionary of the numbers of messages sent,
+        dropped and spooled so far.
+        """
+        return dict(self._appender.counts)
+
+    def writeSummary(self):
+        """!@brief Send waiting messages, then set the pipeline variables
+        netlogSent, netlogDropped and netlogSpooled to the counts from
+        stats(). Called at exit when $PIPELINE_SUMMARY is set.
+        """
+        self.flush()
+        counts = self.stats()
+        for what in ("sent", "dropped", "spooled"):
+            pipeline.setVariable("netlog" + what.capitalize(), counts[what])
+
     # The logging method for each severity level is generated by the _metalog function.
     fatal = _metalog("FATAL")
 
@@ -227,11 +267,10 @@ class PNetlogger(object):
 
     debug = _metalog("DEBUG")
 
-    def _format(self, items):
-        level = self._levelNames.index(items['LEVEL'].upper())
-        if level < self._logLevel:
-            return None
-        return ''.join(list(_dictToText(items)))
+    def _format(self, items, levelLine):
+        # The message text: the per-message items, the level line and the
+        # pre-rendered metadata, then the blank line ending the message.
+        return "".join(list(_dictLines(items))) + levelLine + self._metaText + "\n"
 
 
 
@@ -242,6 +281,7 @@ class _NetlogdAppender(object):
     def __init__(self, netlogDest):
         # Store the set of tuples (IP addr, port).
         self._destinations = list(_parseNetlogDest(netlogDest))
+        self.counts = {"sent": 0, "dropped": 0, "spooled": 0}
 
     def append(self, msg):
         if msg is None:
@@ -267,8 +307,296 @@ class _NetlogdAppender(object):
 
         # If no connection was made dump the message to stderr.
         if not sent:
+            self.counts["dropped"] += 1
             print >>sys.stderr, "Couldn't send this ISOC log message to any server:"
             print msg
+        else:
+            self.counts["sent"] += 1
+
+    def flush(self):
+        pass
+
+
+class _NetlogdConnection(object):
+    # A connection to one netlogd that is kept open between sends and
+    # re-established, after a growing delay, when it fails.
+    def __init__(self, dest):
+        self.dest = dest
+        self._sock = None
+        self._backoff = 0.0
+        self._retryAt = 0.0
+
+    def send(self, data):
+        # Send data, connecting first if need be. Return True if it
+        # was sent.
+        if self._sock is not None and self._peerClosed():
+            # sendall would still succeed once, losing the data
+            self.close()
+        if self._sock is None:
+            if time.time() < self._retryAt:
+                return False
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.settimeout(Config.CONNECT_TIMEOUT)
+                sock.connect(self.dest)
+                self._sock = sock
+            except socket.error:
+                self._failed()
+                return False
+        try:
+            self._sock.sendall(data)
+        except socket.error:
+            self._failed()
+            return False
+        self._backoff = 0.0
+        return True
+
+    def _peerClosed(self):
+        # netlogd never writes to us, so a kept-open connection that has
+        # become readable has been closed or reset by the other end.
+        try:
+            if not select.select([self._sock], [], [], 0)[0]:
+                return False
+            return not self._sock.recv(1, socket.MSG_PEEK)
+        except (socket.error, select.error):
+            return True
+
+    def _failed(self):
+        self.close()
+        self._backoff = min(Config.MAX_BACKOFF, max(Config.MIN_BACKOFF, 2 * self._backoff))
+        self._retryAt = time.time() + self._backoff
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+
+class _BatchingNetlogdAppender(object):
+    # Send messages to all netlogds, as _NetlogdAppender does, but in
+    # batches over persistent connections. A background thread sends
+    # a batch when it reaches Config.BATCH_BYTES or is
+    # Config.FLUSH_INTERVAL seconds old. Each message keeps its own
+    # blank-line terminator, so a batch is just the messages back to
+    # back, as if they had been sent one after the other. Batches that
+    # no netlogd would take are spooled to a file and sent first when a
+    # server next answers.
+    # Logging never waits for the network: at most Config.QUEUE_MESSAGES
+    # messages wait for the thread, beyond which Config.OVERFLOW decides
+    # whether the oldest is dropped or the queue is handed to the thread
+    # to spool (unless the previous one is still waiting for it, in
+    # which case the logging thread spools it after all). At
+    # exit the thread gets Config.EXIT_DEADLINE seconds to send what is
+    # left. counts holds the number of this appender's messages sent,
+    # dropped and spooled.
+    def __init__(self, netlogDest):
+        if Config.OVERFLOW not in ("drop-oldest", "spool"):
+            raise ValueError("'%s' is not a valid overflow policy." % Config.OVERFLOW)
+        self._connections = [_NetlogdConnection(d) for d in _parseNetlogDest(netlogDest)]
+        spoolDir = Config.SPOOL_DIR or tempfile.gettempdir()
+        self._spool = os.path.join(spoolDir, "pnetlogger-%s.spool" % getpass.getuser())
+        self._pending = []
+        self._pendingBytes = 0
+        self._firstAt = None
+        self._inFlight = ""
+        self._overflow = ""
+        self._closed = False
+        self.counts = {"sent": 0, "dropped": 0, "spooled": 0}
+        # _cond guards the pending messages; _sendLock keeps batches in order.
+        self._cond = threading.Condition()
+        self._sendLock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="PNetlogger")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, msg):
+        if msg is None:
+            # The original message didn't pass the severity level filter.
+            return
+        overflow = None
+        self._cond.acquire()
+        try:
+            if self._closed:
+                self._pending.append(msg)
+                batch = self._take()
+            else:
+                batch = None
+                if len(self._pending) >= Config.QUEUE_MESSAGES:
+                    if Config.OVERFLOW == "drop-oldest":
+                        self._pendingBytes -= len(self._pending.pop(0))
+                        self.counts["dropped"] += 1
+                    elif self._overflow:
+                        # The thread hasn't spooled the last lot yet.
+                        overflow = self._take()
+                    else:
+                        self._overflow = self._take()
+                        self._cond.notify()
+                self._pending.append(msg)
+                self._pendingBytes += len(msg)
+                if self._firstAt is None or self._pendingBytes >= Config.BATCH_BYTES:
+                    # Start the clock on a new batch, or send a full one.
+                    if self._firstAt is None:
+                        self._firstAt = time.time()
+                    self._cond.notify()
+        finally:
+            self._cond.release()
+        if overflow:
+            # The thread is not keeping up at all: keep the messages on
+            # disk for a later batch to pick up.
+            self._spoolBatch(overflow)
+        if batch:
+            # Logged after close(): send it straight away.
+            self._sendBatch(batch)
+
+    def _take(self):
+        # Return the pending messages as one string and clear them.
+        # Call with self._cond held.
+        batch = "".join(self._pending)
+        self._pending = []
+        self._pendingBytes = 0
+        self._firstAt = None
+        return batch
+
+    def _run(self):
+        # Background thread: wait for a batch to fill up or age, send it.
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._closed and not self._overflow:
+                    if self._firstAt is not None:
+                        wait = self._firstAt + Config.FLUSH_INTERVAL - time.time()
+                        if wait <= 0 or self._pendingBytes >= Config.BATCH_BYTES:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._cond.release()
+            self.flush()
+            if self._closed:
+                return
+
+    def flush(self):
+        self._sendLock.acquire()
+        try:
+            self._cond.acquire()
+            try:
+                overflow = self._overflow
+                self._overflow = ""
+                batch = self._inFlight = self._take()
+            finally:
+                self._cond.release()
+            if overflow:
+                # Older than the batch, so spooled ahead of it.
+                self._spoolBatch(overflow)
+            if batch:
+                self._deliver(batch)
+            self._inFlight = ""
+        finally:
+            self._sendLock.release()
+
+    def _sendBatch(self, batch):
+        self._sendLock.acquire()
+        try:
+            self._deliver(batch)
+        finally:
+            self._sendLock.release()
+
+    def _deliver(self, batch):
+        # Send a batch to every netlogd, preceded by anything spooled.
+        # Call with self._sendLock held.
+        spooled = ""
+        if os.path.exists(self._spool) and os.path.getsize(self._spool):
+            spooled = self._unspool()
+        sent = [c for c in self._connections if c.send(spooled + batch)]
+        if sent:
+            # The spool is shared with this user's other processes, so
+            # only the batch is ours to count.
+            self._count("sent", batch)
+        elif spooled:
+            # Back where it came from, without counting it again.
+            self._spoolBatch(spooled, count=False)
+            self._spoolBatch(batch)
+        else:
+            self._spoolBatch(batch)
+
+    def _count(self, what, data):
+        # Add the number of messages in data to a counter. Sanitized
+        # values have no newlines, so only the end of a message has two.
+        self._cond.acquire()
+        try:
+            self.counts[what] += data.count("\n\n")
+        finally:
+            self._cond.release()
+
+    def _lockedSpool(self, mode):
+        spool = open(self._spool, mode)
+        fcntl.lockf(spool, fcntl.LOCK_EX)
+        return spool
+
+    def _spoolBatch(self, batch, count=True):
+        try:
+            spool = self._lockedSpool("a")
+            try:
+                spool.write(batch)
+            finally:
+                spool.close()
+            if count:
+                self._count("spooled", batch)
+                print >>sys.stderr, "Couldn't send %d ISOC log messages to any server; spooled them to %s" % \
+                      (batch.count("\n\n"), self._spool)
+        except IOError:
+            self._count("dropped", batch)
+            print >>sys.stderr, "Couldn't send these ISOC log messages to any server:"
+            print batch
+
+    def _unspool(self):
+        # Return and empty the contents of the spool file.
+        try:
+            spool = self._lockedSpool("r+")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                print >>sys.stderr, "Couldn't open ISOC log spool %s: %s" % (self._spool, e)
+            return ""
+        try:
+            data = spool.read()
+            spool.seek(0)
+            spool.truncate()
+        finally:
+            spool.close()
+        return data
+
+    def close(self, deadline=None):
+        # Have the background thread send what is left and stop, giving
+        # it deadline seconds (default Config.EXIT_DEADLINE). Messages
+        # it hasn't sent by then are spooled; a batch it was still
+        # trying to send may then reach a server twice.
+        if deadline is None:
+            deadline = Config.EXIT_DEADLINE
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        self._thread.join(deadline)
+        if self._thread.isAlive():
+            self._cond.acquire()
+            try:
+                left = self._inFlight + self._overflow + self._take()
+                self._overflow = ""
+            finally:
+                self._cond.release()
+            if left:
+                self._spoolBatch(left)
+            return
+        for c in self._connections:
+            c.close()
 
 
 
@@ -300,13 +628,24 @@ def _parseNetlogDest(netlogDest):
 def _dictToText(d):
     # A generator that yields text lines (with newlines)
     # given a message a dictionary form.
-    for k, v in d.iteritems():
-        k = _filterKey(k)
-        t, v = _filterValue(v)
-        yield "%s %s: %s\n" % (t, k, v)
+    for line in _dictLines(d):
+        yield line
     yield "\n"
 
 
+def _dictLines(d):
+    # A generator that yields the item lines of a message, without
+    # the blank line that ends it.
+    for k, v in d.iteritems():
+        yield _itemLine(_filterKey(k), v)
+
+
+def _itemLine(k, v):
+    # The text line (with newline) for one message item.
+    t, v = _filterValue(v)
+    return "%s %s: %s\n" % (t, k, v)
+
+
 def _filterKey(k):
     # Return the given key if it's valid, else raise _BadKey.
     if _BAD_KEY_CHARS.search(k):
@@ -411,8 +750,31 @@ class _IsocTransmogrifier(_Transmogrifier):
         # Truncate after transmogrification.
         return super(_IsocTransmogrifier, self).__call__(text)[0:self.MAXLEN]
 
-# Apply an _IsocTransmogrifier to a string.
-_cleanText = _IsocTransmogrifier()
+class _IsocSanitizer(object):
+    # Same transformation as _IsocTransmogrifier, done with
+    # str.translate (deleting the unwanted characters), one replace()
+    # for the newlines and truncation as early as possible. Every
+    # character left after the deletions becomes at least one output
+    # character, so truncating to MAXLEN before the replace() can't
+    # change the result.
+
+    MAXLEN = _IsocTransmogrifier.MAXLEN
+
+    # Deleted: eight-bit characters and control characters below 26
+    # other than tab and newline (the same set _IsocTransmogrifier
+    # replaces by null strings).
+    _DELETE = "".join([chr(x) for x in xrange(128, 256)] +
+                      [chr(x) for x in xrange(0, 26) if x not in (ord("\t"), ord("\n"))])
+    _IDENTITY = "".join([chr(x) for x in xrange(256)])
+
+    def __call__(self, text):
+        text = text.translate(self._IDENTITY, self._DELETE)[0:self.MAXLEN]
+        if "\n" in text:
+            text = text.replace("\n", " -NL- ")[0:self.MAXLEN]
+        return text
+
+# Clean up a string for a message line.
+_cleanText = _IsocSanitizer()
 
 # From: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/213761
 def _uuid( *args ):
@@ -428,3 +790,72 @@ def _uuid( *args ):
   data = str(t)+' '+str(r)+' '+str(a)+' '+str(args)
   data = md5.md5(data).hexdigest()
   return data
+
+
+def _checkSanitizer(trials=20000):
+    # Compare _IsocSanitizer with _IsocTransmogrifier on random and
+    # edge-case strings, then time both on typical message values.
+    import timeit
+    old, new = _IsocTransmogrifier(), _IsocSanitizer()
+    rng = random.Random(12345)
+    cases = ["", "\n", "\n" * 5000, "x" * 3999 + "\n", "x" * 3995 + "\n" * 3,
+             "\x80" * 5000 + "abc", "".join([chr(x) for x in xrange(256)]) * 20]
+    for i in xrange(trials):
+        length = rng.choice((5, 40, 500, 4100, 9000))
+        alphabet = rng.choice(("ab\n\t\x01\x1a\x1f\x7f\xff", None))
+        if alphabet is None:
+            cases.append("".join([chr(rng.randrange(256)) for j in xrange(length)]))
+        else:
+            cases.append("".join([rng.choice(alphabet) for j in xrange(length)]))
+    bad = [c for c in cases if old(c) != new(c)]
+    print "equivalence: %d of %d strings differ" % (len(bad), len(cases))
+
+    values = ["log.test", "Hello from a pipeline job", "", "-1", "INFO",
+              "2009-01-01 00:00:00.000000", "fermilnx01", "glastraw",
+              "/sdf/data/fermi/a/isoc/flightOps/bin/logChunkExceptions.py",
+              "12345", "0123456789abcdef0123456789abcdef",
+              "chunk exception:\n  some traceback line\n  another"]
+    for name, func in (("_IsocTransmogrifier", old), ("_IsocSanitizer", new)):
+        timer = timeit.Timer(lambda: [func(v) for v in values])
+        best = min(timer.repeat(3, 10000))
+        print "%-20s %6.2f us per %d-field message" % (name, best / 10000 * 1e6, len(values))
+    return len(bad)
+
+
+def _checkFormat():
+    # Compare messages with the text of the whole item dictionary, as
+    # they were formatted before, then time a filtered and a sent call.
+    import timeit
+    class Appender(object):
+        def append(self, msg):
+            self.msg = msg
+    save = Config.BATCHING
+    Config.BATCHING = False
+    try:
+        logger = PNetlogger(Config.DEST_DEVEL, "INFO")
+    finally:
+        Config.BATCHING = save
+    logger._appender = Appender()
+    when = datetime.datetime(2009, 1, 1)
+    logger.info("log.test", "a\nmessage", tgt="x", timestamp=when, tag_run=7)
+    items = dict(EVENT="log.test", MSG="a\nmessage", TGT="x", SCID=-1, LINK="",
+                 LEVEL="INFO", UTCTIMESTAMP=_dt.fromDatetime(when), TAG_RUN=7)
+    items.update(logger._meta)
+    old = "".join(_dictToText(items))
+    new = logger._appender.msg
+    same = sorted(old.splitlines()) == sorted(new.splitlines()) and new.endswith("\n\n")
+    print "format: %s" % (same and "same items" or "DIFFERENT:\n%s\n%s" % (old, new))
+    logger._appender.msg = None
+    logger.debug("log.test", "filtered")
+    if logger._appender.msg is not None:
+        print "format: debug message was not filtered"
+        same = False
+    for name, call in (("filtered debug", lambda: logger.debug("log.test", "Hello")),
+                       ("sent info", lambda: logger.info("log.test", "Hello"))):
+        best = min(timeit.Timer(call).repeat(3, 10000))
+        print "%-20s %6.2f us per call" % (name, best / 10000 * 1e6)
+    return not same
+
+
+if __name__ == "__main__":
+    sys.exit((_checkSanitizer() != 0) + _checkFormat())
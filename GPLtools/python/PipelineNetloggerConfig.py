@@ -25,3 +25,29 @@ LEVEL_PROD = "INFO"
 # Development. Messages will show the Nightly page.
 DEST_DEVEL  = "fermilnx04:15502"
 LEVEL_DEVEL = "INFO"
+
+# Delivery. Messages are collected and sent in batches over connections
+# that are kept open, a batch going out when it reaches BATCH_BYTES or
+# FLUSH_INTERVAL seconds after its first message. Set BATCHING to False
+# to connect once per message instead.
+BATCHING = True
+BATCH_BYTES = 65536
+FLUSH_INTERVAL = 2.0
+CONNECT_TIMEOUT = 5.0
+# Seconds to wait before reconnecting to a server that failed, doubling
+# after each further failure up to the maximum.
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# Batches no server would take are appended to a spool file in this
+# directory (None means the system temporary directory) and sent ahead
+# of later batches once a server is reachable again.
+SPOOL_DIR = None
+# At most QUEUE_MESSAGES messages wait in memory for the background
+# thread. A message logged when the queue is full is handled according
+# to OVERFLOW: "drop-oldest" discards the oldest waiting message,
+# "spool" moves the waiting messages to the spool file.
+QUEUE_MESSAGES = 10000
+OVERFLOW = "spool"
+# Seconds to wait at exit for the queue to be sent before spooling
+# whatever is left.
+EXIT_DEADLINE = 10.0
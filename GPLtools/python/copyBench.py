@@ -0,0 +1,244 @@
+#!/usr/bin/env python2.6
+"""@brief Benchmark the GPLtools copy engines.
+
+Every engine in cpck.engines (plus cp(1) for reference) copies synthetic
+files of the requested sizes within a scratch directory, each run repeated
+a number of times with the page cache dropped beforehand where that is
+permitted.  The median and 95th percentile of the wall time, throughput
+and CPU time of each combination of engine, file size and block size are
+written out as JSON, e.g.
+
+  copyBench.py -d /lscratch/bench -s 100M,2G -b 256K,1M,4M -r 5 -o bench.json
+"""
+
+import ctypes
+import ctypes.util
+import json
+import optparse
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import cpck
+
+defaultSizes = '16M,256M'
+defaultBlocks = '1M'
+defaultRepeat = 5
+
+_units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+POSIX_FADV_DONTNEED = 4
+
+
+def parseSize(text):
+    """@brief Parse a byte count with an optional K, M or G suffix."""
+    text = text.strip().upper()
+    if text and text[-1] in _units:
+        return int(float(text[:-1]) * _units[text[-1]])
+    return int(text)
+
+
+def makeFile(fileName, size, seed=None):
+    """@brief Write size bytes of incompressible data to fileName."""
+    if seed is None: seed = os.urandom(2**20)
+    ofp = open(fileName, 'wb')
+    left = size
+    while left > 0:
+        block = seed[:min(left, len(seed))]
+        ofp.write(block)
+        left -= len(block)
+        continue
+    ofp.close()
+    return
+
+
+def _fadvise(fileName):
+    libc = cpck._loadLibc()
+    if not libc or not hasattr(libc, 'posix_fadvise'): return False
+    fd = os.open(fileName, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        rc = libc.posix_fadvise(fd, ctypes.c_long(0), ctypes.c_long(0),
+                                POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return rc == 0
+
+
+def dropCache(fileNames):
+    """@brief Evict files from the page cache, as far as we are allowed to.
+    @return how: 'drop_caches' (whole cache), 'fadvise' (just these files) or 'none'.
+    """
+    os.system('sync')
+    try:
+        ofp = open('/proc/sys/vm/drop_caches', 'w')
+        ofp.write('1\n')
+        ofp.close()
+        return 'drop_caches'
+    except EnvironmentError:
+        pass
+    how = 'fadvise'
+    for fileName in fileNames:
+        if os.path.exists(fileName) and not _fadvise(fileName): how = 'none'
+        continue
+    return how
+
+
+def cpEngine(inFile, outFile, digests=None):
+    """@brief cp(1), for reference."""
+    rc = os.system('cp %s %s' % (inFile, outFile))
+    if rc: raise OSError('cp failed with status %d' % rc)
+    return None
+
+
+def _cpuTime():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime
+
+
+def percentile(values, fraction):
+    """@brief Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = int(round(fraction * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def summarize(values):
+    return {'median': percentile(values, 0.5), 'p95': percentile(values, 0.95)}
+
+
+def timeRuns(copier, inFile, outFile, size, repeat, digests):
+    """@brief Copy inFile to outFile repeat times.
+    @return (summary, cache-drop method) for the runs.
+    """
+    seconds = []
+    cpu = []
+    throughput = []
+    how = 'none'
+    for run in range(repeat):
+        if os.path.exists(outFile): os.unlink(outFile)
+        how = dropCache([inFile])
+        result = None
+        if digests: result = {}
+        cpu0 = _cpuTime()
+        start = time.time()
+        copier(inFile, outFile, result)
+        os.system('sync')
+        delta = time.time() - start
+        cpu.append(_cpuTime() - cpu0)
+        if os.path.getsize(outFile) != size:
+            raise IOError('%s copied %d of %d bytes' %
+                          (copier.__name__, os.path.getsize(outFile), size))
+        seconds.append(delta)
+        throughput.append(size / 1e6 / max(delta, 1e-9))
+        continue
+    os.unlink(outFile)
+    summary = {'runs': repeat,
+               'seconds': summarize(seconds),
+               'throughputMBps': summarize(throughput),
+               'cpuSeconds': summarize(cpu),
+               }
+    return summary, how
+
+
+def benchmark(workDir, sizes, blocks, repeat, engines=None, digests=False):
+    """@brief Run every engine on a synthetic file of each size.
+    @param workDir Directory for the test files (e.g. on tmpfs or local disk).
+    @param sizes List of file sizes in bytes.
+    @param blocks List of block sizes for the engines that take one.
+    @param repeat Number of runs of each combination.
+    @param engines Names of the engines to run (default all, plus 'cp').
+    @param digests Ask the engines for digests, as staging does.
+    @return dictionary ready to be dumped as JSON.
+    """
+    allEngines = dict(cpck.engines)
+    allEngines['cp'] = cpEngine
+    if engines is None: engines = sorted(allEngines)
+    report = {'host': platform.node(),
+              'python': platform.python_version(),
+              'workDir': os.path.abspath(workDir),
+              'repeat': repeat,
+              'digests': digests,
+              'kernelCalls': [call.__name__.lstrip('_') for call in cpck.kernelCalls()],
+              'results': [],
+              }
+    seed = os.urandom(2**20)
+    tmpDir = tempfile.mkdtemp(prefix='copyBench.', dir=workDir)
+    try:
+        inFile = os.path.join(tmpDir, 'in')
+        outFile = os.path.join(tmpDir, 'out')
+        for size in sizes:
+            makeFile(inFile, size, seed)
+            for name in engines:
+                engine = allEngines[name]
+                runBlocks = [None]
+                if engine is cpck.pipeSum: runBlocks = blocks
+                for blockSize in runBlocks:
+                    copier = engine
+                    if blockSize is not None:
+                        copier = lambda i, o, d, b=blockSize: \
+                                 cpck.pipeSum(i, o, d, blockSize=b)
+                        copier.__name__ = 'pipeSum'
+                        pass
+                    summary, how = timeRuns(copier, inFile, outFile, size,
+                                            repeat, digests)
+                    summary.update({'engine': name, 'size': size,
+                                    'blockSize': blockSize, 'cacheDrop': how})
+                    report['results'].append(summary)
+                    print >> sys.stderr, '%-6s %12d %10s %8.1f MB/s (median) %7.2f s CPU' % \
+                          (name, size, blockSize or '-',
+                           summary['throughputMBps']['median'],
+                           summary['cpuSeconds']['median'])
+                    continue
+                continue
+            os.unlink(inFile)
+            continue
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description='Benchmark the GPLtools copy engines.')
+    parser.add_option('-d', '--dir', default=tempfile.gettempdir(),
+                      help='directory for the test files [%default]')
+    parser.add_option('-s', '--sizes', default=defaultSizes,
+                      help='comma-separated file sizes [%default]')
+    parser.add_option('-b', '--blocks', default=defaultBlocks,
+                      help='comma-separated block sizes for the pipe engine [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=defaultRepeat,
+                      help='runs of each combination [%default]')
+    parser.add_option('-e', '--engines',
+                      help='comma-separated engines to run [all of %s and cp]' %
+                      ','.join(sorted(cpck.engines)))
+    parser.add_option('--digests', action='store_true', default=False,
+                      help='ask the engines for digests, as staging does')
+    parser.add_option('-o', '--output',
+                      help='JSON output file [stdout]')
+    options, args = parser.parse_args()
+
+    engines = None
+    if options.engines: engines = options.engines.split(',')
+    report = benchmark(options.dir,
+                       [parseSize(x) for x in options.sizes.split(',')],
+                       [parseSize(x) for x in options.blocks.split(',')],
+                       options.repeat, engines, options.digests)
+    if options.output:
+        ofp = open(options.output, 'w')
+    else:
+        ofp = sys.stdout
+        pass
+    json.dump(report, ofp, indent=2, sort_keys=True)
+    ofp.write('\n')
+    if options.output: ofp.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
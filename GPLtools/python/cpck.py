@@ -1,19 +1,46 @@
 #!/usr/bin/env python2.5
 
+import ctypes
+import ctypes.util
+import errno
 import hashlib
+import logging
 import optparse
 import random
 import os
 import sys
 import threading
 import time
+import zlib
 import Queue
 
+log = logging.getLogger("gplLong")
 
 defaultBlock = 2**20
 defaultPool = 2**25
 defaultDepth = defaultPool / defaultBlock
 
+## bytes moved per copy_file_range/sendfile call
+kernelBlock = 2**26
+
+## Digests computed by Summer unless told otherwise: 'md5' (hex string),
+## 'crc32' (zlib/gzip CRC as 8 hex digits) and/or 'cksum' (the POSIX
+## cksum(1) CRC, as an integer).
+digestKinds = ('md5', 'crc32', 'cksum')
+defaultKinds = ('md5', 'cksum')
+
+
+def _reverseBits(value, nBits):
+    result = 0
+    for bit in range(nBits):
+        result = (result << 1) | (value & 1)
+        value >>= 1
+        continue
+    return result
+
+_byteReverse = ''.join([chr(_reverseBits(x, 8)) for x in range(256)])
+_mask = 0xffffffff
+
 def timeCopy(fun, inFile, outFile):
     size = os.stat(inFile).st_size / 1e6
     start = time.time()
@@ -46,26 +73,180 @@ def testSpeed(inFile, outFile):
 
 
 
-def writer(ofp, q):
+## Stages of the pipelined copy.  Buffers travel as (buffer, nBytes) from
+## the free pool through reader, summer and writer and back to the pool;
+## (None, 0) marks the end of the file.  A stage that fails records the
+## exception in errors and keeps passing buffers along (without touching
+## them) so the others never block on an empty pool.
+
+def _block(buf, n):
+    if n == len(buf): return buf
+    return buf[:n]
+
+
+def reader(ifp, free, outQ, errors):
+    """Fill free buffers from ifp with readinto."""
+    try:
+        while not errors:
+            buf = free.get()
+            n = ifp.readinto(buf)
+            if not n:
+                free.put(buf)
+                break
+            outQ.put((buf, n))
+            continue
+    except:
+        errors.append(sys.exc_info())
+        pass
+    outQ.put((None, 0))
+    return
+
+
+def summer(hasher, inQ, outQ, errors):
+    """Update hasher (a Summer) with each buffer on its way to the writer."""
     while True:
-        block = q.get()
-        ofp.write(block)
-        q.task_done()
+        buf, n = inQ.get()
+        if buf is not None and not errors:
+            try:
+                hasher.update(_block(buf, n))
+            except:
+                errors.append(sys.exc_info())
+                pass
+            pass
+        outQ.put((buf, n))
+        if buf is None: break
         continue
     return
 
-def reader(q):
-    """not implemented"""
-    return
 
-def summer(hasher, inQ, outQ):
-    """junk"""
-    data = getBlock()
-    hasher.update(data)
-    putBlock(data)
+def writer(ofp, inQ, free, errors):
+    """Write each buffer to ofp and return it to the free pool."""
+    while True:
+        buf, n = inQ.get()
+        if buf is None: break
+        if not errors:
+            try:
+                ofp.write(_block(buf, n))
+            except:
+                errors.append(sys.exc_info())
+                pass
+            pass
+        free.put(buf)
+        continue
     return
 
 
+def pipeSum(inFile, outFile, digests=None, blockSize=None, depth=None,
+            kinds=None):
+    """Copy a file with reading, checksumming and writing in separate threads.
+    depth buffers of blockSize bytes are allocated once and reused, so the
+    three stages overlap without per-block allocation.  Return value and
+    digests are as for dumbSum; with kinds=() nothing is summed.
+    """
+    if blockSize is None: blockSize = defaultBlock
+    if depth is None: depth = defaultDepth
+    if kinds is None:
+        kinds = defaultKinds
+        if digests is None: kinds = ('md5',)
+        pass
+    free = Queue.Queue()
+    for i in range(max(2, depth)):
+        free.put(bytearray(blockSize))
+        continue
+    toSum = Queue.Queue()
+    toWrite = Queue.Queue()
+    errors = []
+    hasher = None
+    if kinds: hasher = Summer(kinds)
+
+    ifp = open(inFile, 'rb')
+    try:
+        ofp = open(outFile, 'wb')
+        try:
+            if hasher is None:
+                stages = [(reader, (ifp, free, toWrite, errors)),
+                          (writer, (ofp, toWrite, free, errors))]
+            else:
+                stages = [(reader, (ifp, free, toSum, errors)),
+                          (summer, (hasher, toSum, toWrite, errors)),
+                          (writer, (ofp, toWrite, free, errors))]
+                pass
+            threads = []
+            for target, args in stages:
+                t = threading.Thread(target=target, args=args)
+                t.setDaemon(True)
+                t.start()
+                threads.append(t)
+                continue
+            for t in threads: t.join()
+        finally:
+            ofp.close()
+    finally:
+        ifp.close()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    if hasher is None: return None
+    result = hasher.digests()
+    if digests is not None: digests.update(result)
+    return result.get('md5')
+
+
+def resumeSum(inFile, outFile, digests=None, blockSize=None):
+    """Copy a file, keeping whatever prefix of an existing outFile (e.g.
+    the .part file left by an interrupted copy) matches the source.
+    Blocks of the two files are compared directly until the first
+    mismatch, the rest of outFile is replaced with the source from there,
+    and if anything was kept the whole of outFile is then summed and
+    compared with the source.  On a mismatch outFile is removed and
+    IOError raised.
+    Return value and digests are as for dumbSum.
+    """
+    if blockSize is None: blockSize = defaultBlock
+    if not os.path.exists(outFile):
+        return dumbSum(inFile, outFile, digests)
+    kinds = ('md5',)
+    if digests is not None: kinds = defaultKinds
+    if 'md5' not in kinds: kinds += ('md5',)
+    summer = Summer(kinds)
+
+    ifp = open(inFile, 'rb')
+    try:
+        ofp = open(outFile, 'r+b')
+        try:
+            kept = 0
+            while True:
+                block = ifp.read(blockSize)
+                if not block: break
+                part = ofp.read(len(block))
+                if part != block: break
+                summer.update(block)
+                kept += len(block)
+                continue
+            log.info('Keeping %d bytes of %s' % (kept, outFile))
+            ofp.seek(kept)
+            ofp.truncate()
+            while block:
+                summer.update(block)
+                ofp.write(block)
+                block = ifp.read(blockSize)
+                continue
+        finally:
+            ofp.close()
+    finally:
+        ifp.close()
+
+    result = summer.digests()
+    if kept:
+        written = sumFile(outFile, ('md5',))
+        if written != {'size': result['size'], 'md5': result['md5']}:
+            os.remove(outFile)
+            raise IOError(errno.EIO, 'Digest mismatch after resuming copy to %s' % outFile)
+        pass
+    if digests is not None: digests.update(result)
+    return result['md5']
+
+
 def dumbCopy(inFile, outFile):
     reader = readIt(inFile)
     ofp = open(outFile, 'wb')
@@ -75,12 +256,75 @@ def dumbCopy(inFile, outFile):
     ofp.close()
     return
 
-def dumbSum(inFile, outFile):
+class Summer(object):
+
+    """@brief Accumulate several digests of a byte stream in one pass.
+
+    cksum(1) uses the same polynomial as zlib's CRC-32, but unreflected,
+    without the initial inversion and with the length appended.  Feeding
+    zlib bit-reversed bytes and undoing the inversions gives the cksum
+    register at C speed.
+    """
+
+    def __init__(self, kinds=None):
+        if kinds is None: kinds = defaultKinds
+        for kind in kinds:
+            if kind not in digestKinds:
+                raise ValueError, 'Unknown digest %s' % kind
+            continue
+        self.kinds = tuple(kinds)
+        self.size = 0
+        self.md5 = None
+        if 'md5' in self.kinds: self.md5 = hashlib.md5()
+        self.crc32 = 0
+        self.cksum = 0
+        return
+
+    def _cksumUpdate(self, data):
+        self.cksum = ~zlib.crc32(buffer(data.translate(_byteReverse)),
+                                 ~self.cksum & _mask) & _mask
+        return
+
+    def update(self, block):
+        """@brief Add a block (a string or bytearray) to the digests."""
+        self.size += len(block)
+        if self.md5 is not None: self.md5.update(block)
+        if 'crc32' in self.kinds: self.crc32 = zlib.crc32(buffer(block), self.crc32)
+        if 'cksum' in self.kinds: self._cksumUpdate(block)
+        return
+
+    def digests(self):
+        """@brief Return {'size': bytes, kind: digest, ...} for the data so far."""
+        result = {'size': self.size}
+        if self.md5 is not None: result['md5'] = self.md5.hexdigest()
+        if 'crc32' in self.kinds: result['crc32'] = '%08x' % (self.crc32 & _mask)
+        if 'cksum' in self.kinds:
+            saved = self.cksum
+            length = ''
+            size = self.size
+            while size:
+                length += chr(size & 0xff)
+                size >>= 8
+                continue
+            self._cksumUpdate(length)
+            result['cksum'] = ~_reverseBits(self.cksum, 32) & _mask
+            self.cksum = saved
+            pass
+        return result
+
+    pass
+
+
+def dumbSum(inFile, outFile, digests=None):
     """Copy a file, performing an md5 checksum on the fly.
     The input file is read once, the output file not at all.
     Return value is a string containing the hex representation of the sum.
+    If digests (a dictionary) is given, it is filled in with the size and
+    the digests computed by Summer.
     """
-    summer = hashlib.md5()
+    kinds = defaultKinds
+    if digests is None: kinds = ('md5',)
+    summer = Summer(kinds)
     reader = readIt(inFile)
     ofp = open(outFile, 'wb')
     for block in reader:
@@ -88,8 +332,18 @@ def dumbSum(inFile, outFile):
         ofp.write(block)
         continue
     ofp.close()
-    digest = summer.hexdigest()
-    return digest
+    result = summer.digests()
+    if digests is not None: digests.update(result)
+    return result.get('md5')
+
+
+def sumFile(inFile, kinds=None):
+    """Return the size and digests (see Summer) of a file, reading it once."""
+    summer = Summer(kinds)
+    for block in readIt(inFile):
+        summer.update(block)
+        continue
+    return summer.digests()
 
 
 def osCopy(inFile, outFile):
@@ -113,20 +367,113 @@ def osSumI(inFile, outFile):
 
 
 def threadCopy(inFile, outFile):
-    q = Queue.Queue(defaultDepth)
-    reader = readIt(inFile)
-    ofp = open(outFile, 'wb')
-    t = threading.Thread(target=writer, args=(ofp, q))
-    t.setDaemon(True)
-    t.start()
-    for block in reader:
-        q.put(block)
-        continue
-    q.join()
-    ofp.close()
+    pipeSum(inFile, outFile, kinds=())
     return
 
 
+## Kernel-side copies.  Each call moves up to count bytes from the current
+## position of one descriptor to that of the other, returning the number of
+## bytes moved (0 at end of file) or raising OSError.
+
+_libc = None
+
+def _loadLibc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        except OSError:
+            _libc = False
+            pass
+        pass
+    return _libc
+
+
+def _checkErrno(n):
+    if n < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return n
+
+
+def _copyFileRange(ifd, ofd, count):
+    return _checkErrno(_libc.copy_file_range(ifd, None, ofd, None, count, 0))
+
+
+def _libcSendfile(ifd, ofd, count):
+    return _checkErrno(_libc.sendfile(ofd, ifd, None, count))
+
+
+def _osSendfile(ifd, ofd, count):
+    return os.sendfile(ofd, ifd, None, count)
+
+
+def kernelCalls():
+    """List the kernel copy calls available here, best first."""
+    calls = []
+    libc = _loadLibc()
+    if libc and hasattr(libc, 'copy_file_range'):
+        libc.copy_file_range.restype = ctypes.c_ssize_t
+        libc.copy_file_range.argtypes = [
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_uint]
+        calls.append(_copyFileRange)
+        pass
+    if hasattr(os, 'sendfile'):
+        calls.append(_osSendfile)
+    elif libc and hasattr(libc, 'sendfile'):
+        libc.sendfile.restype = ctypes.c_ssize_t
+        libc.sendfile.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        calls.append(_libcSendfile)
+        pass
+    return calls
+
+## errors meaning "this call can't copy between these files", as opposed to
+## a real I/O error
+_unsupported = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+                errno.EOPNOTSUPP, errno.EPERM)
+
+
+def kernelCopy(inFile, outFile, digests=None, blockSize=None):
+    """Copy a file with copy_file_range or sendfile, so the data never
+    passes through Python.  Nothing is summed, so if digests are wanted
+    this falls back to dumbSum (and if the kernel can't do the copy, to an
+    unsummed pipeSum).  Return value is as for dumbSum.
+    """
+    if digests is not None: return dumbSum(inFile, outFile, digests)
+    if blockSize is None: blockSize = kernelBlock
+
+    ifd = os.open(inFile, os.O_RDONLY)
+    try:
+        ofd = os.open(outFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            for call in kernelCalls():
+                copied = 0
+                try:
+                    while True:
+                        try:
+                            n = call(ifd, ofd, blockSize)
+                        except OSError, e:
+                            if e.errno == errno.EINTR: continue
+                            raise
+                        if not n: break
+                        copied += n
+                        continue
+                    return None
+                except OSError, e:
+                    if copied or e.errno not in _unsupported: raise
+                    pass
+                continue
+        finally:
+            os.close(ofd)
+    finally:
+        os.close(ifd)
+
+    return pipeSum(inFile, outFile, kinds=())
+
+
 class readIt(object):
 
     def __init__(self, inFile, blockSize=defaultBlock):
@@ -146,10 +493,22 @@ class readIt(object):
 
     pass
 
-funs = [threadCopy, osCopy, dumbCopy, osSumI, osSumO, dumbSum]
+funs = [threadCopy, osCopy, dumbCopy, osSumI, osSumO, dumbSum, pipeSum,
+        kernelCopy]
 
+## pipeSum overlaps reading, summing and writing in threads, but the
+## hashing holds the GIL, and copyBench found it no faster than dumbSum
+## here (slower for small files), so dumbSum stays the default.
 copyAndSum = dumbSum
 
+## Copy engines selectable by name (see fileOps.copyEngine).  All take
+## (inFile, outFile, digests).
+engines = {
+    'kernel': kernelCopy,
+    'pipe': pipeSum,
+    'dumb': dumbSum,
+    }
+
 
 if __name__ == "__main__":
     main()
@@ -2,6 +2,8 @@
 """
 
 
+import errno
+import os
 import random
 import sys
 import time
@@ -16,12 +18,29 @@ log = logging.getLogger("gplLong")
 
 dirMode = 0755
 
+## Retry defaults.  With these a failing copy can wait 5-10, 10-20, 20-40
+## and 40-60 s before its four retries, up to about 130 s in all (it was
+## about 40 s when every retry waited 5-10 s); defBudget bounds the whole
+## copy, attempts included.  Set defMaxDelay = defMaxWait to get the old
+## worst case back.
 defMaxTry = 5
 defMinWait = 5
 defMaxWait = 10
+defMaxDelay = 60
+defBudget = 300
 
 xrootStart = "root:"
 
+## Engine for copies between regular files (see cpck.engines).  'dumb'
+## (cpck.copyAndSum) sums the data on its way through, so every copy logs
+## its md5; 'pipe' does the same in threads, and 'kernel' leaves the copy to
+## the kernel unless the caller asks for digests.
+copyEngine = os.environ.get('GPL_COPY_ENGINE', 'dumb')
+
+## Resume interrupted copies to regular files from the matching prefix of
+## the .part file left behind, rather than starting again.
+resumeCopies = bool(os.environ.get('GPL_COPY_RESUME'))
+
 
 def waitABit(minDelay=None, maxDelay=None):
     if minDelay is None: minDelay = minWait
@@ -62,18 +81,198 @@ def _makeWrapper(funcName):
 
 
 
-def copy(fromFile, toFile, maxTry=None, minWait=None, maxWait=None):
+## Failure classes for RetryPolicy.  Permanent failures are not retried,
+## throttling (a busy or full server) waits longer than transient ones.
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+THROTTLE = 'throttle'
+
+permanentErrnos = (errno.ENOENT, errno.EACCES, errno.EPERM, errno.ENOTDIR,
+                   errno.EISDIR, errno.EROFS, errno.ENAMETOOLONG)
+throttleErrnos = (errno.EAGAIN, errno.EBUSY, errno.EMFILE, errno.ENFILE,
+                  errno.ENOSPC, errno.EDQUOT)
+
+## Class of each nonzero return code from an xrootd copy; any code not
+## listed is TRANSIENT.
+xrootdRcClasses = {}
+
+
+class RetryPolicy(object):
+
+    """@brief Decide whether and when to retry a failed copy, and keep
+    track of how long each attempt took.
+
+    The n-th retry waits a random time between minWait and maxWait
+    seconds, doubled n-1 times (four times for throttling) and capped at
+    maxDelay; no retry starts if it would end the wait beyond budget
+    seconds after the first attempt began.  After a copy, attempts holds
+    one record per attempt and summary() the totals, so use a new policy
+    for each copy.
+    """
+
+    def __init__(self, maxTry=None, minWait=None, maxWait=None,
+                 maxDelay=None, budget=None, factor=2.0, throttleFactor=4.0):
+        if maxTry is None: maxTry = defMaxTry
+        if minWait is None: minWait = defMinWait
+        if maxWait is None: maxWait = defMaxWait
+        if maxDelay is None: maxDelay = defMaxDelay
+        if budget is None: budget = defBudget
+        self.maxTry = maxTry
+        self.minWait = minWait
+        self.maxWait = max(minWait, maxWait)
+        self.maxDelay = maxDelay
+        self.budget = budget
+        self.factor = factor
+        self.throttleFactor = throttleFactor
+        self.attempts = []
+        self.started = None
+        self.pendingWait = 0.0
+        return
+
+    def classifyError(self, exc):
+        """@brief Failure class of an EnvironmentError."""
+        if exc.errno in permanentErrnos: return PERMANENT
+        if exc.errno in throttleErrnos: return THROTTLE
+        return TRANSIENT
+
+    def classifyRc(self, impl, rc):
+        """@brief Failure class of a nonzero return code from impl.copy."""
+        if impl is xrootdFileOps: return xrootdRcClasses.get(rc, TRANSIENT)
+        return TRANSIENT
+
+    def startAttempt(self):
+        now = time.time()
+        if self.started is None: self.started = now
+        self.attempts.append({'try': len(self.attempts), 'start': now,
+                              'wait': self.pendingWait, 'seconds': None,
+                              'failure': None, 'reason': None})
+        self.pendingWait = 0.0
+        return len(self.attempts) - 1
+
+    def endAttempt(self, failure=None, reason=None):
+        attempt = self.attempts[-1]
+        attempt['seconds'] = time.time() - attempt['start']
+        attempt['failure'] = failure
+        attempt['reason'] = reason
+        return
+
+    def delay(self, failure):
+        """@brief Seconds to wait before the next attempt, or None to give up."""
+        if failure == PERMANENT: return None
+        retries = len(self.attempts)
+        if retries >= self.maxTry: return None
+        scale = self.factor ** (retries - 1)
+        if failure == THROTTLE: scale *= self.throttleFactor
+        low = min(self.maxDelay, self.minWait * scale)
+        high = min(self.maxDelay, self.maxWait * scale)
+        delay = random.uniform(low, high)
+        if time.time() + delay - self.started > self.budget: return None
+        return delay
+
+    def backoff(self, failure):
+        """@brief Wait before retrying after failure.
+        @return True if another attempt should be made.
+        """
+        delay = self.delay(failure)
+        if delay is None:
+            if failure == PERMANENT:
+                log.info("Not retrying after %s failure." % failure)
+            else:
+                log.info("Giving up: out of tries or time budget.")
+                pass
+            return False
+        log.info("Waiting %.1f seconds after %s failure." % (delay, failure))
+        time.sleep(delay)
+        self.pendingWait = delay
+        return True
+
+    def summary(self):
+        """@brief Totals over the attempts: number, failures and the wall
+        time spent in failed attempts and waiting."""
+        failed = [x for x in self.attempts if x['failure'] is not None]
+        return {'attempts': len(self.attempts),
+                'failures': len(failed),
+                'failedSeconds': sum([x['seconds'] or 0 for x in failed]),
+                'waitSeconds': sum([x['wait'] for x in self.attempts]),
+                'totalSeconds': sum([(x['seconds'] or 0) + x['wait']
+                                     for x in self.attempts]),
+                }
+
+    pass
+
+
+def _copyOnce(impl, fromFile, toFile, tn, digests, engine, policy, resume):
+    """One attempt at a copy.
+    @return (failure class, reason, size copied, seconds); failure class is None on success.
+    """
+    start = time.time()
+
+    # Verify source file is accessible and get its size
+    fromSize = getSize(fromFile)
+    if fromSize is None:
+        log.error('%s does not exist!' % fromFile)
+        if isOnXrootd(fromFile): return TRANSIENT, 'source not found', None, 0
+        return PERMANENT, 'source not found', None, 0
+
+    # The following kludge is necessary (11/4/2008) due to bug in xrdcp
+    #  wherein overwriting an existing file on a "full" server will fail
+    #  The fix is to first delete the file.  
+    log.debug("Attempting to remove destination file")
+    remove(toFile)
+    resume = resume and impl is fsFileOps and tn != toFile
+    if tn != toFile and not resume: remove(tn)
+
+    rc = mkdirFor(tn)
+    rc |= impl.copy(fromFile, tn, digests, engine, resume)
+
+    if rc:
+        msg = 'Oops. Retrying. (rc=%d)' % rc
+        log.error(msg)
+        return policy.classifyRc(impl, rc), 'rc=%d' % rc, None, 0
+
+    deltaT = time.time() - start
+
+    # Verify destination file has been copied
+    try:
+        toSize = getSize(tn)
+    except OSError:
+        toSize = None
+        pass
+    if toSize is None:
+        log.error('%s does not exist!' % tn)
+        return TRANSIENT, 'destination not found', None, 0
+
+    if toSize != fromSize:
+        msg = 'Size mismatch!\n%d: %s\n%d %s' % \
+              (fromSize, fromFile, toSize, tn)
+        log.error(msg)
+        return TRANSIENT, 'size mismatch', None, 0
+
+    rc = unTemp(toFile)
+    if rc: return TRANSIENT, 'rename failed', None, 0
+    return None, None, toSize, deltaT
+
+
+def copy(fromFile, toFile, maxTry=None, minWait=None, maxWait=None,
+         digests=None, engine=None, policy=None, resume=None):
     """
     @brief copy a file
     @param fromFile = name of ssource file
     @param toFile = name of destination file
+    @param digests = optional dictionary; on success it holds the size and
+    digests (see cpck.Summer) of the data copied, if the copy computed them
+    @param engine = copy engine for regular files (default copyEngine)
+    @param policy = RetryPolicy deciding on retries (default one built from
+    maxTry, minWait and maxWait); its attempts record how each try went
+    @param resume = continue from a .part file left by an earlier try
+    (regular files only; default resumeCopies)
     @return success code
 
     This does retries, logging, and performs various checks.
     """
-    if maxTry is None: maxTry = defMaxTry
-    if minWait is None: minWait = defMinWait
-    if maxWait is None: maxWait = defMaxWait
+    if policy is None: policy = RetryPolicy(maxTry, minWait, maxWait)
+    if engine is None: engine = copyEngine
+    if resume is None: resume = resumeCopies
     
     rc = 0
 
@@ -91,70 +290,31 @@ def copy(fromFile, toFile, maxTry=None, minWait=None, maxWait=None):
     # automount), several attempts are made to copy the input file to
     # local scratch space.  If that fails, then staging is effectively
     # disabled for that file.
-    for mytry in range(maxTry):
-        if mytry: waitABit(minWait, maxWait)
-        rc = 0
-        start = time.time()
+    while True:
+        mytry = policy.startAttempt()
+        if digests is not None: digests.clear()
 
         log.info('Starting try %d.' % mytry)
 
         try:
-            # Verify source file is accessible and get its size
-            fromSize = getSize(fromFile)
-            if fromSize is None:
-                log.error('%s does not exist!' % fromFile)
-                rc |= 1
-                continue
-
-            # The following kludge is necessary (11/4/2008) due to bug in xrdcp
-            #  wherein overwriting an existing file on a "full" server will fail
-            #  The fix is to first delete the file.  
-            log.debug("Attempting to remove destination file")
-            remove(toFile)
-            if tn != toFile: remove(tn)
-
-            rc |= mkdirFor(tn)
-            rc |= impl.copy(fromFile, tn)
-
-            if rc:
-                msg = 'Oops. Retrying. (rc=%d)' % rc
-                log.error(msg)
-                continue
-        
-            deltaT = time.time() - start
-        
-            # Verify destination file has been copied
-            try:
-                toSize = getSize(tn)
-            except OSError:
-                toSize = None
-                pass
-            if toSize is None:
-                log.error('%s does not exist!' % tn)
-                rc = 1
-                continue
-
-            if toSize != fromSize:
-                msg = 'Size mismatch!\n%d: %s\n%d %s' % \
-                      (fromSize, fromFile, toSize, tn)
-                log.error(msg)
-                rc = 1
-                continue
-
-            rc |= unTemp(toFile)
-        
-        except EnvironmentError:
-            rc |= 1
+            failure, reason, toSize, deltaT = _copyOnce(
+                impl, fromFile, toFile, tn, digests, engine, policy, resume)
+        except EnvironmentError, e:
+            failure, reason = policy.classifyError(e), str(e)
             log.error("Error copying file to %s (try %d):" % (toFile, mytry))
             traceback.print_exc()
-            continue
+            pass
+        policy.endAttempt(failure, reason)
 
+        rc = int(failure is not None)
         log.debug('Try %d rc: %d' % (mytry,rc))
         if not rc: break
+        if not policy.backoff(failure): break
         continue
 
     if rc:
         log.info('Failed after %d tries' % (mytry+1))
+        if digests is not None: digests.clear()
         return 1
     
     log.info('Succeeded after %d tries' % (mytry+1))
@@ -13,17 +13,28 @@ import logging
 log = logging.getLogger("gplLong")
 
 
-def copy(fromFile, toFile):
+def copy(fromFile, toFile, digests=None, engine=None, resume=False):
     """
     @brief copy a file
     @param fromFile = name of ssource file
     @param toFile = name of destination file
+    @param digests = optional dictionary to receive the size and digests of the data copied
+    @param engine = name of the cpck copy engine to use (default cpck.copyAndSum)
+    @param resume = keep the part of an existing toFile that matches fromFile (see cpck.resumeSum)
     @return success code - actually always 0, raises exceptions on failure.
 
     This just copies the file.
     """
-    checksum = cpck.copyAndSum(fromFile, toFile)
-    log.info('Checksum = %s' % checksum)
+    if resume and os.path.exists(toFile):
+        log.info('Resuming copy to %s' % toFile)
+        copier = cpck.resumeSum
+    elif engine is None:
+        copier = cpck.copyAndSum
+    else:
+        copier = cpck.engines[engine]
+        pass
+    checksum = copier(fromFile, toFile, digests)
+    if checksum is not None: log.info('Checksum = %s' % checksum)
     return 0
 
 
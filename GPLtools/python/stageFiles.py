@@ -8,12 +8,16 @@ refactored: T.Glanzman 2/22/2007
 
 ## Preliminaries
 import os
+import Queue
 import re
 import sys
 import shutil
+import threading
 import time
 
+import cpck
 import fileOps
+import pipeline
 import runner
 
 ## Set up message logging
@@ -25,6 +29,156 @@ filterAll = '.*'
 filterNone = None
 defaultStrictSetup = False
 
+## Transfer concurrency.  By default transfers run one at a time, in the
+## calling thread, exactly as they always have.  $GPL_STAGE_THREADS (or the
+## maxThreads constructor argument) allows that many transfers at once, with
+## at most defaultFsLimit of them touching any one filesystem (or xrootd
+## server); fsLimits overrides that for paths starting with a given prefix.
+defaultMaxThreads = 1
+defaultFsLimit = 2
+fsLimits = {}
+
+## Record digests of staged files as they are copied (see getChecksums).
+## Without them, copies between regular files are left to the kernel
+## (the defaultCopyEngine, see fileOps.copyEngine).
+defaultChecksums = True
+defaultCopyEngine = os.environ.get('GPL_STAGE_COPY_ENGINE', 'kernel')
+
+
+def fsKey(fileName):
+    """@brief Name the filesystem (mount point or xrootd server) holding a file."""
+    if fileOps.isOnXrootd(fileName):
+        return '/'.join(fileName.split('/')[:3])
+    path = os.path.dirname(os.path.abspath(fileName))
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path: break
+        path = parent
+        continue
+    return path
+
+
+class Transfer(object):
+
+    """@brief A file transfer run by a TransferScheduler."""
+
+    def __init__(self, func, args, kwargs=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.rc = None
+        self.excInfo = None
+        self.done = threading.Event()
+        return
+
+    def run(self):
+        try:
+            self.rc = self.func(*self.args, **self.kwargs)
+        except:
+            self.excInfo = sys.exc_info()
+            pass
+        self.done.set()
+        return
+
+    def wait(self):
+        """@brief Wait for the transfer and return its result (or raise its exception)."""
+        self.done.wait()
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.rc
+
+
+class TransferScheduler(object):
+
+    """@brief Run file transfers on a bounded pool of threads.
+
+    Each transfer names the files it touches; no more than fsLimit
+    transfers involving the same filesystem run at once.  With maxThreads
+    of 1 every transfer runs synchronously when it is submitted.
+    """
+
+    def __init__(self, maxThreads=None, fsLimit=None, limits=None):
+        if maxThreads is None:
+            maxThreads = int(os.environ.get('GPL_STAGE_THREADS', defaultMaxThreads))
+        if fsLimit is None: fsLimit = defaultFsLimit
+        if limits is None: limits = fsLimits
+        self.maxThreads = max(1, maxThreads)
+        self.fsLimit = max(1, fsLimit)
+        self.limits = limits
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        return
+
+    def _semaphore(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.semaphores:
+                limit = self.fsLimit
+                for prefix, value in self.limits.items():
+                    if key.startswith(prefix): limit = value
+                    continue
+                self.semaphores[key] = threading.Semaphore(max(1, limit))
+                pass
+            return self.semaphores[key]
+        finally:
+            self.lock.release()
+
+    def _worker(self):
+        while True:
+            transfer, keys = self.queue.get()
+            if transfer is None: break
+            # take the filesystem slots in a fixed order so transfers
+            # sharing two filesystems can't deadlock
+            sems = [self._semaphore(key) for key in keys]
+            for sem in sems: sem.acquire()
+            try:
+                transfer.run()
+            finally:
+                for sem in sems: sem.release()
+                pass
+            continue
+        return
+
+    def submit(self, func, fileNames, *args, **kwargs):
+        """@brief Schedule func(*args, **kwargs), a transfer touching the named files.
+        @return a Transfer; call its wait() for the result.
+        """
+        transfer = Transfer(func, args, kwargs)
+        if self.maxThreads == 1:
+            transfer.run()
+            return transfer
+        keys = sorted(set([fsKey(name) for name in fileNames]))
+        self.lock.acquire()
+        try:
+            if len(self.threads) < self.maxThreads:
+                thread = threading.Thread(target=self._worker)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+                pass
+        finally:
+            self.lock.release()
+        self.queue.put((transfer, keys))
+        return transfer
+
+    def copy(self, fromFile, toFile, digests=None, engine=None, policy=None):
+        """@brief Schedule fileOps.copy(fromFile, toFile, digests=digests, engine=engine, policy=policy)."""
+        return self.submit(fileOps.copy, (fromFile, toFile), fromFile, toFile,
+                           digests=digests, engine=engine, policy=policy)
+
+    def shutdown(self):
+        """@brief Stop the worker threads once the queued transfers are done."""
+        self.lock.acquire()
+        threads = self.threads
+        self.threads = []
+        self.lock.release()
+        for thread in threads: self.queue.put((None, None))
+        for thread in threads: thread.join()
+        return
+
+
 class StageSet:
 
     """@brief Manage staging of files to/from machine-local disk.
@@ -61,14 +215,22 @@ class StageSet:
 
 
     def __init__(self, stageName=None, stageArea=None, excludeIn=filterAfs,
-                 excludeOut=filterNone, autoStart=True, strictSetup=None):
+                 excludeOut=filterNone, autoStart=True, strictSetup=None,
+                 maxThreads=None, background=False, checksums=None,
+                 copyEngine=None):
         """@brief Initialize the staging system
         @param [stageName] Name of directory where staged copies are kept.
         @param [stageArea] Parent of directory where staged copies are kept.
         @param [exculde] Regular expresion for file names which should not be staged.
+        @param [maxThreads] Number of transfers to run at once (default $GPL_STAGE_THREADS or 1).
+        @param [background] Return from stageIn before the copy is done; call wait(name) before using the file.
+        @param [checksums] Record digests while copying (default defaultChecksums).
+        @param [copyEngine] Copy engine for regular files (default defaultCopyEngine).
         """
 
         if strictSetup is None: strictSetup = defaultStrictSetup
+        if checksums is None: checksums = defaultChecksums
+        if copyEngine is None: copyEngine = defaultCopyEngine
 
         log.debug("Entering stageFiles constructor...")
         self.setupFlag = 0
@@ -77,6 +239,11 @@ class StageSet:
         self.excludeIn = excludeIn
         self.excludeOut = excludeOut
         self.autoStart = autoStart
+        self.scheduler = TransferScheduler(maxThreads)
+        self.background = background and self.scheduler.maxThreads > 1
+        self.checksums = checksums
+        self.copyEngine = copyEngine
+        self.copyPolicies = []
         
         ##
         ## defaultStateAreas defines all possible machine-local stage
@@ -218,8 +385,13 @@ class StageSet:
         
         log.info("\nstageIn for: "+inFile)
 
-        inStage = StagedFile(stageName, source=inFile,
-                             cleanup=cleanup, autoStart=self.autoStart)
+        inStage = StagedFile(stageName, source=inFile, cleanup=cleanup,
+                             autoStart=self.autoStart and not self.background,
+                             checksums=self.checksums, engine=self.copyEngine,
+                             policies=self.copyPolicies)
+        if self.autoStart and self.background:
+            inStage.start(self.scheduler)
+            pass
 
         self.numIn=self.numIn+1
         self.stagedFiles.append(inStage)
@@ -260,7 +432,9 @@ class StageSet:
             pass
 
         outStage = StagedFile(
-            stageName, destinations=destinations, cleanup=cleanup)
+            stageName, destinations=destinations, cleanup=cleanup,
+            checksums=self.checksums, engine=self.copyEngine,
+            policies=self.copyPolicies)
         self.stagedFiles.append(outStage)
 
         self.numOut=self.numOut+1
@@ -296,7 +470,13 @@ class StageSet:
         log.info("\nstageMod for: "+modFile)
 
         modStage = StagedFile(stageName, source=modFile, destinations=[modFile],
-                             cleanup=cleanup, autoStart=self.autoStart)
+                              cleanup=cleanup,
+                              autoStart=self.autoStart and not self.background,
+                              checksums=self.checksums, engine=self.copyEngine,
+                              policies=self.copyPolicies)
+        if self.autoStart and self.background:
+            modStage.start(self.scheduler)
+            pass
 
         self.numMod += 1
         self.stagedFiles.append(modStage)
@@ -314,10 +494,35 @@ class StageSet:
 
 
     def start(self):
+        if self.scheduler.maxThreads == 1:
+            rc = 0
+            for stagee in self.stagedFiles:
+                rc |= stagee.start()
+                continue
+            return rc
+        for stagee in self.stagedFiles:
+            stagee.start(self.scheduler)
+            continue
+        return self.wait()
+
+
+    def wait(self, stageName=None):
+        """@brief Wait for stage-ins to complete.
+        @param [stageName] Staged name (as returned by stageIn) to wait for; default all.
+        @return OR of the copy return codes; raises IOError if a stage-in failed, as start() does.
+        """
         rc = 0
+        excInfo = None
         for stagee in self.stagedFiles:
-            rc |= stagee.start()
+            if stageName is not None and stagee.location != stageName: continue
+            try:
+                rc |= stagee.wait()
+            except IOError:
+                if excInfo is None: excInfo = sys.exc_info()
+                pass
             continue
+        if excInfo is not None:
+            raise excInfo[0], excInfo[1], excInfo[2]
         return rc
     
 
@@ -350,10 +555,24 @@ class StageSet:
             keep = True
             pass
 
-        # copy stageOut files to their final destinations
+        # make sure no stage-in is still writing to the staging area
+        try:
+            self.wait()
+        except IOError:
+            pass
+
+        # copy stageOut files to their final destinations (all at once if
+        # transfers may run concurrently), then clean up after each
+        if self.scheduler.maxThreads > 1:
+            for stagee in self.stagedFiles:
+                stagee.copyOut(self.scheduler)
+                continue
+            pass
         for stagee in self.stagedFiles:
-            rc |= stagee.finish(keep)
+            rc |= stagee.finish(keep, self.scheduler)
             continue
+        self.scheduler.shutdown()
+        self.writeRetryStats()
     
         if option == "keep": return rc              # Early return #1
 
@@ -424,7 +643,12 @@ class StageSet:
 
 
     def getChecksums(self,printflag=None):
-        """@brief Return a dictionary of: [stagedOut file name,[length,checksum] ].  Call this after creating file(s), but before finish(), if at all.  If the printflag is set to 1, a brief report will be sent to stdout."""
+        """@brief Return a dictionary of: [stagedOut file name,[checksum,length] ].  Call this after creating file(s), but before finish(), if at all.  If the printflag is set to 1, a brief report will be sent to stdout.
+
+        The checksum is the POSIX cksum CRC.  Digests recorded while a file
+        was being copied are reused as long as the file has not changed
+        since; otherwise the file is read once and its digests kept for later.
+        """
         cksums = {}
         # Compute checksums for all stagedOut files
         log.info("Calculating 32-bit CRC checksums for stagedOut files")
@@ -432,15 +656,12 @@ class StageSet:
             if len(stagee.destinations) != 0:
                 file = stagee.location
                 if os.access(file,os.R_OK):
-                    cksum = "cksum "+file
-                    fd = os.popen(cksum,'r')    # Capture output from unix command
-                    foo = fd.read()             # Calculate checksum
-                    rc = fd.close()
-                    if rc != None:
-                        log.warning("Checksum error: return code =  "+str(rc)+" for file "+file)
+                    try:
+                        digests = stagee.checksum()
+                    except EnvironmentError, e:
+                        log.warning("Checksum error: %s for file %s" % (e, file))
                     else:
-                        cksumout = foo.split()
-                        cksums[cksumout[2]] = [cksumout[0],cksumout[1]]
+                        cksums[file] = [str(digests['cksum']),str(digests['size'])]
                         pass
                 else:
                     log.warning("Checksum error: file does not exist, "+file)
@@ -460,6 +681,39 @@ class StageSet:
 
 
 
+    def getRetryStats(self):
+        """@brief Return the totals (see fileOps.RetryPolicy.summary) over all copies made so far, e.g. for the pipeline summary."""
+        stats = {'copies': 0, 'attempts': 0, 'failures': 0,
+                 'failedSeconds': 0.0, 'waitSeconds': 0.0, 'totalSeconds': 0.0}
+        for policy in self.copyPolicies:
+            stats['copies'] += 1
+            for key, value in policy.summary().items():
+                stats[key] += value
+                continue
+            continue
+        return stats
+
+
+
+    def writeRetryStats(self):
+        """@brief Add the copy retry totals (see getRetryStats) to the pipeline summary, if there is one.
+        They cover every copy made so far, so a later call supersedes an earlier one."""
+        if not os.environ.get("PIPELINE_SUMMARY"): return
+        stats = self.getRetryStats()
+        try:
+            pipeline.setVariable("stageCopies", stats['copies'])
+            pipeline.setVariable("stageCopyAttempts", stats['attempts'])
+            pipeline.setVariable("stageCopyFailures", stats['failures'])
+            pipeline.setVariable("stageCopyFailedSeconds", "%.1f" % stats['failedSeconds'])
+            pipeline.setVariable("stageCopyWaitSeconds", "%.1f" % stats['waitSeconds'])
+            pipeline.setVariable("stageCopySeconds", "%.1f" % stats['totalSeconds'])
+        except EnvironmentError, e:
+            log.warning("Could not write copy retry totals to the pipeline summary: %s" % e)
+            pass
+        return
+
+
+
     def getStageDir(self):
         """@brief Return the name of the stage directory being used"""
         if self.setupOK == 0: return ""
@@ -509,12 +763,22 @@ class StageSet:
 class StagedFile(object):
 
     def __init__(self, location, source=None, destinations=[],
-                 cleanup=False, autoStart=True):
+                 cleanup=False, autoStart=True, checksums=True, engine=None,
+                 policies=None):
         self.source = source                   # (stageIn) original file location
         self.location = location               # temporary file location during job
         self.destinations = list(destinations) # (stageOut) list of final destinations for file
         self.cleanup = cleanup                 # cleanup=>remove file at finish()
         self.started = False                   # (stageIn) file has been copied to scratch area
+        self.transfer = None                   # (stageIn) copy in progress
+        self.transfers = None                  # (stageOut) copies in progress
+        self.checksums = checksums             # record digests while copying
+        self.engine = engine                   # copy engine (default fileOps.copyEngine)
+        if policies is None: policies = []
+        self.policies = policies               # RetryPolicy of each copy made (may be shared)
+        self.inDigests = {}                    # (stageIn) filled in by the copy
+        self.digests = None                    # size & digests of file at location
+        self.digestStamp = None                # (size, mtime) of location when digested
         if location in self.destinations:      # prevent shooting self in foot
             self.destinations.remove(location)
             self.cleanup = False
@@ -534,28 +798,111 @@ class StagedFile(object):
         log.info('started: %s' % self.started)
         return
 
-    def start(self):                   # copy stagedIn file to temporary working area
+    def start(self, scheduler=None):   # copy stagedIn file to temporary working area
+        if self.transfer is not None:      # already started by a scheduler
+            if scheduler is None: return self.wait()
+            return 0
         self.dumpState()
         rc = 0
         if self.source and self.location != self.source and not self.started:
-            rc = fileOps.copy(self.source, self.location)
+            digests = None
+            if self.checksums: digests = self.inDigests
+            policy = fileOps.RetryPolicy()
+            self.policies.append(policy)
+            if scheduler is not None:
+                self.transfer = scheduler.copy(self.source, self.location,
+                                               digests, self.engine, policy)
+                return 0
+            rc = fileOps.copy(self.source, self.location,
+                              digests=digests, engine=self.engine,
+                              policy=policy)
+            if not rc: self.recordDigests(self.inDigests)
             pass
         if rc:
             raise IOError, "Can't stage in %s" % self.source
         self.started = True
         return rc
 
-    def finish(self, keep=False):      # copy stagedOut file to final destination(s) & cleanup
-        self.dumpState()
+    def wait(self):                    # wait for a stage-in started by a scheduler
         rc = 0
+        if self.transfer is not None:
+            rc = self.transfer.wait()
+            if rc:
+                raise IOError, "Can't stage in %s" % self.source
+            if not self.started: self.recordDigests(self.inDigests)
+            self.started = True
+            pass
+        return rc
+
+    def _stamp(self):
+        st = os.stat(self.location)
+        return (st.st_size, st.st_mtime)
+
+    def recordDigests(self, digests):  # remember digests computed while copying location
+        if not digests: return
+        try:
+            stamp = self._stamp()
+        except OSError:
+            return
+        if stamp[0] != digests['size']: return
+        if self.digestStamp == stamp:
+            for kind in digests:
+                if kind in self.digests and self.digests[kind] != digests[kind]:
+                    log.warning('%s digest of %s changed from %s to %s while copying' %
+                                (kind, self.location, self.digests[kind], digests[kind]))
+                    pass
+                continue
+            pass
+        self.digests = dict(digests)
+        self.digestStamp = stamp
+        return
+
+    def checksum(self):                # size & digests of location, reading it only if necessary
+        stamp = self._stamp()
+        if self.digestStamp != stamp or 'cksum' not in self.digests:
+            log.info('Reading %s for checksums' % self.location)
+            self.digests = cpck.sumFile(self.location)
+            self.digestStamp = stamp
+            pass
+        return self.digests
+
+    def copyOut(self, scheduler=None): # start copying stagedOut file to final destination(s)
+        if self.transfers is not None: return
+        self.transfers = []
+        self.outDigests = []
         if not 'SCRATCH' in self.destinations:
+            if scheduler is None: scheduler = TransferScheduler(1)
             for dest in self.destinations:
-                rc |= fileOps.copy(self.location, dest)
+                digests = None
+                if self.checksums:
+                    digests = {}
+                    self.outDigests.append(digests)
+                    pass
+                policy = fileOps.RetryPolicy()
+                self.policies.append(policy)
+                self.transfers.append(scheduler.copy(self.location, dest,
+                                                     digests, self.engine,
+                                                     policy))
+                continue
+            pass
+        return
+
+    def finish(self, keep=False, scheduler=None): # copy stagedOut file to final destination(s) & cleanup
+        self.dumpState()
+        rc = 0
+        if not 'SCRATCH' in self.destinations:
+            self.copyOut(scheduler)
+            for transfer in self.transfers:
+                rc |= transfer.wait()
+                continue
+            for digests in self.outDigests:
+                self.recordDigests(digests)
                 continue
             pass
         else:
             log.info('File declared scratch, not copying to destination: '+self.destinations[0])
             pass
+        self.transfers = None
         
         if not keep and self.cleanup and os.access(self.location, os.W_OK):
             log.info('Nuking %s' % self.location)
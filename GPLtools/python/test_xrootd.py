@@ -0,0 +1,152 @@
+"""@brief Offline tests of the xrootd backends (see xrootdClient).
+
+A scratch directory stands in for the xrootd server: LocalBackend maps
+root://host//path onto it directly, the worker processes serve it through
+the same LocalBackend, and fake xrdcp and xrd.pl commands serve it to
+CommandBackend, so that its command lines and output parsing are exercised.
+The XRootD python bindings (BindingsBackend) are not tested here.
+
+Run as "python test_xrootd.py" from this directory (or with it on
+PYTHONPATH).
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fileOps
+import xrootdClient
+import xrootdFileOps
+
+## The fake xrdcp and xrd.pl (one script, which looks at its own name).
+fakeCommand = '''
+import os, shutil, sys
+root = os.environ['GPL_XROOTD_FAKE_ROOT']
+def local(name):
+    if not name.startswith('root:'): return name
+    return os.path.join(root, name.split('://', 1)[1].split('/', 1)[1].lstrip('/'))
+args = [x for x in sys.argv[1:] if not x.startswith('-')]
+if os.path.basename(sys.argv[0]) == 'xrdcp':
+    src, dest = [local(x) for x in args]
+    if not os.path.exists(src): sys.exit(54)
+    if not os.path.isdir(os.path.dirname(dest)): os.makedirs(os.path.dirname(dest))
+    shutil.copyfile(src, dest)
+    sys.exit(0)
+op, name = args
+path = local(name)
+if not os.path.exists(path): sys.exit(1)
+if op == 'stat':
+    # xrd.pl -w stat prints the size as its second field
+    sys.stdout.write('%s %d 0 %d\\n' % (name, os.path.getsize(path), os.path.getmtime(path)))
+elif op == 'rm':
+    os.remove(path)
+elif op == 'rmtree':
+    shutil.rmtree(path)
+else:
+    sys.exit(2)
+'''
+
+
+class XrootdTest(unittest.TestCase):
+
+    remote = 'root://localhost//glast/test/file'
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp(prefix='test_xrootd.')
+        self.root = os.path.join(self.top, 'server')
+        os.environ['GPL_XROOTD_FAKE_ROOT'] = self.root
+        self.src = os.path.join(self.top, 'src')
+        self.back = os.path.join(self.top, 'back')
+        open(self.src, 'w').write('x' * 1000)
+        bindir = os.path.join(self.top, 'bin')
+        os.mkdir(bindir)
+        for name in ('xrdcp', 'xrd.pl'):
+            script = os.path.join(bindir, name)
+            open(script, 'w').write('#!%s\n%s' % (sys.executable, fakeCommand))
+            os.chmod(script, 0755)
+            continue
+        self.saved = (xrootdFileOps.xrdcp, xrootdFileOps.xrdstat, xrootdFileOps.xrd)
+        xrootdFileOps.xrdcp = os.path.join(bindir, 'xrdcp') + ' '
+        xrootdFileOps.xrdstat = os.path.join(bindir, 'xrd.pl') + ' -w stat '
+        xrootdFileOps.xrd = os.path.join(bindir, 'xrd.pl')
+        self.workers = []
+        return
+
+    def tearDown(self):
+        for backend in self.workers: backend.close()
+        xrootdFileOps.xrdcp, xrootdFileOps.xrdstat, xrootdFileOps.xrd = self.saved
+        xrootdFileOps.setBackend(None)
+        os.environ.pop('GPL_XROOTD_FAKE_ROOT', None)
+        os.environ.pop('GPL_XROOTD_FAKE_DELAY', None)
+        shutil.rmtree(self.top, ignore_errors=True)
+        return
+
+    def workerBackend(self, **kwargs):
+        backend = xrootdClient.WorkerBackend(**kwargs)
+        self.workers.append(backend)
+        return backend
+
+    def checkBackend(self, backend):
+        self.assertEqual(backend.stat(self.remote), None)
+        self.assertEqual(backend.copy(self.src, self.remote), 0)
+        self.assertEqual(backend.stat(self.remote), 1000)
+        self.assertEqual(backend.copy(self.remote, self.back), 0)
+        self.assertEqual(open(self.back).read(), 'x' * 1000)
+        self.assertEqual(backend.remove(self.remote), 0)
+        self.assertNotEqual(backend.remove(self.remote), 0)
+        self.assertEqual(backend.copy(self.src, self.remote), 0)
+        self.assertEqual(backend.rmtree('root://localhost//glast'), 0)
+        self.assertEqual(backend.stat(self.remote), None)
+        return
+
+    def testLocal(self):
+        self.checkBackend(xrootdClient.LocalBackend(self.root))
+        return
+
+    def testWorker(self):
+        self.checkBackend(self.workerBackend())
+        return
+
+    def testCommand(self):
+        self.checkBackend(xrootdFileOps.CommandBackend())
+        return
+
+    def testWorkerConcurrency(self):
+        # four slow requests to one redirector overlap rather than queue
+        os.environ['GPL_XROOTD_FAKE_DELAY'] = '0.5'
+        backend = self.workerBackend(maxWorkers=4)
+        backend.copy(self.src, self.remote)
+        results = []
+        def stat():
+            results.append(backend.stat(self.remote))
+            return
+        threads = [threading.Thread(target=stat) for i in range(4)]
+        start = time.time()
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        elapsed = time.time() - start
+        self.assertEqual(results, [1000] * 4)
+        self.assertTrue(elapsed < 1.5, 'four stats took %.1f s' % elapsed)
+        self.assertEqual(len(backend.workers['root://localhost']), 4)
+        return
+
+    def testFileOpsCopy(self):
+        # a whole fileOps.copy to and from xrootd through the commands
+        xrootdFileOps.setBackend(xrootdFileOps.CommandBackend())
+        self.assertEqual(fileOps.copy(self.src, self.remote, maxTry=1), 0)
+        self.assertEqual(fileOps.getSize(self.remote), 1000)
+        self.assertEqual(fileOps.copy(self.remote, self.back, maxTry=1), 0)
+        self.assertEqual(open(self.back).read(), 'x' * 1000)
+        return
+
+    pass
+
+
+if __name__ == "__main__":
+    unittest.main()
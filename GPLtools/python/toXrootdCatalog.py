@@ -24,6 +24,26 @@
 ##  If no cut is applied, there is no need to supply the -m option, and the
 ##  group would be "Concat"
 ##
+##  Batch mode:
+##
+##  toXrootdCatalog.py -b <manifest> -r <results> [-j <copies at once>] [--resume]
+##                       -e yes [-t <type>] [-g <group>] [-m 'metadata']
+##
+##  Each non-comment line of the manifest names one file:
+##
+##    <in_filespec> <xrootd path> <catalogue path> [<type> [<group> [<metadata>]]]
+##
+##  with the type, group and metadata defaulting to the -t, -g and -m
+##  options (the metadata is the rest of the line).  The files are copied
+##  several at a time through GPLtools fileOps (which checks the size of
+##  each copy), then registered, also several at a time, with one datacat
+##  registerDataset per file.  The outcome for each file is appended to the
+##  results file, one JSON record per line, as each copy and registration
+##  finishes (the last record for a file wins), so a killed batch can be
+##  resumed; the file is rewritten with one record per file at the end.
+##  With --resume, files the results already show as copied (and still the
+##  same size in xrootd) or registered are not copied or registered again.
+##
 ##   noric11:richard> toXrootdCatalog.py -i $u18/MC-tasks/allGamma-GR-v13r9p12-LowE/prune5000/allGamma-GR-v13r9p12-LowE-pruned-merit.root -x mc/ServiceChallenge/allGamma-GR-v13r9p12-LowE/skims/ -d /MC-Tasks/ServiceChallenge/allGamma-GR-v13r9p12-LowE/skims/ -g pruneGamma -m 'TCut=ObfGamStatus>0'
 ##  
 ##
@@ -37,10 +57,194 @@
 ##
 import os
 import sys
+import json
 import math
 import stat
+import subprocess
 from optparse import OptionParser
 
+import fileOps
+import stageFiles
+
+xrootRedirector = 'root://glast-rdr.slac.stanford.edu//glast/'
+xrdcpLoc = '/sdf/data/fermi/a/applications/xrootd/dist/v3.1.1/i386_rhel60/bin/xrdcp'
+datacatLoc = '/sdf/data/fermi/a/ground/bin/datacat'
+
+
+##
+## Batch mode
+##
+def readManifest(manifest, defaults):
+    entries = []
+    for line in open(manifest):
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+        fields = line.split(None, 5)
+        if len(fields) < 3:
+            print 'Bad manifest line: ' + line
+            return None
+        entry = dict(defaults)
+        entry['input'] = fields[0]
+        entry['xrootd'] = xrootRedirector + fields[1] + '/' + os.path.basename(fields[0])
+        entry['datacat'] = fields[2]
+        for key, value in zip(('type', 'group', 'metadata'), fields[3:]):
+            entry[key] = value
+            continue
+        entries.append(entry)
+        continue
+    return entries
+
+
+def readResults(results):
+    done = {}
+    if not os.path.exists(results): return done
+    for line in open(results):
+        line = line.strip()
+        if not line: continue
+        record = json.loads(line)
+        done[(record['input'], record['xrootd'])] = record
+        continue
+    return done
+
+
+def writeResults(results, entries):
+    tmp = results + '.tmp'
+    ofd = open(tmp, 'w')
+    for entry in entries:
+        ofd.write(json.dumps(entry, sort_keys=True) + '\n')
+        continue
+    ofd.close()
+    os.rename(tmp, results)
+    return
+
+
+def appendResult(results, entry):
+    ofd = open(results, 'a')
+    ofd.write(json.dumps(entry, sort_keys=True) + '\n')
+    ofd.close()
+    return
+
+
+def registerCommand(entry):
+    useMeta = ''
+    if entry['metadata'] != 'null':
+        useMeta = '-D s"' + entry['metadata'] + '"'
+    return datacatLoc + ' registerDataset -G  ' + entry['group'] + ' ' + useMeta + ' -S SLAC_XROOT ' + \
+           entry['type'] + ' ' + entry['datacat'] + ' ' + entry['xrootd']
+
+
+def register(entry):
+    return subprocess.call(registerCommand(entry), shell=True)
+
+
+def copyBatch(entries, jobs, execute, results):
+    scheduler = stageFiles.TransferScheduler(maxThreads=jobs, fsLimit=jobs)
+    transfers = []
+    for entry in entries:
+        if entry['copied']: continue
+        if not execute:
+            print 'Test prep of xrootd copy: %s -> %s' % (entry['input'], entry['xrootd'])
+            continue
+        transfers.append((entry, scheduler.copy(entry['input'], entry['xrootd'])))
+        continue
+    for entry, transfer in transfers:
+        try:
+            rc = transfer.wait()
+        except EnvironmentError, e:
+            rc = str(e)
+            pass
+        if rc:
+            entry['error'] = 'copy failed: %s' % rc
+        else:
+            entry['copied'] = True
+            entry['error'] = None
+            pass
+        appendResult(results, entry)
+        continue
+    scheduler.shutdown()
+    return
+
+
+def registerBatch(entries, jobs, execute, results):
+    # each registerDataset is its own JVM, so run several at once like the
+    # copies; they touch no files, so only the thread count bounds them
+    scheduler = stageFiles.TransferScheduler(maxThreads=jobs)
+    registrations = []
+    for entry in entries:
+        if entry['error'] or entry['registered']: continue
+        if execute and not entry['copied']: continue
+        if not execute:
+            print 'Test prep of datacat registration: ' + registerCommand(entry)
+            continue
+        registrations.append((entry, scheduler.submit(register, (), entry)))
+        continue
+    for entry, registration in registrations:
+        try:
+            rc = registration.wait()
+        except EnvironmentError, e:
+            rc = str(e)
+            pass
+        if rc:
+            entry['error'] = 'registration failed: rc=%s' % rc
+        else:
+            entry['registered'] = True
+            entry['error'] = None
+            pass
+        appendResult(results, entry)
+        continue
+    scheduler.shutdown()
+    return
+
+
+def runBatch(options):
+    defaults = {'type': options.inputType, 'group': options.group,
+                'metadata': options.metadata}
+    entries = readManifest(options.batch, defaults)
+    if entries is None: return 1
+    if options.group is None and [x for x in entries if x['group'] is None]:
+        print 'No datacat group given for some files'
+        return 1
+    results = options.results or options.batch + '.results'
+    execute = options.execute == 'yes'
+
+    done = {}
+    if options.resume: done = readResults(results)
+    for entry in entries:
+        previous = done.get((entry['input'], entry['xrootd']), {})
+        entry['copied'] = False
+        entry['registered'] = previous.get('registered', False)
+        entry['error'] = None
+        if not os.access(entry['input'], os.R_OK):
+            entry['error'] = 'cannot access input'
+            continue
+        entry['size'] = os.stat(entry['input']).st_size
+        if previous.get('copied') and previous.get('size') == entry['size']:
+            # already verified by an earlier run; make sure it is still there
+            if execute:
+                entry['copied'] = fileOps.getSize(entry['xrootd']) == entry['size']
+            else:
+                entry['copied'] = True
+                pass
+            pass
+        if not entry['copied']: entry['registered'] = False
+        continue
+
+    print 'Batch of %d files: %d to copy, %d to register' % \
+          (len(entries), len([x for x in entries if not x['copied'] and not x['error']]),
+           len([x for x in entries if not x['registered'] and not x['error']]))
+    if execute: writeResults(results, entries)
+    copyBatch([x for x in entries if not x['error']], options.jobs, execute, results)
+    registerBatch(entries, options.jobs, execute, results)
+    if execute: writeResults(results, entries)
+
+    failed = [x for x in entries if x['error']]
+    for entry in failed:
+        print 'FAILED %s: %s' % (entry['input'], entry['error'])
+        continue
+    print '%d of %d files copied and registered' % \
+          (len([x for x in entries if x['registered']]), len(entries))
+    return int(len(failed) > 0)
+
 
 
 print "\n\n\n\n\n\t\t*****************************\n\t\t* Entering toXrootdCatalog.py *\n\t\t*****************************\n\n"
@@ -62,9 +266,20 @@ parser.add_option("-d","--datacatpath",action="store",type="string",dest="dataca
 parser.add_option("-e","--execute",action="store",type="string",dest="execute",                  default="no",help="really execute the commands if yes")
 parser.add_option("-m","--metadata",action="store",type="string",dest="metadata",                  default="null",help="apply metadata to the dataset")
 parser.add_option("-g","--group",action="store",type="string",dest="group",                  help="group in datacat")
+parser.add_option("-b","--batch",action="store",type="string",dest="batch",
+                  help="manifest of files to copy and register")
+parser.add_option("-r","--results",action="store",type="string",dest="results",
+                  help="batch results file (default <manifest>.results)")
+parser.add_option("-j","--jobs",action="store",type="int",dest="jobs",
+                  default=4,help="batch copies (and registrations) to run at once")
+parser.add_option("--resume",action="store_true",dest="resume",
+                  default=False,help="skip batch files already copied or registered")
 
 (options, args) = parser.parse_args()
 
+if options.batch:
+    sys.exit(runBatch(options))
+
 ##
 ## interpret the input args & set up some defaults
 ##
@@ -79,10 +294,6 @@ group = options.group
 
 executeThis = options.execute
 
-xrootRedirector = 'root://glast-rdr.slac.stanford.edu//glast/'
-xrdcpLoc = '/sdf/data/fermi/a/applications/xrootd/dist/v3.1.1/i386_rhel60/bin/xrdcp'
-
-
 ##
 ## Check existence of the input file
 
@@ -110,7 +321,6 @@ else:
 
 ## register the file in the catalogue
 
-datacatLoc = '/sdf/data/fermi/a/ground/bin/datacat'
 useMeta = ''
 if metaData != 'null': 
     useMeta = '-D s"' + metaData + '"'
@@ -0,0 +1,364 @@
+"""@brief Long-lived xrootd clients for xrootdFileOps.
+
+Each backend provides copy(fromFile, toFile), stat(fileName), remove(fileName)
+and rmtree(name), with the return conventions of xrootdFileOps:
+
+BindingsBackend  the XRootD python bindings, one FileSystem per redirector
+WorkerBackend    worker processes (this file, run with --serve) fed requests
+                 over pipes, for when the bindings are only installed for
+                 another python ($GPL_XROOTD_PYTHON); up to
+                 $GPL_XROOTD_WORKERS of them per redirector, so that
+                 concurrent transfers stay concurrent
+LocalBackend     a fake xrootd that maps root://host//path onto a local
+                 directory, so the staging code can be exercised offline
+                 (see test_xrootd.py)
+
+This file is also run by the worker's python, so it must stay importable by
+both python 2 and 3 and must not import the rest of GPLtools.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+xrootStart = "root:"
+
+## Set up message logging
+import logging
+log = logging.getLogger("gplLong")
+
+
+def haveBindings():
+    try:
+        import XRootD.client
+    except ImportError:
+        return False
+    return True
+
+
+def splitUrl(fileName):
+    """@brief Split root://host[:port]//path into ('root://host[:port]', '/path')."""
+    rest = fileName.split('://', 1)[1]
+    if '/' not in rest: return fileName, '/'
+    host, path = rest.split('/', 1)
+    return 'root://' + host, '/' + path.lstrip('/')
+
+
+def isRemote(fileName):
+    return fileName.startswith(xrootStart)
+
+
+class BindingsBackend(object):
+
+    """@brief xrootd operations through the XRootD python bindings."""
+
+    def __init__(self):
+        from XRootD import client
+        from XRootD.client import flags
+        self.client = client
+        self.flags = flags
+        self.filesystems = {}
+        self.lock = threading.Lock()
+        return
+
+    def _fs(self, fileName):
+        """@brief (FileSystem for the file's redirector, path on it)."""
+        url, path = splitUrl(fileName)
+        self.lock.acquire()
+        try:
+            if url not in self.filesystems:
+                log.debug('Connecting to %s' % url)
+                self.filesystems[url] = self.client.FileSystem(url)
+                pass
+            return self.filesystems[url], path
+        finally:
+            self.lock.release()
+
+    def _rc(self, status, what):
+        if status.ok: return 0
+        log.error('%s: %s' % (what, status.message))
+        return status.errno or 1
+
+    def copy(self, fromFile, toFile):
+        remote = toFile
+        if not isRemote(toFile): remote = fromFile
+        fs, path = self._fs(remote)
+        status, response = fs.copy(fromFile, toFile, force=True)
+        return self._rc(status, 'copy %s to %s' % (fromFile, toFile))
+
+    def stat(self, fileName):
+        fs, path = self._fs(fileName)
+        status, info = fs.stat(path)
+        if not status.ok: return None
+        return info.size
+
+    def remove(self, fileName):
+        fs, path = self._fs(fileName)
+        status, response = fs.rm(path)
+        return int(not status.ok)
+
+    def rmtree(self, name):
+        fs, path = self._fs(name)
+        return self._rmtree(fs, path)
+
+    def _rmtree(self, fs, path):
+        status, listing = fs.dirlist(path, self.flags.DirListFlags.STAT)
+        if not status.ok: return self._rc(status, 'list %s' % path)
+        rc = 0
+        for entry in listing:
+            child = path.rstrip('/') + '/' + entry.name
+            if entry.statinfo.flags & self.flags.StatInfoFlags.IS_DIR:
+                rc |= self._rmtree(fs, child)
+            else:
+                status, response = fs.rm(child)
+                rc |= self._rc(status, 'remove %s' % child)
+                pass
+            continue
+        status, response = fs.rmdir(path)
+        return rc | self._rc(status, 'rmdir %s' % path)
+
+    pass
+
+
+class LocalBackend(object):
+
+    """@brief A fake xrootd server: root://host//path is root/path.
+    Each operation takes at least delay seconds, like a round trip."""
+
+    def __init__(self, root, delay=0.0):
+        self.root = root
+        self.delay = delay
+        return
+
+    def _wait(self):
+        if self.delay: time.sleep(self.delay)
+        return
+
+    def local(self, fileName):
+        if not isRemote(fileName): return fileName
+        url, path = splitUrl(fileName)
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def copy(self, fromFile, toFile):
+        self._wait()
+        dest = self.local(toFile)
+        try:
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+                pass
+            shutil.copyfile(self.local(fromFile), dest)
+        except EnvironmentError:
+            e = sys.exc_info()[1]
+            log.error('copy %s to %s: %s' % (fromFile, toFile, e))
+            return 1
+        return 0
+
+    def stat(self, fileName):
+        self._wait()
+        try:
+            return os.stat(self.local(fileName)).st_size
+        except OSError:
+            return None
+
+    def remove(self, fileName):
+        self._wait()
+        try:
+            os.remove(self.local(fileName))
+        except OSError:
+            return 1
+        return 0
+
+    def rmtree(self, name):
+        self._wait()
+        try:
+            shutil.rmtree(self.local(name))
+        except EnvironmentError:
+            return 1
+        return 0
+
+    pass
+
+
+def serverBackend():
+    """@brief The backend a worker serves: the bindings, or the fake server
+    under $GPL_XROOTD_FAKE_ROOT (answering after $GPL_XROOTD_FAKE_DELAY seconds)."""
+    if haveBindings(): return BindingsBackend()
+    root = os.environ.get('GPL_XROOTD_FAKE_ROOT')
+    if root: return LocalBackend(root, float(os.environ.get('GPL_XROOTD_FAKE_DELAY', 0)))
+    raise ImportError('No XRootD python bindings for %s' % sys.executable)
+
+
+## Worker processes per redirector (see WorkerBackend).
+defaultWorkers = int(os.environ.get('GPL_XROOTD_WORKERS', 4))
+
+
+class _Worker(object):
+
+    """@brief One worker process, answering one request at a time."""
+
+    def __init__(self, python):
+        self.python = python
+        self.proc = None
+        return
+
+    def _start(self):
+        script = os.path.abspath(__file__)
+        if script.endswith('.pyc'): script = script[:-1]
+        log.info('Starting xrootd worker: %s %s --serve' % (self.python, script))
+        self.proc = subprocess.Popen([self.python, script, '--serve'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     universal_newlines=True)
+        return
+
+    def call(self, request):
+        """@brief Send a request line and return the reply line ('' if the
+        worker died twice)."""
+        reply = ''
+        for attempt in (0, 1):
+            if self.proc is None or self.proc.poll() is not None:
+                self._start()
+                pass
+            try:
+                self.proc.stdin.write(request)
+                self.proc.stdin.flush()
+                reply = self.proc.stdout.readline()
+            except EnvironmentError:
+                reply = ''
+                pass
+            if reply: break
+            log.warning('xrootd worker exited; restarting it')
+            self.close()
+            continue
+        return reply
+
+    def close(self):
+        if self.proc is None: return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except EnvironmentError:
+            pass
+        self.proc = None
+        return
+
+    pass
+
+
+class WorkerBackend(object):
+
+    """@brief Forward xrootd operations to worker processes.
+
+    Requests and replies are single lines of JSON on a worker's stdin and
+    stdout.  Each redirector has its own pool of up to maxWorkers workers,
+    started as they are needed and restarted if they die; a request waits
+    only if all of its redirector's workers are busy.
+    """
+
+    def __init__(self, python=None, maxWorkers=None):
+        if python is None: python = sys.executable
+        if maxWorkers is None: maxWorkers = defaultWorkers
+        self.python = python
+        self.maxWorkers = max(1, maxWorkers)
+        self.idle = {}                   # redirector -> idle workers
+        self.workers = {}                # redirector -> all its workers
+        self.cond = threading.Condition()
+        return
+
+    def _acquire(self, url):
+        self.cond.acquire()
+        try:
+            while True:
+                if self.idle.get(url):
+                    return self.idle[url].pop()
+                workers = self.workers.setdefault(url, [])
+                if len(workers) < self.maxWorkers:
+                    worker = _Worker(self.python)
+                    workers.append(worker)
+                    return worker
+                self.cond.wait()
+                continue
+        finally:
+            self.cond.release()
+
+    def _release(self, url, worker):
+        self.cond.acquire()
+        try:
+            self.idle.setdefault(url, []).append(worker)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return
+
+    def _call(self, op, *args):
+        remote = [x for x in args if isRemote(x)]
+        url = remote and splitUrl(remote[0])[0] or ''
+        request = json.dumps({'op': op, 'args': args}) + '\n'
+        worker = self._acquire(url)
+        try:
+            reply = worker.call(request)
+        finally:
+            self._release(url, worker)
+        if not reply: raise IOError('xrootd worker failed on %s' % op)
+        reply = json.loads(reply)
+        if 'error' in reply: raise IOError(reply['error'])
+        return reply['result']
+
+    def copy(self, fromFile, toFile):
+        return self._call('copy', fromFile, toFile)
+
+    def stat(self, fileName):
+        return self._call('stat', fileName)
+
+    def remove(self, fileName):
+        return self._call('remove', fileName)
+
+    def rmtree(self, name):
+        return self._call('rmtree', name)
+
+    def close(self):
+        """@brief Stop all the workers (call when none is in use)."""
+        self.cond.acquire()
+        try:
+            for workers in self.workers.values():
+                for worker in workers: worker.close()
+                continue
+            self.idle = {}
+            self.workers = {}
+        finally:
+            self.cond.release()
+        return
+
+    pass
+
+
+def serve(backend, inp, out):
+    """@brief Answer requests (see WorkerBackend) until inp is closed."""
+    while True:
+        line = inp.readline()
+        if not line: break
+        try:
+            request = json.loads(line)
+            op = request['op']
+            if op not in ('copy', 'stat', 'remove', 'rmtree'):
+                raise ValueError('Unknown operation %s' % op)
+            reply = {'result': getattr(backend, op)(*request['args'])}
+        except Exception:
+            reply = {'error': str(sys.exc_info()[1])}
+            pass
+        out.write(json.dumps(reply) + '\n')
+        out.flush()
+        continue
+    return
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['--serve']:
+        serve(serverBackend(), sys.stdin, sys.stdout)
+        sys.exit(0)
+    sys.stderr.write('usage: %s --serve\n' % sys.argv[0])
+    sys.exit(2)
@@ -1,9 +1,21 @@
 """Low-level file operations when at least on file is on xrootd.
+
+The operations are carried out by a backend (see xrootdClient), chosen by
+$GPL_XROOTD_BACKEND:
+  auto     - bindings if the XRootD python bindings are installed, else
+             worker if $GPL_XROOTD_PYTHON names a python that has them,
+             else command (the default)
+  bindings - XRootD python bindings in this process
+  worker   - a long-lived worker process running $GPL_XROOTD_PYTHON
+  command  - one xrdcp or xrd.pl process per operation
+  fake     - local directory $GPL_XROOTD_FAKE_ROOT standing in for xrootd
 """
 
 import os
+import threading
 
 import runner
+import xrootdClient
 
 xrootStart = "root:"
 xrootdLocation = os.getenv("GPL_XROOTD_DIR","/sdf/data/fermi/a/applications/xrootd/dist/v3.1.1/i386_rhel60/bin")
@@ -12,45 +24,112 @@ xrdstat  = xrootdLocation+"/xrd.pl -w stat "
 xrdrm    = xrootdLocation+"/xrd.pl rm "
 xrd      = xrootdLocation+"/xrd.pl"
 
+backendName = os.getenv("GPL_XROOTD_BACKEND", "auto")
+
 ## Set up message logging
 import logging
 log = logging.getLogger("gplLong")
 
 
-def copy(fromFile, toFile):
+class CommandBackend(object):
+
+    """@brief One xrootd client command per operation."""
+
+    def copy(self, fromFile, toFile):
+        xrdcmd=xrdcp+" -np -f "+fromFile+" "+toFile   #first time try standard copy
+        log.info("Executing...\n"+xrdcmd)
+        rc = runner.run(xrdcmd)
+        log.debug("xrdcp return code = "+str(rc))
+        return rc
+
+    def stat(self, fileName):
+        xrdcmd = xrdstat + fileName
+        pipe = os.popen(xrdcmd)
+        lines = pipe.read()
+        rc = pipe.close()
+        if rc: return None
+        log.debug(lines)
+        size = int(lines.split()[1])
+        return size
+
+    def remove(self, fileName):
+        xrdcmd = '%s rm %s' % (xrd, fileName)
+        rc = runner.run(xrdcmd)  ## failure is Okay => file does not already exist
+        return rc
+
+    def rmtree(self, name):
+        xrdcmd = '%s rmtree %s' % (xrd, name)
+        rc = runner.run(xrdcmd)
+        return rc
+
+    pass
+
+
+_backend = None
+_backendLock = threading.Lock()
+
+
+def makeBackend(name):
+    if name == 'auto':
+        if xrootdClient.haveBindings():
+            name = 'bindings'
+        elif os.getenv("GPL_XROOTD_PYTHON"):
+            name = 'worker'
+        else:
+            name = 'command'
+            pass
+        pass
+    log.info("Using xrootd backend: " + name)
+    if name == 'bindings': return xrootdClient.BindingsBackend()
+    if name == 'worker': return xrootdClient.WorkerBackend(os.getenv("GPL_XROOTD_PYTHON"))
+    if name == 'fake': return xrootdClient.LocalBackend(os.environ["GPL_XROOTD_FAKE_ROOT"])
+    if name == 'command': return CommandBackend()
+    raise ValueError, "Unknown xrootd backend %s" % name
+
+
+def backend():
+    """@brief The backend in use, created on first use."""
+    global _backend
+    _backendLock.acquire()
+    try:
+        if _backend is None: _backend = makeBackend(backendName)
+        return _backend
+    finally:
+        _backendLock.release()
+
+
+def setBackend(newBackend):
+    """@brief Use newBackend (an object, or a name for makeBackend) from now on."""
+    global _backend
+    if isinstance(newBackend, str): newBackend = makeBackend(newBackend)
+    _backendLock.acquire()
+    _backend = newBackend
+    _backendLock.release()
+    return
+
+
+def copy(fromFile, toFile, digests=None, engine=None, resume=False):
     """
     @brief copy a staged file to final xrootd repository.
     @param fromFile = name of staged file, toFile = name of final file
+    @param digests = ignored; the xrootd client does the reading, so no digests are recorded
+    @param engine = ignored
+    @param resume = ignored
     @return success code
 
     This just copies the file.
     """
-
-    xrdcmd=xrdcp+" -np -f "+fromFile+" "+toFile   #first time try standard copy
-    log.info("Executing...\n"+xrdcmd)
-    rc = runner.run(xrdcmd)
-    log.debug("xrdcp return code = "+str(rc))
-    
-    return rc
+    return backend().copy(fromFile, toFile)
 
 
 def exists(fileName):
-    xrdcmd = xrdstat + fileName
-    xrdrc = runner.run(xrdcmd)
-    log.debug("xrdstat return code = " + str(xrdrc))
-    rc = not xrdrc
+    rc = backend().stat(fileName) is not None
+    log.debug("xrootd stat of %s: %s" % (fileName, rc))
     return rc
 
 
 def getSize(fileName):
-    xrdcmd = xrdstat + fileName
-    pipe = os.popen(xrdcmd)
-    lines = pipe.read()
-    rc = pipe.close()
-    if rc: return None
-    log.debug(lines)
-    size = int(lines.split()[1])
-    return size
+    return backend().stat(fileName)
 
 
 def makedirs(name, mode):
@@ -62,9 +141,7 @@ def mkdirFor(fileName, mode):
 
 
 def remove(fileName):
-    xrdcmd = '%s rm %s' % (xrd, fileName)
-    rc = runner.run(xrdcmd)  ## failure is Okay => file does not already exist
-    return rc
+    return backend().remove(fileName)  ## failure is Okay => file does not already exist
 
 
 def rmdir(name):
@@ -72,9 +149,7 @@ def rmdir(name):
 
 
 def rmtree(name):
-    xrdcmd = '%s rmtree %s' % (xrd, name)
-    rc = runner.run(xrdcmd)
-    return rc
+    return backend().rmtree(name)
 
 
 def tempName(fileName):
@@ -28,7 +28,7 @@ import quarks.legal.copyright
 #  @brief Record information about a downlink in a database.
 #
 
-import datetime, errno, glob, logging, operator, os, subprocess, sys
+import bisect, datetime, errno, glob, logging, operator, os, sys, threading, time, Queue
 
 _log = logging.getLogger()
 
@@ -36,6 +36,30 @@ from py_MOOT import MootUpdate, vectorOfUnsigned
 
 from ISOC.ProductUtils import ProductSpan
 
+try:
+    import BinaryIndex
+except ImportError:
+    BinaryIndex = None
+
+import IndexReader
+
+## number of threads reading chunk indices in Downlink.addseg
+IDX_READERS = 4
+
+## acquisitions per MOOT cross-load group, and number of groups loaded at once
+## (more than one thread is untested: nothing shows that py_MOOT, the MySQL
+## client library under it, or the SqlAlchemy-mapped acquisitions may be
+## used from several threads at once)
+MOOT_GROUP = 16
+MOOT_THREADS = 1
+
+## retries of a failed MOOT call, and the delay (seconds) before the first
+MOOT_RETRIES = 2
+MOOT_BACKOFF = 5.0
+
+## total seconds a cross-load may spend waiting to retry failed MOOT calls
+MOOT_RETRY_BUDGET = 30.0
+
 class DoesNotBelong( RuntimeError ):
     """!Raised when an event from a different acquisition is added to a datagram"""
 
@@ -105,10 +129,17 @@ class Downlink( object ):
         session.flush()
 
     def addseg( self, idxlist, session = None ):
+        # read the datagram records of any index files without a current
+        # binary sidecar up front, a few files at a time
+        textidx = idxlist
+        if BinaryIndex:
+            textidx = [ x for x in idxlist if not BinaryIndex.isCurrent( x ) ]
+        dgmstrs = IndexReader.readMany( textidx, 'DGM', workers=IDX_READERS )
+
         # load datagram segments from the index files
         for idx in idxlist:
             try:
-                seg = DatagramSegment( idx, session )
+                seg = DatagramSegment( idx, session, dgmstrs.get( idx ) )
             except NoDatagramsFound, e:
                 _log.exception( 'Acquisition::addseg: %s' %  str(e) )
                 continue
@@ -148,13 +179,114 @@ class Downlink( object ):
         @param[in] prefix the table prefix for the LPA-defaults table
         @param[in] ofd output file handle for textual summary
         """
-        for a in self.acquisitions: a.map_moot( db, prefix, ofd )
-
-    def update_moot( self, mupd ):
+        acqs = [ a.acquisition for a in self.acquisitions ]
+        if not acqs: return
+
+        # get every default setting that could apply to an LPA acquisition
+        # in this downlink: the last one before the earliest acquisition and
+        # all those after it
+        defaults = []
+        lpatimes = [ a.dgmutc0 for a in acqs if a.type == 'LPA' ]
+        if lpatimes:
+            dtbl = SchemaCache.table( db, '%s_acqdefaults' % prefix )
+            tfirst = SA.select( [ SA.func.max( dtbl.c.tcompleted ) ], dtbl.c.tcompleted < min( lpatimes ) ).execute().scalar()
+            dsel = dtbl.select( SA.and_( dtbl.c.tcompleted < max( lpatimes ),
+                                         dtbl.c.tcompleted >= ( tfirst or min( lpatimes ) ) ),
+                                order_by=[ dtbl.c.tcompleted, ] )
+            defaults = dsel.execute().fetchall()
+        dtimes = [ x.tcompleted for x in defaults ]
+
+        # get every acquisition-specific setting requested by these acquisitions' ground IDs
+        atbl = SchemaCache.table( db, '%s_acquisition' % prefix )
+        asel = atbl.select( SA.and_( atbl.c.trequested < max( a.dgmutc0 for a in acqs ),
+                                     atbl.c.id.in_( *set( a.groundId for a in acqs ) ),
+                                     atbl.c.startedat == None,
+                                     SA.or_( atbl.c.type == 'LPA', atbl.c.type == 'LCI' ),
+                                     ),
+                            order_by=[ atbl.c.trequested, ] )
+        specifics = {}
+        for row in asel.execute():
+            specifics.setdefault( row.id, [] ).append( row )
+        _log.info( 'Downlink::map_moot: found %d default and %d acquisition-specific settings for %d acquisitions' % \
+                   ( len( defaults ), sum( len( x ) for x in specifics.values() ), len( acqs ) ) )
+
+        # pick the latest of each that precedes each acquisition
+        for a in acqs:
+            default = None
+            if a.type == 'LPA':
+                i = bisect.bisect_left( dtimes, a.dgmutc0 )
+                if i > 0: default = defaults[i-1]
+            rows = specifics.get( a.groundId, [] )
+            i = bisect.bisect_left( [ x.trequested for x in rows ], a.dgmutc0 )
+            a.set_moot( default, rows[i-1] if i > 0 else None, ofd )
+
+    def update_moot( self, loader ):
         """!@brief update MOOT acquisition-summary table
-        @param[in] mupd A MootUpdate instance
+        @param[in] loader A MootLoader instance
         """
-        for a in self.acquisitions: a.acquisition.update_moot( mupd )
+        loader.load( [ a.acquisition for a in self.acquisitions ] )
+
+def summarize( startedat, segments ):
+    """!@brief acquisition-summary column values for the segments of an acquisition
+    @param[in] startedat Acquisition start time.
+    @param[in] segments DatagramSegment (or SegmentSummary) objects for the acquisition.
+    @return Dictionary of _acqsummary column values.
+    """
+    summ = {}
+    # we may not have any information
+    if len( segments ) == 0:
+        summ[ 'type' ] = 'LPA'
+        rst = datetime.datetime(2001,1,1) + datetime.timedelta( seconds = startedat )
+        summ[ 'dgmutc0' ] = rst
+        summ[ 'dgmutc1' ] = rst
+        summ[ 'evtutc0' ] = rst
+        summ[ 'evtutc1' ] = rst
+        summ[ 'ndgms' ]   = 0
+        summ[ 'nevts' ]   = 0
+        summ[ 'hwkey' ]   = 0xFFFFFFFF
+        summ[ 'swkey' ]   = 0xFFFFFFFF
+        summ[ 'status' ]  = 'InProgress'
+        return summ
+
+    # capture summary information
+    if segments[0].apid == 965:
+        summ[ 'type' ] = 'LCI'
+    else:
+        summ[ 'type' ] = 'LPA'
+    summ[ 'dgmutc0' ] = min( x.dgmutc0 for x in segments )
+    summ[ 'dgmutc1' ] = max( x.dgmutc1 for x in segments )
+    summ[ 'evtutc0' ] = min( x.evtutc0 for x in segments )
+    summ[ 'evtutc1' ] = max( x.evtutc1 for x in segments )
+    summ[ 'ndgms' ]   = sum( x.ndgms for x in segments )
+    summ[ 'nevts' ]   = sum( x.nevts for x in segments )
+    summ[ 'hwkey' ]   = segments[0].hwkey
+    summ[ 'swkey' ]   = segments[0].swkey
+
+    # partition segments by apid
+    apids = list( set( [ x.apid for x in segments ] ) )
+    summ[ 'status' ] = 'InProgress'
+    bcomplete = True
+    for apid in apids:
+        segs = [ x for x in segments if x.apid == apid ]
+        segs.sort( key = operator.attrgetter( 'dgmseq0' ) )
+        bstart = segs[0].oaction == 'start'
+        bstop  = segs[-1].caction in ('stop', 'abort', 'pause')
+        bcnt   = sum( [x.ndgms for x in segs ] ) == ( segs[-1].dgmseq1 - segs[0].dgmseq0 + 1 )
+        bcomplete = bcomplete and ( bstart and bstop and bcnt )
+    if bcomplete:
+        summ[ 'status' ] = 'Complete'
+    return summ
+
+class SegmentSummary( object ):
+    """!@brief the parts of a stored datagram segment needed by summarize()"""
+    def __init__( self, row ):
+        for name in ( 'apid', 'nevts', 'dgmseq0', 'dgmseq1', 'oaction', 'caction',
+                      'dgmutc0', 'dgmutc1', 'evtutc0', 'evtutc1', 'hwkey', 'swkey' ):
+            setattr( self, name, row[ name ] )
+
+    @property
+    def ndgms( self ):
+        return self.dgmseq1 - self.dgmseq0 + 1
 
 class Acquisition( object ):
     """Collection of datagram-segments."""
@@ -168,48 +300,9 @@ class Acquisition( object ):
         self.moot_alias = 'UNKNOWN'
 
     def update( self ):
-        # we may not have any information
-        if len( self.segments ) == 0:
-            self.type = 'LPA'
-            rst = datetime.datetime(2001,1,1) + datetime.timedelta( seconds = self.startedat )
-            self.dgmutc0 = rst
-            self.dgmutc1 = rst
-            self.evtutc0 = rst
-            self.evtutc1 = rst
-            self.ndgms   = 0
-            self.nevts   = 0
-            self.hwkey   = 0xFFFFFFFF
-            self.swkey   = 0xFFFFFFFF
-            self.status  = 'InProgress'
-            return
-        
-        # capture summary information
-        if self.segments[0].apid == 965:
-            self.type = 'LCI'
-        else:
-            self.type = 'LPA'
-        self.dgmutc0 = min( x.dgmutc0 for x in self.segments )
-        self.dgmutc1 = max( x.dgmutc1 for x in self.segments )
-        self.evtutc0 = min( x.evtutc0 for x in self.segments )
-        self.evtutc1 = max( x.evtutc1 for x in self.segments )
-        self.ndgms   = sum( x.ndgms for x in self.segments )
-        self.nevts   = sum( x.nevts for x in self.segments )
-        self.hwkey   = self.segments[0].hwkey
-        self.swkey   = self.segments[0].swkey
-
-        # partition segments by apid
-        apids = list( set( [ x.apid for x in self.segments ] ) )
-        self.status = 'InProgress'
-        bcomplete = True
-        for apid in apids:
-            segs = [ x for x in self.segments if x.apid == apid ]
-            segs.sort( key = operator.attrgetter( 'dgmseq0' ) )
-            bstart = segs[0].oaction == 'start'
-            bstop  = segs[-1].caction in ('stop', 'abort', 'pause')
-            bcnt   = sum( [x.ndgms for x in segs ] ) == ( segs[-1].dgmseq1 - segs[0].dgmseq0 + 1 )
-            bcomplete = bcomplete and ( bstart and bstop and bcnt )
-        if bcomplete:
-            self.status = 'Complete'
+        """!@brief recompute the summary information from the segments"""
+        for name, value in summarize( self.startedat, self.segments ).iteritems():
+            setattr( self, name, value )
 
     @property
     def startedAt( self ):
@@ -229,27 +322,38 @@ class Acquisition( object ):
         @param[in] prefix the table prefix for the LPA-defaults table
         @param[in] ofd output file handle for textual summary
         """
-        moot_source = 'missing'
         # if LPA, get the applicable default setting
+        default = None
         if self.type == 'LPA':
-            dtbl = SA.Table( '%s_acqdefaults' % prefix, db.metadata, autoload=True )
+            dtbl = SchemaCache.table( db, '%s_acqdefaults' % prefix )
             dsel = dtbl.select( dtbl.c.tcompleted < self.dgmutc0,
                               order_by=[ SA.desc( dtbl.c.tcompleted ), ] )
-            row = dsel.execute().fetchone()
-            if row:
-                self.moot_key   = row.moot_key
-                self.moot_alias = row.moot_alias
-                moot_source = 'default'
+            default = dsel.execute().fetchone()
 
         # get the acquisition-specific setting if available
-        atbl = SA.Table( '%s_acquisition' % prefix, db.metadata, autoload=True )
+        atbl = SchemaCache.table( db, '%s_acquisition' % prefix )
         asel = atbl.select( SA.and_( atbl.c.trequested < self.dgmutc0,
                                      atbl.c.id        == self.groundId,
                                      atbl.c.startedat == None,
                                      SA.or_( atbl.c.type == 'LPA', atbl.c.type == 'LCI' ),
                                      ),
                             order_by=[SA.desc( atbl.c.trequested ), ] )
-        row = asel.execute().fetchone()
+        self.set_moot( default, asel.execute().fetchone(), ofd )
+
+    def set_moot( self, default, specific, ofd ):
+        """!@brief apply the MOOT key/alias from the defaults and acquisition tables
+        @param[in] default The applicable _acqdefaults row, or None
+        @param[in] specific The applicable _acquisition row, or None
+        @param[in] ofd output file handle for textual summary
+        """
+        moot_source = 'missing'
+        if default:
+            self.moot_key   = default.moot_key
+            self.moot_alias = default.moot_alias
+            moot_source = 'default'
+
+        # the acquisition-specific setting takes precedence
+        row = specific
         if row:
             self.moot_key   = row.moot_key   if row.moot_key   else self.moot_key
             self.moot_alias = row.moot_alias if row.moot_alias else self.moot_alias
@@ -260,31 +364,35 @@ class Acquisition( object ):
                    ( self.startedat, moot_source, self.moot_alias, self.moot_key ) )
         print >>ofd, 'r%010d %d %s' % ( self.startedat, self.moot_key, self.moot_alias )
 
-    def update_moot( self, mupd ):
+    def update_moot( self, mupd, call = None ):
         """!@brief update MOOT acquisition-summary table
         @param[in] mupd A MootUpdate instance:
+        @param[in] call Function( name, method, *args ) through which to make the MOOT calls (see MootLoader.call).
         """
+        if call is None:
+            call = lambda name, method, *args: method( *args )
         dt0 = self.evtutc0 - datetime.datetime( 1970, 1, 1 )
         dt1 = self.evtutc1 - datetime.datetime( 1970, 1, 1 )
         try:
-            mupd.updateAcqSummary( self.startedat,
-                                   self.scid,
-                                   self.moot_key,
-                                   self.type,
-                                   '',
-                                   float(dt0.days*86400) + float(dt0.seconds) + float(dt0.microseconds)/1000000.0,
-                                   float(dt1.days*86400) + float(dt1.seconds) + float(dt1.microseconds)/1000000.0,
-                                   self.nevts,
-                                   self.hwkey,
-                                   self.swkey,
-                                   '',
-                                   vectorOfUnsigned() )
+            call( 'updateAcqSummary', mupd.updateAcqSummary,
+                  self.startedat,
+                  self.scid,
+                  self.moot_key,
+                  self.type,
+                  '',
+                  float(dt0.days*86400) + float(dt0.seconds) + float(dt0.microseconds)/1000000.0,
+                  float(dt1.days*86400) + float(dt1.seconds) + float(dt1.microseconds)/1000000.0,
+                  self.nevts,
+                  self.hwkey,
+                  self.swkey,
+                  '',
+                  vectorOfUnsigned() )
             _log.info( 'Acquisition::update_moot: updated MOOT acq-summary table for r%010d' % self.startedat )
         except Exception, e:
             _log.error( 'Acquisition::update_moot: %s %s' % ( type(e), str(e) ) )
         try:
             if self.status != 'InProgress':
-                mupd.markAcqComplete( self.startedat, self.scid )
+                call( 'markAcqComplete', mupd.markAcqComplete, self.startedat, self.scid )
                 _log.info( 'Acquisition::update_moot: marked r%010d with status %s as Complete in MOOT' % ( self.startedat, self.status ) )
         except Exception, e:
             _log.error( 'Acquisition::update_moot: %s %s' % ( type(e), str(e) ) )
@@ -332,18 +440,186 @@ class Acquisition( object ):
                 iseg += 1
 
                 
+class MootLoader( object ):
+    """!Cross-load acquisition summaries to MOOT in groups, with retries and call timing.
+
+    The acquisitions are split into groups of at most `group`, and up to
+    `threads` groups are loaded at once, each through its own MootUpdate
+    instance (see MOOT_THREADS before using more than one).  Each MOOT call is
+    retried up to `retries` times with an exponentially-increasing delay,
+    as long as the delays of the whole load stay within `budget` seconds,
+    so an unreachable MOOT costs at most that much waiting.  The duration
+    of every attempt is accumulated in a latency histogram for the
+    pipeline summary.
+    """
+    ## upper edges (seconds) of the latency-histogram bins
+    BINS = ( 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0 )
+
+    def __init__( self, factory, group = MOOT_GROUP, threads = MOOT_THREADS,
+                  retries = MOOT_RETRIES, backoff = MOOT_BACKOFF, budget = MOOT_RETRY_BUDGET ):
+        """!@param[in] factory Callable returning a new MootUpdate instance.
+        @param[in] group Maximum number of acquisitions per group.
+        @param[in] threads Maximum number of groups loaded at once.
+        @param[in] retries Number of times a failed call is retried.
+        @param[in] backoff Delay (seconds) before the first retry, doubled for each subsequent one.
+        @param[in] budget Total delay (seconds) allowed for the retries of all calls.
+        """
+        self.factory = factory
+        self.group   = max( 1, group )
+        self.threads = max( 1, threads )
+        self.retries = retries
+        self.backoff = backoff
+        self.budget  = budget
+        self.waited  = 0.0
+        self.hist     = [ 0 ] * ( len( self.BINS ) + 1 )
+        self.ncalls   = 0
+        self.nerrors = 0
+        self.nfailed  = 0
+        self.elapsed  = 0.0
+        self.__lock = threading.Lock()
+
+    def __record( self, dt, ok ):
+        self.__lock.acquire()
+        try:
+            self.hist[ bisect.bisect_left( self.BINS, dt ) ] += 1
+            self.ncalls += 1
+            self.elapsed += dt
+            if not ok: self.nerrors += 1
+        finally:
+            self.__lock.release()
+
+    def __reserve( self, delay ):
+        # Take a retry delay out of the budget, shortened to what is left
+        # of it; None once the budget is spent.
+        self.__lock.acquire()
+        try:
+            delay = min( delay, self.budget - self.waited )
+            if delay <= 0:
+                return None
+            self.waited += delay
+            return delay
+        finally:
+            self.__lock.release()
+
+    def call( self, name, method, *args ):
+        """!@brief make a MOOT call, retrying it if it raises an exception"""
+        attempt = 0
+        while True:
+            t0 = time.time()
+            try:
+                result = method( *args )
+            except Exception, e:
+                self.__record( time.time() - t0, False )
+                delay = self.__reserve( self.backoff * ( 2 ** attempt ) )
+                if attempt >= self.retries or delay is None:
+                    self.__lock.acquire()
+                    self.nfailed += 1
+                    self.__lock.release()
+                    raise
+                _log.warning( 'MootLoader::call: %s failed (%s %s), retrying in %.1f s' % ( name, type(e), str(e), delay ) )
+                time.sleep( delay )
+                attempt += 1
+                continue
+            self.__record( time.time() - t0, True )
+            return result
+
+    def __loadGroup( self, acqs ):
+        try:
+            mupd = self.factory()
+        except Exception, e:
+            _log.error( 'MootLoader::load: cannot connect to MOOT: %s %s' % ( type(e), str(e) ) )
+            self.__lock.acquire()
+            self.nfailed += len( acqs )
+            self.__lock.release()
+            return
+        for a in acqs:
+            a.update_moot( mupd, self.call )
+
+    def load( self, acqs ):
+        """!@brief cross-load a list of acquisitions"""
+        groups = [ acqs[i:i+self.group] for i in xrange( 0, len( acqs ), self.group ) ]
+        _log.info( 'MootLoader::load: loading %d acquisitions in %d groups with %d threads' % \
+                   ( len( acqs ), len( groups ), min( self.threads, len( groups ) ) ) )
+        if self.threads == 1 or len( groups ) <= 1:
+            # a single MootUpdate instance, as before
+            self.__loadGroup( acqs )
+            return
+        todo = Queue.Queue()
+        for g in groups:
+            todo.put( g )
+        def worker():
+            while True:
+                try:
+                    g = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                self.__loadGroup( g )
+        workers = [ threading.Thread( target=worker ) for i in xrange( min( self.threads, len( groups ) ) ) ]
+        for t in workers: t.start()
+        for t in workers: t.join()
+
+    def histogram( self ):
+        """!@brief the latency histogram as text, e.g. '<=0.01:3 <=0.03:12 ... >30:0'"""
+        labels = [ '<=%g' % x for x in self.BINS ] + [ '>%g' % self.BINS[-1] ]
+        return ' '.join( '%s:%d' % x for x in zip( labels, self.hist ) )
+
+    def report( self ):
+        """!@brief log the call statistics and add them to the pipeline summary, if there is one"""
+        _log.info( 'MootLoader::report: %d calls (%d errors, %d failed) in %.3f s (%.1f s waiting to retry), latency %s' % \
+                   ( self.ncalls, self.nerrors, self.nfailed, self.elapsed, self.waited, self.histogram() ) )
+        summary = os.environ.get( 'PIPELINE_SUMMARY' )
+        if not summary:
+            return
+        try:
+            ofd = open( summary, 'a' )
+            print >> ofd, 'Pipeline.mootCalls: %d' % self.ncalls
+            print >> ofd, 'Pipeline.mootErrors: %d' % self.nerrors
+            print >> ofd, 'Pipeline.mootFailures: %d' % self.nfailed
+            print >> ofd, 'Pipeline.mootSeconds: %.3f' % self.elapsed
+            print >> ofd, 'Pipeline.mootRetryWait: %.1f' % self.waited
+            print >> ofd, 'Pipeline.mootLatency: %s' % self.histogram()
+            ofd.close()
+        except EnvironmentError, e:
+            _log.warning( 'MootLoader::report: cannot write %s: %s' % ( summary, e ) )
+
 class DatagramSegment( object ):
     """A contiguous series of decoded datagrams."""
-    def __init__( self, idx, session = None ):
-        # get the list of datagrams from the index file and capture the first and last
-        ifd = subprocess.Popen( 'grep ^DGM %s' % idx, shell=True, stdout=subprocess.PIPE ).stdout
-        datagrams = [ DgmIdx( dgmstr ) for dgmstr in ifd ]
-        if len( datagrams ) == 0:
-            raise NoDatagramsFound( 'No datagrams found in idx file %s' % idx )
-        _log.info( 'DatagramSegment::__init__: found %d datagrams in %s' % ( len(datagrams), idx ) )
-        self.dgm0 = datagrams[0]
-        self.dgm1 = datagrams[-1]
-        self.nevts  = sum( [ x.nevts for x in datagrams ] )
+    def __init__( self, idx, session = None, dgmstrs = None ):
+        """!@param[in] idx Chunk index filename.
+        @param[in] session A SqlAlchemy unit-of-work session.
+        @param[in] dgmstrs The DGM records of idx, if they have already been read.
+        """
+        # use the binary sidecar if there is a current one, since only the
+        # first and last datagrams and the event count are needed
+        bidx = None
+        if BinaryIndex and dgmstrs is None:
+            bidx = BinaryIndex.load( idx )
+        if bidx is not None:
+            ndgms = len( bidx.dgm )
+            if ndgms == 0:
+                raise NoDatagramsFound( 'No datagrams found in idx file %s' % idx )
+            self.dgm0 = bidx.dgmidx( 0, DgmRecord )
+            if ndgms == 1:
+                self.dgm1 = self.dgm0
+            else:
+                self.dgm1 = bidx.dgmidx( ndgms-1, DgmRecord )
+            self.nevts = int( bidx.dgm['nevts'].sum() )
+        else:
+            # get the list of datagrams from the index file and capture the first and last
+            if dgmstrs is None:
+                dgmstrs = IndexReader.readMany( [ idx ], 'DGM' )[ idx ]
+            if isinstance( dgmstrs, EnvironmentError ):
+                raise NoDatagramsFound( 'Cannot read idx file %s: %s' % ( idx, dgmstrs ) )
+            ndgms = len( dgmstrs )
+            if ndgms == 0:
+                raise NoDatagramsFound( 'No datagrams found in idx file %s' % idx )
+            self.dgm0 = DgmRecord( dgmstrs[0] )
+            if ndgms == 1:
+                self.dgm1 = self.dgm0
+            else:
+                self.dgm1 = DgmRecord( dgmstrs[-1] )
+            self.nevts  = sum( [ DgmIdx( x ).nevts for x in dgmstrs ] )
+        _log.info( 'DatagramSegment::__init__: found %d datagrams in %s' % ( ndgms, idx ) )
         self.scid = self.dgm0.scid
         self.startedat = self.dgm0.startedat
         self.apid = self.dgm0.apid
@@ -429,13 +705,42 @@ class DatagramSegment( object ):
         return self.dgm1.evtutc1
 
 
+def _stamp_property( name ):
+    """!@brief property for a timestamp kept as text in <name>_stamp and converted on first access"""
+    cache = '_' + name
+    stamp = name + '_stamp'
+    def fget( self ):
+        try:
+            return getattr( self, cache )
+        except AttributeError:
+            value = datetime.datetime.utcfromtimestamp( float( getattr( self, stamp ) ) )
+            setattr( self, cache, value )
+            return value
+    def fset( self, value ):
+        setattr( self, cache, value )
+    return property( fget, fset )
+
 class DgmIdx( object ):
-    """!object to represent a decoded datagram"""
+    """!object to represent a decoded datagram
+
+    Built from a DGM index line, or from a dictionary of attribute values
+    (see BinaryIndex.dgmvalues).  The timestamps are kept in their original
+    text form and only converted to datetimes when utc, evtutc0 or evtutc1
+    is first used.
+    """
+    __slots__ = ( 'startedat', 'scid', 'apid', 'datagrams', 'groundid', 'modechanges', 'modename',
+                  'oaction', 'oreason', 'caction', 'creason', 'platform', 'origin', 'crate',
+                  'evtseq0', 'evtseq1', 'nevts', 'hwkey', 'swkey',
+                  'utc_stamp', 'evtutc0_stamp', 'evtutc1_stamp', '_utc', '_evtutc0', '_evtutc1' )
     def __init__( self, instr ):
+        if isinstance( instr, dict ):
+            for name, value in instr.iteritems():
+                setattr( self, name, value )
+            return
         fields = instr.split()
         if fields[0].startswith( 'DGM' ):
             self.startedat   = int(   fields[ 1] )
-            self.utc         = datetime.datetime.utcfromtimestamp( float( fields[ 2] ) )
+            self.utc_stamp   =        fields[ 2]
             self.scid        = int(   fields[ 3] )
             self.apid        = int(   fields[ 4] )
             self.datagrams   = int(   fields[ 5] )
@@ -449,14 +754,18 @@ class DgmIdx( object ):
             self.platform    =        fields[13]
             self.origin      =        fields[14]
             self.crate       =        fields[15]
-            self.evtutc0     = datetime.datetime.utcfromtimestamp( float( fields[16] ) )
+            self.evtutc0_stamp =      fields[16]
             self.evtseq0     = long(  fields[17] )
-            self.evtutc1     = datetime.datetime.utcfromtimestamp( float( fields[18] ) )
+            self.evtutc1_stamp =      fields[18]
             self.evtseq1     = long(  fields[19] )
             self.nevts       = int(   fields[20] )
             if len(fields) > 21: self.hwkey       = long(  fields[21] )
             if len(fields) > 22: self.swkey       = long(  fields[22] )
 
+    utc     = _stamp_property( 'utc' )
+    evtutc0 = _stamp_property( 'evtutc0' )
+    evtutc1 = _stamp_property( 'evtutc1' )
+
     def __eq__( self, rhs ):
         if not rhs: return False
         return self.scid == rhs.scid and \
@@ -468,6 +777,18 @@ class DgmIdx( object ):
     def key( self ):
         return ( self.startedAt, self.evtseq0 )
 
+class DgmRecord( DgmIdx ):
+    """!decoded datagram stored in the _downlink_dgm table
+
+    SqlAlchemy keeps its state in the instance __dict__, which the slotted
+    DgmIdx does not have, so this subclass is the one that gets mapped.  Its
+    timestamps are converted up front since they are all written to the table.
+    """
+    def __init__( self, instr ):
+        DgmIdx.__init__( self, instr )
+        for name in ( 'utc', 'evtutc0', 'evtutc1' ):
+            setattr( self, name, datetime.datetime.utcfromtimestamp( float( getattr( self, name + '_stamp' ) ) ) )
+
 class EvtIdx( object ):
     __slots__ = 'startedAt', 'sequence', 'apid', 'datagrams', 'oaction', 'caction', 'fileofst', 'evtfile'
     def __init__( self, evtfile, evtstr ):
@@ -534,6 +855,8 @@ if __name__ == '__main__':
     import getpass
     import sqlalchemy as SA
 
+    import SchemaCache
+
     from quarks.cmdline.xoptparse import OptionParser
     from quarks.database.dbconfig import DbConfig
 
@@ -589,6 +912,15 @@ if __name__ == '__main__':
                            help='report based on event times' )
         parser.add_option( '--received', dest='timefield', action='store_const', const='received',
                            help='report based on received times' )
+        parser.add_option( '--mootthreads', type='int', default=MOOT_THREADS,
+                           help='number of acquisition groups to cross-load to MOOT at once; '
+                                'more than 1 is not known to be thread-safe (%default)' )
+        parser.add_option( '--mootbudget', type='float', default=MOOT_RETRY_BUDGET,
+                           help='total seconds to spend waiting to retry failed MOOT calls (%default)' )
+        parser.add_option( '--schemacache',
+                           help='file in which to cache reflected table definitions' )
+        parser.add_option( '--bulk', action='store_true', default=False,
+                           help='load with batched SQL statements in one transaction instead of the ORM (%default)' )
         parser.add_option( '--moot', action='store_true', default=False,
                            help='cross-load acquisition-summary information to the MOOT database (%default)' )
         opts, args = parser.parse_args()
@@ -611,6 +943,8 @@ if __name__ == '__main__':
 
         # connect to the database
         db = DbConfig.fromConfigParser( SiteDep, opts.dbi )
+        if opts.schemacache:
+            SchemaCache.use( opts.schemacache )
 
         # define tracking tables
         dltbl = SA.Table( '%s_downlink' % opts.prefix,     db.metadata,
@@ -683,7 +1017,7 @@ if __name__ == '__main__':
                             )
 
         # map tables to objects
-        dgmap = SA.mapper( DgmIdx, dgtbl )
+        dgmap = SA.mapper( DgmRecord, dgtbl )
         aqmap = SA.mapper( Acquisition, aqtbl,
                            properties={ 'segments' : SA.relation( DatagramSegment, lazy=False,
                                                                   primaryjoin=SA.and_( sgtbl.c.scid == aqtbl.c.scid,
@@ -697,25 +1031,28 @@ if __name__ == '__main__':
                                         'segments'     : SA.relation( DatagramSegment, lazy=False, private=True )
                                         } )
         sgmap = SA.mapper( DatagramSegment, sgtbl,
-                           properties={ 'dgm0' : SA.relation( DgmIdx, lazy=False, private=True,
+                           properties={ 'dgm0' : SA.relation( DgmRecord, lazy=False, private=True,
                                                              primaryjoin=SA.and_( sgtbl.c.scid == dgtbl.c.scid,
                                                                                   sgtbl.c.startedat == dgtbl.c.startedat,
                                                                                   sgtbl.c.apid == dgtbl.c.apid,
                                                                                   sgtbl.c.dgmseq0 == dgtbl.c.datagrams ) ),
-                                        'dgm1' : SA.relation( DgmIdx, lazy=False, private=True,
+                                        'dgm1' : SA.relation( DgmRecord, lazy=False, private=True,
                                                              primaryjoin=SA.and_( sgtbl.c.scid == dgtbl.c.scid,
                                                                                   sgtbl.c.startedat == dgtbl.c.startedat,
                                                                                   sgtbl.c.apid == dgtbl.c.apid,
                                                                                   sgtbl.c.dgmseq1 == dgtbl.c.datagrams ) ),
                                         } )
 
+        tables = { 'downlink' : dltbl, 'acqsummary' : aqtbl, 'segment' : sgtbl,
+                   'datagram' : dgtbl, 'association' : dlaqtbl }
+
         # perform the requested action
         if opts.action == 'rebuild':
             _log.info( 'Rebuilding database tables for prefix "%s" in "%s"' % ( opts.prefix, opts.dbi ) )
             rebuild( opts, db )
         elif opts.action == 'load':
             _log.info( 'Loading info from %s to prefix "%s" in "%s"' % ( opts.indir, opts.prefix, opts.dbi ) )
-            load( opts, db )
+            load( opts, db, tables )
         elif opts.action == 'report':
             _log.info( 'Reporting from prefix "%s" in "%s"' % ( opts.prefix, opts.dbi ) )
             report( opts, db )
@@ -784,19 +1121,163 @@ if __name__ == '__main__':
         else:
             _log.info( 'no previous data found' )
 
-    def load( opts, db ):
+    def bulk_rows( tbl, objs, **values ):
+        """!@brief column-value dictionaries for inserting objects into a table
+        @param[in] tbl The table.
+        @param[in] objs Objects with attributes named for the table columns.
+        @param[in] values Column values to use instead of the object attributes.
+        """
+        names = tbl.c.keys()
+        rows = []
+        for obj in objs:
+            row = dict( ( x, getattr( obj, x, None ) ) for x in names )
+            row.update( values )
+            rows.append( row )
+        return rows
+
+    def bulk_insert( conn, tbl, rows ):
+        """!@brief insert rows with one executemany
+
+        The rows of the downlink being loaded have already been deleted, so
+        a primary key that is still taken belongs to another downlink; as
+        with the ORM the insert then fails and the load is rolled back.
+        """
+        if not rows: return
+        conn.execute( tbl.insert(), rows )
+
+    def bulk_load( opts, db, tables ):
+        """!@brief load a downlink with batched statements in a single transaction
+
+        Writes the same rows as Downlink.updateDatabase (after delete) does
+        through the ORM: the downlink, its segments and their endpoint
+        datagrams, the downlink-acquisition associations and the summary of
+        every acquisition the old or new downlink contributed to.
+        """
+        dltbl = tables[ 'downlink' ]
+        aqtbl = tables[ 'acqsummary' ]
+        sgtbl = tables[ 'segment' ]
+        dgtbl = tables[ 'datagram' ]
+        dlaqtbl = tables[ 'association' ]
+
+        # read the segments in this downlink
+        dlink = Downlink( opts.downlink, opts.l0key, opts.indir, opts.outbase )
+        idxfiles = glob.glob( os.path.join( dlink.indir, '????????-????????-????-?????.idx' ) )
+        idxfiles.sort()
+        dlink.addseg( idxfiles )
+        if len( dlink.segments ) == 0:
+            _log.error( "bulk_load: no data segments found for downlink %d in %s" % ( dlink.id, dlink.indir ) )
+            return
+        scid = dlink.segments[0].scid
+        runstarts = set( dlink.runstarts() )
+
+        dgms = {}
+        for seg in dlink.segments:
+            for dgm in ( seg.dgm0, seg.dgm1 ):
+                dgms[ ( dgm.scid, dgm.startedat, dgm.apid, dgm.datagrams ) ] = dgm
+
+        conn = db.engine.connect()
+        trans = conn.begin()
+        try:
+            # clear any pre-existing content related to this downlink
+            if opts.downlink:
+                olddl = conn.execute( dltbl.select( dltbl.c.id == opts.downlink ) ).fetchone()
+            else:
+                olddl = conn.execute( dltbl.select( dltbl.c.l0key == opts.l0key ) ).fetchone()
+            if olddl:
+                _log.info( 'clearing previous data for downlink %09d with l0key %d' % ( olddl.id, olddl.l0key ) )
+                oldacqs = conn.execute( dlaqtbl.select( dlaqtbl.c.downlink_id == olddl.id ) ).fetchall()
+                oldsegs = conn.execute( sgtbl.select( sgtbl.c.downlink_id == olddl.id ) ).fetchall()
+                runstarts.update( [ x.startedat for x in oldacqs if x.scid == scid ] )
+                conn.execute( dlaqtbl.delete( dlaqtbl.c.downlink_id == olddl.id ) )
+                conn.execute( sgtbl.delete( sgtbl.c.downlink_id == olddl.id ) )
+                oldkeys = [ ( x.scid, x.startedat, x.apid, d ) for x in oldsegs for d in set( ( x.dgmseq0, x.dgmseq1 ) ) ]
+                if oldkeys:
+                    conn.execute( dgtbl.delete( SA.and_( dgtbl.c.scid == SA.bindparam( 'k_scid' ),
+                                                         dgtbl.c.startedat == SA.bindparam( 'k_startedat' ),
+                                                         dgtbl.c.apid == SA.bindparam( 'k_apid' ),
+                                                         dgtbl.c.datagrams == SA.bindparam( 'k_datagrams' ) ) ),
+                                  [ dict( zip( ( 'k_scid', 'k_startedat', 'k_apid', 'k_datagrams' ), x ) ) for x in oldkeys ] )
+                conn.execute( dltbl.delete( dltbl.c.id == olddl.id ) )
+            else:
+                _log.info( 'no previous data found' )
+
+            # write the downlink, its endpoint datagrams and its segments
+            conn.execute( dltbl.insert(), id=dlink.id, l0key=dlink.l0key, indir=dlink.indir, outbase=dlink.outbase )
+            bulk_insert( conn, dgtbl, bulk_rows( dgtbl, dgms.values() ) )
+            bulk_insert( conn, sgtbl, bulk_rows( sgtbl, dlink.segments, downlink_id=dlink.id ) )
+            _log.info( 'bulk_load: wrote %d segments and %d datagrams for downlink %09d' % \
+                       ( len( dlink.segments ), len( dgms ), dlink.id ) )
+
+            # summarize each acquisition from all of its stored segments
+            d0 = dgtbl.alias( 'd0' )
+            d1 = dgtbl.alias( 'd1' )
+            sel = SA.select( [ sgtbl.c.startedat, sgtbl.c.apid, sgtbl.c.nevts, sgtbl.c.dgmseq0, sgtbl.c.dgmseq1,
+                               d0.c.oaction.label( 'oaction' ), d1.c.caction.label( 'caction' ),
+                               d0.c.utc.label( 'dgmutc0' ), d1.c.utc.label( 'dgmutc1' ),
+                               d0.c.evtutc0.label( 'evtutc0' ), d1.c.evtutc1.label( 'evtutc1' ),
+                               d0.c.hwkey.label( 'hwkey' ), d0.c.swkey.label( 'swkey' ) ],
+                             SA.and_( sgtbl.c.scid == scid,
+                                      sgtbl.c.startedat.in_( *runstarts ),
+                                      d0.c.scid == sgtbl.c.scid, d0.c.startedat == sgtbl.c.startedat,
+                                      d0.c.apid == sgtbl.c.apid, d0.c.datagrams == sgtbl.c.dgmseq0,
+                                      d1.c.scid == sgtbl.c.scid, d1.c.startedat == sgtbl.c.startedat,
+                                      d1.c.apid == sgtbl.c.apid, d1.c.datagrams == sgtbl.c.dgmseq1 ),
+                             order_by=[ sgtbl.c.startedat, sgtbl.c.apid, sgtbl.c.dgmseq0 ] )
+            segments = dict( ( x, [] ) for x in runstarts )
+            for row in conn.execute( sel ):
+                segments[ row.startedat ].append( SegmentSummary( row ) )
+            existing = set( x.startedat for x in conn.execute(
+                SA.select( [ aqtbl.c.startedat ], SA.and_( aqtbl.c.scid == scid, aqtbl.c.startedat.in_( *runstarts ) ) ) ) )
+            updates = []
+            inserts = []
+            for rst in runstarts:
+                summ = summarize( rst, segments[ rst ] )
+                if rst in existing:
+                    summ.update( k_scid=scid, k_startedat=rst )
+                    updates.append( summ )
+                else:
+                    summ.update( scid=scid, startedat=rst, moot_key=0xffffffff, moot_alias='UNKNOWN' )
+                    inserts.append( summ )
+            if updates:
+                conn.execute( aqtbl.update( SA.and_( aqtbl.c.scid == SA.bindparam( 'k_scid' ),
+                                                     aqtbl.c.startedat == SA.bindparam( 'k_startedat' ) ) ),
+                              updates )
+            if inserts:
+                conn.execute( aqtbl.insert(), inserts )
+            _log.info( 'bulk_load: updated %d and created %d acquisition summaries' % ( len( updates ), len( inserts ) ) )
+
+            # associate this downlink's acquisitions with it
+            conn.execute( dlaqtbl.insert(), [ { 'downlink_id' : dlink.id, 'scid' : scid, 'startedat' : x }
+                                              for x in dlink.runstarts() ] )
+            trans.commit()
+        except:
+            trans.rollback()
+            _log.error( 'bulk_load: rolled back the load of downlink %09d' % dlink.id )
+            raise
+        finally:
+            conn.close()
+
+    def load( opts, db, tables ):
         # create the tables if necessary
         db.metadata.create_all()
 
         # create a unit-of-work session
         sess = SA.create_session( bind_to=db.engine )
 
-        # clear any pre-existing content related to this downlink
-        delete( opts, db, sess )
+        if opts.bulk:
+            # write everything with batched statements, then load the
+            # downlink back through the ORM for the reports below
+            bulk_load( opts, db, tables )
+            dlink = sess.query( Downlink ).get_by( id = opts.downlink )
+            if dlink is None:
+                return
+        else:
+            # clear any pre-existing content related to this downlink
+            delete( opts, db, sess )
 
-        # create the downlink object
-        dlink = Downlink( opts.downlink, opts.l0key, opts.indir, opts.outbase )
-        dlink.updateDatabase( sess )
+            # create the downlink object
+            dlink = Downlink( opts.downlink, opts.l0key, opts.indir, opts.outbase )
+            dlink.updateDatabase( sess )
         dlink.report()
 
         # map and report the MOOT key/alias info
@@ -833,8 +1314,9 @@ if __name__ == '__main__':
         if opts.moot:
             _log.info( 'AcqSummary::load: cross-loading to MOOT' )
             try:
-                mupd = MootUpdate()
-                dlink.update_moot( mupd )
+                loader = MootLoader( MootUpdate, threads=opts.mootthreads, budget=opts.mootbudget )
+                dlink.update_moot( loader )
+                loader.report()
             except Exception, e:
                 _log.error( 'AcqSummary::load: error updating MOOT %s "%s"' % (type(e), str(e)) )
 
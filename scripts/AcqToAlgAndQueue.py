@@ -29,6 +29,8 @@ from LICOS_Scripts.analysis.pipeline.KeyToAlgAndQueue import KeyToAlgAndQueue
 
 from ISOC import SiteDep
 
+import SchemaCache
+
 def main():
     # command line
     parser = OptionParser()
@@ -40,11 +42,15 @@ def main():
                        help='start-time of the acquisition' )
     parser.add_option( '-o', '--outfile',
                        help='name of output file for result' )
+    parser.add_option( '--schemacache',
+                       help='file in which to cache reflected table definitions' )
     opts, args = parser.parse_args()
 
     # connect to the database and grab the acq-summary table
     db = DbConfig.fromConfigParser( SiteDep, opts.dbi )
-    acqtbl = SA.Table( 'glastops_acqsummary', db.metadata, autoload=True )
+    if opts.schemacache:
+        SchemaCache.use( opts.schemacache )
+    acqtbl = SchemaCache.table( db, 'glastops_acqsummary' )
 
     # get the forwarded MOOT key for this acquisition
     acq = acqtbl.select( SA.and_( acqtbl.c.startedat == opts.started, acqtbl.c.scid == opts.scid  ) ).execute().fetchone()
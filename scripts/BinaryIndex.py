@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""Compact binary sidecar files for EVT/DGM index records."""
+
+## @namespace BinaryIndex
+#  @brief Write and read fixed-width binary companions of the text .idx files.
+#
+#  The text index files written by getLSEChunk are re-parsed with split()
+#  and int()/long() by every consumer.  A sidecar file (the index filename
+#  with a trailing 'b', e.g. foo.idx -> foo.idxb) holds the same EVT and DGM
+#  records as fixed-width NumPy records which can be memory-mapped, so that
+#  consumers can work on columns rather than re-parsing text.  The short
+#  text fields (actions, reasons, mode names, file names) are stored once in
+#  a string table and referenced by index.
+#
+#  File layout (all little-endian):
+#  - header:   HEADER_FORMAT, padded to HEADER_SIZE bytes
+#  - EVT records (EVT_DTYPE) at the EVT offset
+#  - DGM records (DGM_DTYPE) at the DGM offset
+#  - string table: newline-separated strings, from its offset to EOF
+#
+#  A sidecar is only used while it is at least as new as its text index;
+#  stale or missing sidecars make load() return None so the caller falls back
+#  to the text file.  So does a missing NumPy.
+#
+#  Writing a sidecar parses every EVT and DGM line of the text index, which
+#  costs more than the one pass over the DGM lines that AcqSummary makes, so
+#  no pipeline step writes them: they only pay off for an index that is read
+#  many times (use --write by hand, or from the step that would reuse it).
+
+import logging, os, struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_log = logging.getLogger()
+
+MAGIC = 'HPIX'
+VERSION = 1
+HEADER_FORMAT = '<4sHHQQQQQ'
+HEADER_SIZE = 64
+
+## string-table index used for a missing string (e.g. no evtfile field)
+NOSTRING = 0xFFFF
+
+_EVT_FIELDS = [ ( 'startedAt', '<u4' ),
+                ( 'sequence',  '<i8' ),
+                ( 'apid',      '<u2' ),
+                ( 'datagrams', '<u4' ),
+                ( 'oaction',   '<u2' ),
+                ( 'caction',   '<u2' ),
+                ( 'fileofst',  '<i8' ),
+                ( 'evtfile',   '<u2' ),
+                ]
+
+_DGM_FIELDS = [ ( 'startedat',     '<u4' ),
+                ( 'utc_stamp',     'S24' ),
+                ( 'scid',          '<u2' ),
+                ( 'apid',          '<u2' ),
+                ( 'datagrams',     '<u4' ),
+                ( 'groundid',      '<i8' ),
+                ( 'modechanges',   '<u4' ),
+                ( 'modename',      '<u2' ),
+                ( 'oaction',       '<u2' ),
+                ( 'oreason',       '<u2' ),
+                ( 'caction',       '<u2' ),
+                ( 'creason',       '<u2' ),
+                ( 'platform',      '<u2' ),
+                ( 'origin',        '<u2' ),
+                ( 'crate',         '<u2' ),
+                ( 'evtutc0_stamp', 'S24' ),
+                ( 'evtseq0',       '<i8' ),
+                ( 'evtutc1_stamp', 'S24' ),
+                ( 'evtseq1',       '<i8' ),
+                ( 'nevts',         '<u4' ),
+                ( 'hwkey',         '<i8' ),
+                ( 'swkey',         '<i8' ),
+                ( 'nfields',       '<u1' ),
+                ]
+
+EVT_DTYPE = DGM_DTYPE = None
+if numpy is not None:
+    EVT_DTYPE = numpy.dtype( _EVT_FIELDS )
+    DGM_DTYPE = numpy.dtype( _DGM_FIELDS )
+
+## names of the string-table columns of each record type
+EVT_STRINGS = ( 'oaction', 'caction', 'evtfile' )
+DGM_STRINGS = ( 'modename', 'oaction', 'oreason', 'caction', 'creason', 'platform', 'origin', 'crate' )
+
+class BadSidecar( RuntimeError ):
+    """!Raised when a sidecar file is truncated or has the wrong format"""
+
+def sidecar( idxfile ):
+    """!@brief name of the binary sidecar for a text index file"""
+    return idxfile + 'b'
+
+def isCurrent( idxfile ):
+    """!@brief true if the sidecar for idxfile exists and is at least as new as idxfile
+    (always false without NumPy, since the sidecar could not be read)"""
+    if numpy is None:
+        return False
+    try:
+        return os.stat( sidecar( idxfile ) ).st_mtime >= os.stat( idxfile ).st_mtime
+    except OSError:
+        return False
+
+def load( idxfile ):
+    """!@brief open the sidecar for a text index file if it is current
+    @param[in] idxfile Text index filename.
+    @return A BinaryIndex, or None if there is no usable sidecar.
+    """
+    if not isCurrent( idxfile ):
+        return None
+    try:
+        return BinaryIndex( sidecar( idxfile ) )
+    except ( BadSidecar, EnvironmentError ), e:
+        _log.warning( 'BinaryIndex::load: ignoring sidecar for %s: %s' % ( idxfile, str(e) ) )
+        return None
+
+class _StringTable( object ):
+    # Assigns a small integer to each distinct string.
+    def __init__( self ):
+        self.strings = []
+        self.index = {}
+
+    def __call__( self, s ):
+        try:
+            return self.index[s]
+        except KeyError:
+            if len( self.strings ) >= NOSTRING:
+                raise BadSidecar( 'too many distinct strings for the string table' )
+            self.index[s] = len( self.strings )
+            self.strings.append( s )
+            return self.index[s]
+
+def _evtRecord( fields, strtab ):
+    # Return the EVT_DTYPE tuple for the split fields of an EVT line
+    # (same field selection as MergeDatagrams.EvtIdx).
+    if len( fields ) == 9:
+        return ( int( fields[1] ), long( fields[2] ), int( fields[3] ), int( fields[4] ),
+                 strtab( fields[5] ), strtab( fields[6] ), long( fields[7] ), strtab( fields[8] ) )
+    evtfile = NOSTRING
+    if len( fields ) > 14:
+        evtfile = strtab( fields[14] )
+    return ( int( fields[1] ), long( fields[2] ), int( fields[7] ), int( fields[8] ),
+             strtab( fields[10] ), strtab( fields[11] ), long( fields[13] ), evtfile )
+
+def _dgmRecord( fields, strtab ):
+    # Return the DGM_DTYPE tuple for the split fields of a DGM line
+    # (same field selection as MergeDatagrams.DgmIdx).
+    hwkey = swkey = 0
+    if len( fields ) > 21: hwkey = long( fields[21] )
+    if len( fields ) > 22: swkey = long( fields[22] )
+    return ( int( fields[1] ), fields[2], int( fields[3] ), int( fields[4] ), int( fields[5] ),
+             int( fields[6] ), int( fields[7] ),
+             strtab( fields[8] ), strtab( fields[9] ), strtab( fields[10] ), strtab( fields[11] ),
+             strtab( fields[12] ), strtab( fields[13] ), strtab( fields[14] ), strtab( fields[15] ),
+             fields[16], long( fields[17] ), fields[18], long( fields[19] ), int( fields[20] ),
+             hwkey, swkey, min( len( fields ), 23 ) )
+
+def _align( n ):
+    return ( n + 7 ) & ~7
+
+def write( idxfile, outfile = None ):
+    """!@brief write the binary sidecar for a text index file
+    @param[in] idxfile Text index filename.
+    @param[in] outfile Sidecar filename (default sidecar(idxfile)).
+    @return Tuple of the number of EVT and DGM records written.
+    """
+    if numpy is None:
+        raise BadSidecar( 'cannot write %s without NumPy' % sidecar( idxfile ) )
+    if outfile is None: outfile = sidecar( idxfile )
+    strtab = _StringTable()
+    evts = []
+    dgms = []
+    for line in open( idxfile ):
+        if line.startswith( 'EVT' ):
+            evts.append( _evtRecord( line.split(), strtab ) )
+        elif line.startswith( 'DGM' ):
+            dgms.append( _dgmRecord( line.split(), strtab ) )
+    evtarr = numpy.array( evts, dtype=EVT_DTYPE )
+    dgmarr = numpy.array( dgms, dtype=DGM_DTYPE )
+    strbuf = '\n'.join( strtab.strings )
+
+    evtofst = HEADER_SIZE
+    dgmofst = _align( evtofst + evtarr.nbytes )
+    strofst = _align( dgmofst + dgmarr.nbytes )
+    header = struct.pack( HEADER_FORMAT, MAGIC, VERSION, 0,
+                          len( evtarr ), evtofst, len( dgmarr ), dgmofst, strofst )
+
+    # write to a temporary name and rename so readers never see a partial file
+    tmpfile = '%s.%d.tmp' % ( outfile, os.getpid() )
+    ofd = open( tmpfile, 'wb' )
+    try:
+        ofd.write( header.ljust( HEADER_SIZE, '\0' ) )
+        ofd.write( evtarr.tostring() )
+        ofd.write( '\0' * ( dgmofst - evtofst - evtarr.nbytes ) )
+        ofd.write( dgmarr.tostring() )
+        ofd.write( '\0' * ( strofst - dgmofst - dgmarr.nbytes ) )
+        ofd.write( strbuf )
+    finally:
+        ofd.close()
+    os.rename( tmpfile, outfile )
+    _log.info( 'BinaryIndex::write: wrote %d EVT and %d DGM records to %s' % ( len( evtarr ), len( dgmarr ), outfile ) )
+    return len( evtarr ), len( dgmarr )
+
+class BinaryIndex( object ):
+    """!Memory-mapped view of the EVT and DGM records in a sidecar file"""
+    def __init__( self, filename ):
+        """!@param[in] filename Sidecar filename."""
+        self.filename = filename
+        size = os.stat( filename ).st_size
+        ifd = open( filename, 'rb' )
+        try:
+            header = ifd.read( HEADER_SIZE )
+            if len( header ) != HEADER_SIZE:
+                raise BadSidecar( '%s: truncated header' % filename )
+            magic, version, pad, nevt, evtofst, ndgm, dgmofst, strofst = \
+                   struct.unpack( HEADER_FORMAT, header[:struct.calcsize( HEADER_FORMAT )] )
+            if magic != MAGIC or version != VERSION:
+                raise BadSidecar( '%s: not a version %d index sidecar' % ( filename, VERSION ) )
+            if strofst > size or dgmofst + ndgm * DGM_DTYPE.itemsize > strofst:
+                raise BadSidecar( '%s: truncated file' % filename )
+            ifd.seek( strofst )
+            strbuf = ifd.read()
+        finally:
+            ifd.close()
+        self.strings = strbuf.split( '\n' ) if strbuf else []
+        self.evt = self._map( EVT_DTYPE, evtofst, nevt )
+        self.dgm = self._map( DGM_DTYPE, dgmofst, ndgm )
+
+    def _map( self, dtype, offset, count ):
+        # numpy.memmap refuses zero-length maps
+        if count == 0:
+            return numpy.zeros( 0, dtype=dtype )
+        return numpy.memmap( self.filename, dtype=dtype, mode='r', offset=offset, shape=( count, ) )
+
+    def records( self, prefix ):
+        """!@brief record array for 'EVT' or 'DGM' records"""
+        if prefix == 'EVT':
+            return self.evt
+        return self.dgm
+
+    def string( self, i ):
+        """!@brief string-table entry (None for NOSTRING)"""
+        if i == NOSTRING:
+            return None
+        return self.strings[i]
+
+    def column( self, prefix, name ):
+        """!@brief one column of the EVT or DGM records
+        String-table columns are returned as a list of strings, all others as arrays.
+        """
+        col = self.records( prefix )[ name ]
+        if name in ( EVT_STRINGS if prefix == 'EVT' else DGM_STRINGS ):
+            return [ self.string( i ) for i in col.tolist() ]
+        return col
+
+    def dgmline( self, i ):
+        """!@brief text DGM index line for DGM record i"""
+        r = self.dgm[i]
+        s = self.string
+        fields = [ 'DGM:', str( r['startedat'] ), r['utc_stamp'], str( r['scid'] ), str( r['apid'] ),
+                   str( r['datagrams'] ), str( r['groundid'] ), str( r['modechanges'] ),
+                   s( r['modename'] ), s( r['oaction'] ), s( r['oreason'] ), s( r['caction'] ),
+                   s( r['creason'] ), s( r['platform'] ), s( r['origin'] ), s( r['crate'] ),
+                   r['evtutc0_stamp'], str( r['evtseq0'] ), r['evtutc1_stamp'], str( r['evtseq1'] ),
+                   str( r['nevts'] ), str( r['hwkey'] ), str( r['swkey'] ) ]
+        return ' '.join( fields[:int( r['nfields'] )] ) + '\n'
+
+    def evtidx( self, i, cls ):
+        """!@brief EvtIdx-compatible object for EVT record i
+        @param[in] i Record number.
+        @param[in] cls The EvtIdx class to instantiate.
+        """
+        r = self.evt[i]
+        e = cls.__new__( cls )
+        e.startedAt = int( r['startedAt'] )
+        e.sequence  = long( r['sequence'] )
+        e.apid      = int( r['apid'] )
+        e.datagrams = int( r['datagrams'] )
+        e.oaction   = self.string( r['oaction'] )
+        e.caction   = self.string( r['caction'] )
+        e.fileofst  = long( r['fileofst'] )
+        e.evtfile   = self.string( r['evtfile'] )
+        return e
+
+    def dgmvalues( self, i ):
+        """!@brief dictionary of the DgmIdx attribute values of DGM record i
+        (hwkey and swkey only if the text record had them)"""
+        r = self.dgm[i]
+        s = self.string
+        values = { 'startedat'     : int( r['startedat'] ),
+                   'utc_stamp'     : str( r['utc_stamp'] ),
+                   'scid'          : int( r['scid'] ),
+                   'apid'          : int( r['apid'] ),
+                   'datagrams'     : int( r['datagrams'] ),
+                   'groundid'      : int( r['groundid'] ),
+                   'modechanges'   : int( r['modechanges'] ),
+                   'modename'      : s( r['modename'] ),
+                   'oaction'       : s( r['oaction'] ),
+                   'oreason'       : s( r['oreason'] ),
+                   'caction'       : s( r['caction'] ),
+                   'creason'       : s( r['creason'] ),
+                   'platform'      : s( r['platform'] ),
+                   'origin'        : s( r['origin'] ),
+                   'crate'         : s( r['crate'] ),
+                   'evtutc0_stamp' : str( r['evtutc0_stamp'] ),
+                   'evtseq0'       : long( r['evtseq0'] ),
+                   'evtutc1_stamp' : str( r['evtutc1_stamp'] ),
+                   'evtseq1'       : long( r['evtseq1'] ),
+                   'nevts'         : int( r['nevts'] ),
+                   }
+        nfields = int( r['nfields'] )
+        if nfields > 21: values['hwkey'] = long( r['hwkey'] )
+        if nfields > 22: values['swkey'] = long( r['swkey'] )
+        return values
+
+    def dgmidx( self, i, cls ):
+        """!@brief DgmIdx-compatible object for DGM record i
+        @param[in] i Record number.
+        @param[in] cls The DgmIdx class to instantiate.
+
+        DgmIdx may be mapped by SqlAlchemy, so it is constructed through its
+        normal constructor, from the record's values rather than a text line.
+        """
+        return cls( self.dgmvalues( i ) )
+
+    def iterevt( self, cls ):
+        """!@brief generate EvtIdx-compatible objects for all EVT records"""
+        for i in xrange( len( self.evt ) ):
+            yield self.evtidx( i, cls )
+
+    def iterdgm( self, cls ):
+        """!@brief generate DgmIdx-compatible objects for all DGM records"""
+        for i in xrange( len( self.dgm ) ):
+            yield self.dgmidx( i, cls )
+
+if __name__ == '__main__':
+
+    import sys
+
+    from quarks.cmdline.xoptparse import OptionParser
+
+    import IndexMerge
+
+    def main():
+        # set basic logging configuration
+        logging.basicConfig( format='%(asctime)s.%(msecs)03d %(levelname)-8s %(name)s: %(message)s',
+                             datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stdout )
+        logging.getLogger().setLevel( logging.INFO )
+
+        # parse command-line args
+        parser = OptionParser( usage='usage: %prog [options] idxfile-or-pattern ...' )
+        parser.add_option( '--write', dest='action', action='store_const', const='write',
+                           help='write sidecars for index files that have no current sidecar' )
+        parser.add_option( '--dump', dest='action', action='store_const', const='dump',
+                           help='print the DGM records of the sidecars as text' )
+        parser.add_option( '--force', action='store_true', default=False,
+                           help='rewrite sidecars even if they are current (%default)' )
+        opts, args = parser.parse_args()
+
+        rc = 0
+        for idxfile in IndexMerge.expand( args ):
+            if opts.action == 'write':
+                if opts.force or not isCurrent( idxfile ):
+                    try:
+                        write( idxfile )
+                    except Exception, e:
+                        _log.error( 'BinaryIndex: could not write sidecar for %s: %s %s' % ( idxfile, type(e), str(e) ) )
+                        rc = 1
+            elif opts.action == 'dump':
+                bidx = load( idxfile )
+                if bidx:
+                    for i in xrange( len( bidx.dgm ) ):
+                        sys.stdout.write( bidx.dgmline( i ) )
+            else:
+                parser.error( 'no action specified' )
+        return rc
+
+    sys.exit( main() )
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""Streaming k-way merge of sorted EVT/DGM index files."""
+
+## @namespace IndexMerge
+#  @brief Merge per-chunk index files into a single sorted, de-duplicated
+#  stream of index records.
+#
+#  Previously-merged dgm-/evt-<rst>.idx files are already sorted, so rather
+#  than concatenating everything and re-sorting with sort(1) they are
+#  treated as sorted streams and merged with a heap.  Per-chunk .idx files
+#  interleave the records of apids 956 and 957, so they are not sorted:
+#  their records are picked out with grep(1) and sorted by a single sort(1)
+#  over all the chunks, whose output is read as one more stream (sort spills
+#  to its own temporary files if need be, so nothing is held in memory).
+#  Records are ordered and de-duplicated on the same keys used by the
+#  sort(1) invocations this replaces:
+#
+#  - DGM: sort -u -b -k 2n,2 -k 5n,5 -k 6n,6  (startedat, apid, datagram)
+#  - EVT: sort -u -b -k 3g,3 -k 8n,8          (sequence, apid)
+#
+#  As with sort -u, the first record seen for a given key is kept; ties are
+#  broken in the order in which the input files are given, the chunk files
+#  coming after the sorted ones.
+
+import glob, heapq, logging, os, subprocess
+
+_log = logging.getLogger()
+
+class IndexNotSorted( RuntimeError ):
+    """!Raised when an input that should be sorted has records out of order"""
+
+def dgm_key( fields ):
+    """!@brief merge key for a DGM record (startedat, apid, datagram)"""
+    return ( int( fields[1] ), int( fields[4] ), int( fields[5] ) )
+
+def evt_key( fields ):
+    """!@brief merge key for an EVT record (sequence, apid)"""
+    return ( long( fields[2] ), int( fields[7] ) )
+
+## record prefix and merge key for each kind of index record
+RECORD_KEYS = { 'DGM' : dgm_key,
+                'EVT' : evt_key,
+                }
+
+## sort(1) key options giving the same order as RECORD_KEYS
+SORT_KEYS = { 'DGM' : [ '-k', '2n,2', '-k', '5n,5', '-k', '6n,6' ],
+              'EVT' : [ '-k', '3g,3', '-k', '8n,8' ],
+              }
+
+def expand( patterns ):
+    """!@brief expand a list of filenames and/or glob patterns
+    @param[in] patterns Sequence of filenames or shell-style wildcard patterns.
+    @return List of existing filenames, each pattern's matches sorted.
+    """
+    files = []
+    for pat in patterns:
+        matches = glob.glob( pat )
+        matches.sort()
+        if not matches:
+            _log.info( 'IndexMerge::expand: no files match %s' % pat )
+        files.extend( matches )
+    return files
+
+def stream( lines, name, prefix, keyfunc, order ):
+    """!@brief generate (key, order, line) tuples for the matching records of sorted lines
+    @param[in] lines Iterable of index lines, sorted by their merge keys.
+    @param[in] name Name of the input, for messages.
+    @param[in] prefix Record-type prefix ('DGM' or 'EVT').
+    @param[in] keyfunc Function mapping the split fields of a record to its merge key.
+    @param[in] order Tie-breaking rank of this input among the merge inputs.
+    """
+    last = None
+    nrec = 0
+    for line in lines:
+        if not line.startswith( prefix ):
+            continue
+        key = keyfunc( line.split() )
+        if last is not None and key < last:
+            raise IndexNotSorted( '%s: %s record %d is out of order' % ( name, prefix, nrec + 1 ) )
+        last = key
+        nrec += 1
+        yield ( key, order, line )
+    _log.debug( 'IndexMerge::stream: read %d %s records from %s' % ( nrec, prefix, name ) )
+
+def sort_chunks( chunkfiles, prefix ):
+    """!@brief generate the matching records of unsorted index files, sorted by sort(1)
+    @param[in] chunkfiles Sequence of index filenames.
+    @param[in] prefix Record-type prefix ('DGM' or 'EVT').
+
+    The sort is stable, so records with the same key keep the order of the
+    files and of the lines within them.
+    """
+    env = dict( os.environ, LC_ALL='C' )
+    grep = subprocess.Popen( [ 'grep', '-h', '^' + prefix ] + list( chunkfiles ),
+                             stdout=subprocess.PIPE, env=env )
+    sort = subprocess.Popen( [ 'sort', '-s', '-b' ] + SORT_KEYS[ prefix ],
+                             stdin=grep.stdout, stdout=subprocess.PIPE, env=env )
+    grep.stdout.close()
+    try:
+        for line in sort.stdout:
+            yield line
+    finally:
+        sort.stdout.close()
+        rc = sort.wait(), grep.wait()
+    # grep exits 1 when nothing matched
+    if rc[0] != 0 or rc[1] not in ( 0, 1 ):
+        raise IndexNotSorted( 'sorting the %s records of %d chunk files failed (sort rc=%d, grep rc=%d)' % \
+                              ( prefix, len( chunkfiles ), rc[0], rc[1] ) )
+
+def merge( idxfiles, prefix, chunkfiles = () ):
+    """!@brief merge index files into one sorted, de-duplicated stream of records
+    @param[in] idxfiles Sequence of sorted index filenames, in order of precedence for duplicates.
+    @param[in] prefix Record-type prefix ('DGM' or 'EVT').
+    @param[in] chunkfiles Sequence of unsorted (per-chunk) index filenames, after idxfiles in precedence.
+    @return Generator of index-record text lines (with newlines).
+    """
+    keyfunc = RECORD_KEYS[ prefix ]
+    streams = [ stream( open( f ), f, prefix, keyfunc, i ) for i, f in enumerate( idxfiles ) ]
+    if chunkfiles:
+        streams.append( stream( sort_chunks( chunkfiles, prefix ), '%d chunk files' % len( chunkfiles ),
+                                prefix, keyfunc, len( idxfiles ) ) )
+    _log.info( 'IndexMerge::merge: merging %s records from %d sorted and %d chunk files' % \
+               ( prefix, len( idxfiles ), len( chunkfiles ) ) )
+    last = None
+    nout = ndup = 0
+    for key, order, line in heapq.merge( *streams ):
+        if key == last:
+            ndup += 1
+            continue
+        last = key
+        nout += 1
+        yield line
+    _log.info( 'IndexMerge::merge: merged %d %s records, dropped %d duplicates' % ( nout, prefix, ndup ) )
+
+def tee( lines, outfile ):
+    """!@brief pass lines through while also writing them to a file
+    @param[in] lines Iterable of text lines.
+    @param[in] outfile Filename to which the lines should be written.
+    """
+    ofd = open( outfile, 'w' )
+    try:
+        for line in lines:
+            ofd.write( line )
+            yield line
+    finally:
+        ofd.close()
+
+if __name__ == '__main__':
+
+    import sys
+
+    from quarks.cmdline.xoptparse import OptionParser
+
+    def main():
+        # set basic logging configuration
+        logging.basicConfig( format='%(asctime)s.%(msecs)03d %(levelname)-8s %(name)s: %(message)s',
+                             datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stdout )
+        logging.getLogger().setLevel( logging.INFO )
+
+        # parse command-line args
+        parser = OptionParser( usage='usage: %prog [options] sorted-idxfile-or-pattern ...' )
+        parser.add_option( '--dgm', dest='prefix', action='store_const', const='DGM',
+                           help='merge datagram-index records' )
+        parser.add_option( '--evt', dest='prefix', action='store_const', const='EVT',
+                           help='merge event-index records' )
+        parser.add_option( '-c', '--chunks', action='append', default=[],
+                           help='unsorted per-chunk index file or pattern (may be repeated)' )
+        parser.add_option( '-o', '--outfile',
+                           help='output file (default stdout)' )
+        opts, args = parser.parse_args()
+        if not opts.prefix:
+            parser.error( 'one of --dgm or --evt must be specified' )
+
+        lines = merge( expand( args ), opts.prefix, expand( opts.chunks ) )
+        if opts.outfile:
+            for line in tee( lines, opts.outfile ): pass
+        else:
+            sys.stdout.writelines( lines )
+        return 0
+
+    sys.exit( main() )
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""In-process extraction of records from EVT/DGM index files."""
+
+## @namespace IndexReader
+#  @brief Read the records of a given type from index files without
+#  spawning grep.
+#
+#  Index files are read in large blocks and split into lines, keeping only
+#  those that begin with the requested record prefix, so the result is the
+#  same as that of `grep ^DGM <idx>`.  readMany() can optionally read a list
+#  of files from a small pool of threads, which hides most of the per-file
+#  latency when the index files live on NFS.
+
+import logging, threading, Queue
+
+_log = logging.getLogger()
+
+## bytes per read
+BLOCKSIZE = 1 << 20
+
+## default number of reader threads for readMany (0 reads serially)
+WORKERS = 0
+
+def records( idxfile, prefix, blocksize = BLOCKSIZE ):
+    """!@brief generate the lines of idxfile that begin with prefix
+    @param[in] idxfile Index filename.
+    @param[in] prefix Record-type prefix (e.g. 'DGM' or 'EVT').
+    @param[in] blocksize Bytes per read.
+    @return Generator of lines, including their newlines.
+    """
+    ifd = open( idxfile, 'rb' )
+    try:
+        tail = ''
+        while True:
+            block = ifd.read( blocksize )
+            if not block:
+                break
+            data = tail + block
+            lines = data.split( '\n' )
+            tail = lines.pop()
+            # most blocks of a chunk index are all EVT records, so only
+            # look at the individual lines of blocks containing the prefix
+            if prefix in data:
+                for line in lines:
+                    if line.startswith( prefix ):
+                        yield line + '\n'
+        if tail.startswith( prefix ):
+            yield tail + '\n'
+    finally:
+        ifd.close()
+
+def read( idxfile, prefix, blocksize = BLOCKSIZE ):
+    """!@brief list of the lines of idxfile that begin with prefix"""
+    return list( records( idxfile, prefix, blocksize ) )
+
+def readMany( idxfiles, prefix, workers = WORKERS, blocksize = BLOCKSIZE ):
+    """!@brief read the records of a given type from several index files
+    @param[in] idxfiles Sequence of index filenames.
+    @param[in] prefix Record-type prefix (e.g. 'DGM' or 'EVT').
+    @param[in] workers Number of reader threads (0 or 1 reads serially).
+    @param[in] blocksize Bytes per read.
+    @return Dictionary mapping each filename to its list of lines.  A file
+    that cannot be read maps to the exception raised when reading it.
+    """
+    result = {}
+    if workers <= 1 or len( idxfiles ) <= 1:
+        for idxfile in idxfiles:
+            try:
+                result[ idxfile ] = read( idxfile, prefix, blocksize )
+            except EnvironmentError, e:
+                result[ idxfile ] = e
+        return result
+
+    todo = Queue.Queue()
+    for idxfile in idxfiles:
+        todo.put( idxfile )
+
+    def reader():
+        while True:
+            try:
+                idxfile = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                lines = read( idxfile, prefix, blocksize )
+            except EnvironmentError, e:
+                lines = e
+            result[ idxfile ] = lines
+
+    threads = [ threading.Thread( target=reader ) for i in xrange( min( workers, len( idxfiles ) ) ) ]
+    for t in threads:
+        t.setDaemon( True )
+        t.start()
+    for t in threads:
+        t.join()
+    _log.info( 'IndexReader::readMany: read %s records from %d files with %d threads' % \
+               ( prefix, len( idxfiles ), len( threads ) ) )
+    return result
+
+if __name__ == '__main__':
+
+    import sys
+
+    from quarks.cmdline.xoptparse import OptionParser
+
+    def main():
+        # set basic logging configuration
+        logging.basicConfig( format='%(asctime)s.%(msecs)03d %(levelname)-8s %(name)s: %(message)s',
+                             datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stderr )
+        logging.getLogger().setLevel( logging.INFO )
+
+        # parse command-line args
+        parser = OptionParser( usage='usage: %prog [options] idxfile ...' )
+        parser.add_option( '-p', '--prefix', default='DGM',
+                           help='record prefix to extract (%default)' )
+        parser.add_option( '-w', '--workers', type='int', default=WORKERS,
+                           help='number of reader threads (%default)' )
+        opts, args = parser.parse_args()
+
+        lines = readMany( args, opts.prefix, opts.workers )
+        status = 0
+        for idxfile in args:
+            if isinstance( lines[ idxfile ], EnvironmentError ):
+                _log.error( 'cannot read %s: %s' % ( idxfile, lines[ idxfile ] ) )
+                status = 1
+                continue
+            sys.stdout.writelines( lines[ idxfile ] )
+        return status
+
+    sys.exit( main() )
@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 
-import datetime, logging, os, pprint, subprocess, sys
+import datetime, logging, os, pprint, sys
 from collections import defaultdict
 
 from ISOC import Log
 
+import IndexReader
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _log = logging.getLogger()
 
 MERGE_APIDS = ( 956, 957, 958 )
 
+## event classifications used by classify()
+MERGED, DELIVERED, ORPHANED = 0, 1, 2
+
 class NoDatagramsFound( RuntimeError ):
     """!Raised when no datagrams are found in an index file"""
 
@@ -22,8 +32,10 @@ class DatagramSegment( object ):
         if idx:
             src = idx
             # get the list of datagrams from the index file and capture the first and last
-            ifd = subprocess.Popen( 'grep ^DGM %s' % idx, shell=True, stdout=subprocess.PIPE ).stdout
-            self.dgmlist = [ DgmIdx( dgmstr ) for dgmstr in ifd ]
+            try:
+                self.dgmlist = [ DgmIdx( dgmstr ) for dgmstr in IndexReader.records( idx, 'DGM' ) ]
+            except EnvironmentError, e:
+                raise NoDatagramsFound( 'Cannot read idx file %s: %s' % ( idx, e ) )
             if len( self.dgmlist ) == 0:
                 raise NoDatagramsFound( 'No datagrams found in idx file %s' % idx )
         elif dgms:
@@ -129,13 +141,36 @@ class DatagramSegment( object ):
         return self.dgm1.evtutc1
 
 
+def _stamp_property( name ):
+    """!@brief property for a timestamp kept as text in <name>_stamp and converted on first access"""
+    cache = '_' + name
+    stamp = name + '_stamp'
+    def fget( self ):
+        try:
+            return getattr( self, cache )
+        except AttributeError:
+            value = datetime.datetime.utcfromtimestamp( float( getattr( self, stamp ) ) )
+            setattr( self, cache, value )
+            return value
+    def fset( self, value ):
+        setattr( self, cache, value )
+    return property( fget, fset )
+
 class DgmIdx( object ):
-    """!object to represent a decoded datagram"""
+    """!object to represent a decoded datagram
+
+    The timestamps are kept in their original text form and only converted
+    to datetimes when utc, evtutc0 or evtutc1 is first used.
+    """
+    __slots__ = ( 'startedat', 'scid', 'apid', 'datagrams', 'groundid', 'modechanges', 'modename',
+                  'oaction', 'oreason', 'caction', 'creason', 'platform', 'origin', 'crate',
+                  'evtseq0', 'evtseq1', 'nevts', 'hwkey', 'swkey',
+                  'utc_stamp', 'evtutc0_stamp', 'evtutc1_stamp', '_utc', '_evtutc0', '_evtutc1' )
     def __init__( self, instr ):
         fields = instr.split()
         if fields[0].startswith( 'DGM' ):
             self.startedat   = int(   fields[ 1] )
-            self.utc         = datetime.datetime.utcfromtimestamp( float( fields[ 2] ) )
+            self.utc_stamp   =        fields[ 2]
             self.scid        = int(   fields[ 3] )
             self.apid        = int(   fields[ 4] )
             self.datagrams   = int(   fields[ 5] )
@@ -149,18 +184,17 @@ class DgmIdx( object ):
             self.platform    =        fields[13]
             self.origin      =        fields[14]
             self.crate       =        fields[15]
-            self.evtutc0     = datetime.datetime.utcfromtimestamp( float( fields[16] ) )
+            self.evtutc0_stamp =      fields[16]
             self.evtseq0     = long(  fields[17] )
-            self.evtutc1     = datetime.datetime.utcfromtimestamp( float( fields[18] ) )
+            self.evtutc1_stamp =      fields[18]
             self.evtseq1     = long(  fields[19] )
             self.nevts       = int(   fields[20] )
             if len(fields) > 21: self.hwkey       = long(  fields[21] )
             if len(fields) > 22: self.swkey       = long(  fields[22] )
 
-            # store the original representations of the timestamps
-            self.utc_stamp    = fields[2]
-            self.evtutc0_stamp = fields[16]
-            self.evtutc1_stamp = fields[18]
+    utc     = _stamp_property( 'utc' )
+    evtutc0 = _stamp_property( 'evtutc0' )
+    evtutc1 = _stamp_property( 'evtutc1' )
 
     def __eq__( self, rhs ):
         if not rhs: return False
@@ -225,12 +259,61 @@ class EvtIdx( object ):
     def __ne__( self, other ):
         return not other == self
 
+def in_spans( seqs, spans ):
+    """!@brief flag the events that fall within the span each would be tested against
+    @param[in] seqs Array of event sequence numbers, in non-decreasing order.
+    @param[in] spans List of (first, last) sequence-number spans.
+    @return Boolean array, true where spans[i][0] <= seqs[j] <= spans[i][1].
+
+    Walking the events in order, the per-event merge only ever moves forward
+    through the span list, testing each event against the first span whose
+    end is not before it.  That is the first span at which the running
+    maximum of the span ends reaches the event, which searchsorted finds.
+    """
+    if not spans:
+        return numpy.zeros( len( seqs ), dtype=bool )
+    lo = numpy.array( [ x[0] for x in spans ], dtype=numpy.int64 )
+    hi = numpy.array( [ x[1] for x in spans ], dtype=numpy.int64 )
+    ispan = numpy.searchsorted( numpy.maximum.accumulate( hi ), seqs, side='left' )
+    found = ispan < len( spans )
+    ispan = numpy.minimum( ispan, len( spans )-1 )
+    return found & ( lo[ ispan ] <= seqs ) & ( seqs <= hi[ ispan ] )
+
+def classify( seqs, newspans, donespans ):
+    """!@brief classify events as MERGED, DELIVERED or ORPHANED
+    @param[in] seqs Array of event sequence numbers, in non-decreasing order.
+    @param[in] newspans List of mergeable (first, last) event spans.
+    @param[in] donespans Sorted list of previously-delivered (first, last) event spans.
+    @return Array of classifications, one per event.
+    """
+    state = numpy.zeros( len( seqs ), dtype=numpy.int8 )
+    state[ ~in_spans( seqs, newspans ) ] = ORPHANED
+    state[ in_spans( seqs, donespans ) ] = DELIVERED
+    return state
+
+def merged_runs( state ):
+    """!@brief find the contiguous runs of MERGED events
+    @param[in] state Array of event classifications from classify().
+    @return List of (first, last+1) event-index ranges.
+    """
+    edges = numpy.diff( numpy.concatenate( ( [0], ( state == MERGED ).astype( numpy.int8 ), [0] ) ) )
+    starts = numpy.nonzero( edges == 1 )[0]
+    stops = numpy.nonzero( edges == -1 )[0]
+    return zip( starts.tolist(), stops.tolist() )
+
 if __name__ == '__main__':
 
-    import cPickle, glob, itertools, os, pprint, sys
+    import array, copy, cPickle, errno, glob, itertools, multiprocessing, os, pprint, shutil, sys
 
     from quarks.cmdline.xoptparse import OptionParser
 
+    try:
+        import SpanRegistry
+    except ImportError:
+        SpanRegistry = None
+
+    import IndexMerge
+
     def gen_EvtIdx( idxfile ):
         for estr in open( idxfile ):
             yield ( estr, EvtIdx( None, estr ) )
@@ -238,10 +321,24 @@ if __name__ == '__main__':
 
     def merge( opts ):
 
+        # get the datagram and event index records, either from the pre-merged
+        # index files or by merging the source index files on the fly (in which
+        # case the merged records are also written to the index files)
+        if opts.dgmsrc or opts.dgmchunks:
+            dgmlines = IndexMerge.tee( IndexMerge.merge( IndexMerge.expand( opts.dgmsrc or [] ), 'DGM',
+                                                         IndexMerge.expand( opts.dgmchunks or [] ) ), opts.dgmidx )
+        else:
+            dgmlines = open( opts.dgmidx )
+        if opts.evtsrc or opts.evtchunks:
+            evtlines = IndexMerge.tee( IndexMerge.merge( IndexMerge.expand( opts.evtsrc or [] ), 'EVT',
+                                                         IndexMerge.expand( opts.evtchunks or [] ) ), opts.evtidx )
+        else:
+            evtlines = open( opts.evtidx )
+
         # create DgmIdx objects for each line in the input file
         dgmlists = defaultdict( list )
         seglists = defaultdict( list )
-        for dgmstr in open( opts.dgmidx ):
+        for dgmstr in dgmlines:
             didx = DgmIdx( dgmstr )
             _log.info("%s", dgmstr[:60]);
             if len( dgmlists[ didx.apid ] ) > 0:
@@ -294,6 +391,8 @@ if __name__ == '__main__':
         else:
             if len( seglists.keys() ) != 2:
                 _log.warning( 'Found apid segments for %s, cannot merge!' % str(seglists.keys()) )
+                # make sure the merged event index still gets written
+                for estr in evtlines: pass
                 return 0
             acqtype = 'LPA'
             _log.info( 'generating list of output spans for LPA data' )
@@ -356,9 +455,19 @@ if __name__ == '__main__':
                 gapstart = span[1]
             ofd_evtgap.close()
 
-        # get the list of spans already merged
+        # get the list of spans already merged, from the registry if there is one
         donespans = []
-        if opts.basedir:
+        registry = None
+        if opts.basedir and SpanRegistry is not None:
+            registry = SpanRegistry.open_registry( opts.basedir, opts.registry )
+        if registry is not None and not opts.noregistry:
+            delivered = registry.delivered( startedAt, exclude=opts.downlink )
+            donespans = delivered.spans
+            for span in newspans:
+                overlap = delivered.overlapping( *span )
+                if overlap: _log.info( 'mergeable span %s overlaps delivered spans %s' % ( span, overlap ) )
+            if donespans: _log.info( 'list of previously-delivered spans: %s' % pprint.pformat( donespans, indent=5) )
+        elif opts.basedir:
             for spanfile in glob.glob( os.path.join( opts.basedir, '*/*/r%010d-spans.txt' % startedAt ) ):
                 # skip any file from a previous execution in our current location
                 if os.path.split( os.path.split( os.path.abspath( spanfile ) )[0] )[0] == os.path.abspath( os.path.join( opts.basedir, opts.downlink ) ):
@@ -371,10 +480,46 @@ if __name__ == '__main__':
 
         # now write out the index of merged, undelivered events
         _log.info( 'found %d event spans for output' % len(newspans) )
+        if numpy is not None and not opts.loop:
+            nmerged, norphaned, mergespans = merge_columnar( opts, startedAt, evtlines, newspans, donespans )
+        else:
+            nmerged, norphaned, mergespans = merge_loop( opts, startedAt, evtlines, newspans, donespans )
+
+        # save the merged event spans, and register them even when they
+        # were looked up from the span files, so that the registry stays complete
+        spanfile = os.path.join( opts.outdir, 'r%010d-spans.txt' % startedAt )
+        ofd_spans = open( spanfile, 'w' )
+        cPickle.dump( mergespans, ofd_spans )
+        ofd_spans.close()
+        if registry is not None:
+            registry.register( startedAt, opts.downlink, mergespans, spanfile )
+            registry.close()
+
+        # write the delivery-summary file
+        ofd_summ = open( os.path.join( opts.outdir, 'r%010d-delivered.txt' % startedAt ), 'w' )
+        print >> ofd_summ, 'r%010d %d %d %s' % ( startedAt, nmerged, norphaned, acqtype )
+        ofd_summ.close()
+
+        # if the number of orphans exceeds the number of events successfully merged,
+        # something is most likely wrong with the downlink, so emit a warning into the
+        # central log.
+        if norphaned >= nmerged:
+            msg = 'more events orphaned than merged (%d >= %d) for r%010d (%08x) in %s' % \
+                  ( norphaned, nmerged, startedAt, startedAt, opts.downlink )
+            _log.warning( msg )
+            Log.warn( 'halfPipe.mergeEvt.orphans', msg, tgt=opts.downlink )
+        else:
+            _log.info( 'merged %d events with %d orphans for r%010d in %s' % ( nmerged, norphaned, startedAt, opts.downlink ) )
+
+            
+    def merge_loop( opts, startedAt, evtlines, newspans, donespans ):
+        """!@brief write the merged-event index files one event at a time
+        @return Tuple of ( events merged into the last output file, events orphaned, merged spans ).
+        """
         mergespans = []
         nevt = nmerged = norphaned = nskipped = 0
         ofd_merge = None
-        iter_eidx = itertools.chain( open( opts.evtidx ) )
+        iter_eidx = itertools.chain( evtlines )
         iter_done = itertools.chain( donespans )
         iter_span = itertools.chain( newspans )
         e0 = e1 = -1
@@ -456,26 +601,159 @@ if __name__ == '__main__':
             # bottom of the output loop
             pass
 
-        # save the merged event spans
-        cPickle.dump( mergespans, open( os.path.join( opts.outdir, 'r%010d-spans.txt' % startedAt ), 'w' ) )
-
-        # write the delivery-summary file
-        ofd_summ = open( os.path.join( opts.outdir, 'r%010d-delivered.txt' % startedAt ), 'w' )
-        print >> ofd_summ, 'r%010d %d %d %s' % ( startedAt, nmerged, norphaned, acqtype )
-        ofd_summ.close()
-
-        # if the number of orphans exceeds the number of events successfully merged,
-        # something is most likely wrong with the downlink, so emit a warning into the
-        # central log.
-        if norphaned >= nmerged:
-            msg = 'more events orphaned than merged (%d >= %d) for r%010d (%08x) in %s' % \
-                  ( norphaned, nmerged, startedAt, startedAt, opts.downlink )
-            _log.warning( msg )
-            Log.warn( 'halfPipe.mergeEvt.orphans', msg, tgt=opts.downlink )
+        return nmerged, norphaned, mergespans
+
+
+    def merge_columnar( opts, startedAt, evtlines, newspans, donespans ):
+        """!@brief write the merged-event index files, classifying all events at once
+        @return Tuple of ( events merged into the last output file, events orphaned, merged spans ).
+
+        Produces the same output as merge_loop.  The event index is read once to
+        collect the sequence numbers, every event is classified with classify(),
+        and then each contiguous run of merged events is copied from the event
+        index to its own output file.
+        """
+        # collect the sequence number and line length of each event.  The
+        # lines themselves are re-read from opts.evtidx, which evtlines either
+        # is or writes.
+        seqlist = array.array( 'l' )
+        lenlist = array.array( 'l' )
+        for estr in evtlines:
+            seqlist.append( long( estr.split( None, 3 )[2] ) )
+            lenlist.append( len( estr ) )
+        nevt = len( seqlist )
+        _log.info( 'exhausted event index with %d events' % nevt )
+        if nevt == 0:
+            return 0, 0, []
+        seqs = numpy.frombuffer( seqlist, dtype=numpy.int_ ).astype( numpy.int64 )
+        if ( numpy.diff( seqs ) < 0 ).any():
+            _log.warning( 'event index is not ordered by sequence, falling back to per-event merging' )
+            return merge_loop( opts, startedAt, open( opts.evtidx ), newspans, donespans )
+        ofsts = numpy.zeros( nevt+1, dtype=numpy.int64 )
+        numpy.cumsum( numpy.frombuffer( lenlist, dtype=numpy.int_ ), out=ofsts[1:] )
+
+        # classify the events and find the runs of merged events
+        state = classify( seqs, newspans, donespans )
+        norphaned = int( ( state == ORPHANED ).sum() )
+        runs = merged_runs( state )
+        _log.info( 'classified %d events: %d merged in %d runs, %d delivered, %d orphaned' % \
+                   ( nevt, int( ( state == MERGED ).sum() ), len( runs ),
+                     int( ( state == DELIVERED ).sum() ), norphaned ) )
+
+        # note any merged events on the edges of the mergeable spans
+        if newspans:
+            edges = numpy.array( [ x for span in newspans for x in span ], dtype=numpy.int64 )
+            for seq in seqs[ ( state == MERGED ) & numpy.in1d( seqs, edges ) ].tolist():
+                _log.info( 'span-edge event at %010d.%020d' % ( startedAt, seq ) )
+
+        # copy each run of merged events to its own output file
+        mergespans = []
+        nmerged = 0
+        ifd = open( opts.evtidx )
+        for i0, i1 in runs:
+            merge0 = long( seqs[i0] )
+            merge1 = long( seqs[i1-1] )
+            ofd_merge = open( os.path.join( opts.outdir, 'r%010d-e%020d.idx' % (startedAt, merge0) ), 'w' )
+            _log.info( 'opening %s' % ofd_merge.name )
+            ifd.seek( ofsts[i0] )
+            for i in xrange( i0, i1 ):
+                print >> ofd_merge, str( EvtIdx( None, ifd.readline() ) )
+            ofd_merge.close()
+            nmerged = i1 - i0
+            _log.info( 'closing %s with %d merged in %s' % ( ofd_merge.name, nmerged, (merge0, merge1) ) )
+            mergespans.append( ( merge0, merge1 ) )
+        ifd.close()
+
+        # as in merge_loop, nmerged counts the events in the last output file
+        return nmerged, norphaned, mergespans
+
+    def run_lock( lockdir, rst ):
+        """!@brief create the lock/<rst> file for a run, as lockFile.sh does
+        @return Lock filename, or None if the run is already locked.
+        """
+        if not os.path.isdir( lockdir ):
+            try:
+                os.makedirs( lockdir )
+            except OSError:
+                pass
+        lockfile = os.path.join( lockdir, rst )
+        try:
+            os.close( os.open( lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL ) )
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+            return None
+        return lockfile
+
+    def merge_run( args ):
+        """!@brief merge a single run as mergeEvt.sh would, for use by merge_all
+        @param[in] args Tuple of ( options, hex run start ).
+        @return Tuple of ( hex run start, status, message ).
+        """
+        opts, rst = args
+        stream = '%d' % int( rst, 16 )
+        lockfile = run_lock( os.path.join( opts.basedir, 'lock' ), rst )
+        if lockfile is None:
+            _log.warning( 'run %s is locked, skipping' % rst )
+            return ( rst, 'LOCKED', 'lock/%s exists' % rst )
+        try:
+            try:
+                outdir = os.path.join( opts.indir, stream )
+                if os.path.isdir( outdir ):
+                    _log.info( 'removing existing directory %s' % outdir )
+                    shutil.rmtree( outdir )
+                os.mkdir( outdir )
+                runopts = copy.copy( opts )
+                runopts.outdir = outdir
+                runopts.dgmidx = os.path.join( outdir, 'dgm-%s.idx' % rst )
+                runopts.evtidx = os.path.join( outdir, 'evt-%s.idx' % rst )
+                runopts.dgmsrc = [ os.path.join( opts.basedir, '*', stream, 'dgm-%s.idx' % rst ) ]
+                runopts.dgmchunks = [ os.path.join( opts.indir, '*-%s-*.idx' % rst ) ]
+                runopts.evtsrc = [ os.path.join( opts.basedir, '*', stream, 'evt-%s.idx' % rst ) ]
+                runopts.evtchunks = [ os.path.join( opts.indir, '*-%s-*.idx' % rst ) ]
+                _log.info( 'merging run %s into %s' % ( rst, outdir ) )
+                merge( runopts )
+            except Exception, e:
+                _log.exception( 'failed to merge run %s' % rst )
+                return ( rst, 'FAILED', str( e ) )
+        finally:
+            os.unlink( lockfile )
+        return ( rst, 'MERGED', stream )
+
+    def merge_all( opts ):
+        """!@brief merge every run start found in a downlink directory in a pool of processes
+
+        Each run is merged into <indir>/<decimal runstart>, exactly as the
+        per-run mergeEvt.sh jobs do, while holding the same lock/<rst> file.
+        """
+        if not opts.basedir or not opts.downlink:
+            _log.error( 'merging all runs requires --basedir and --downlink' )
+            return 1
+        if not opts.indir:
+            opts.indir = os.path.join( opts.basedir, opts.downlink )
+        rsts = set()
+        for idxfile in glob.glob( os.path.join( opts.indir, '????????-????????-????-?????.idx' ) ):
+            rsts.add( os.path.basename( idxfile ).split( '-' )[1] )
+        rsts = sorted( rsts )
+        _log.info( 'found %d run starts in %s: %s' % ( len( rsts ), opts.indir, ' '.join( rsts ) ) )
+
+        work = [ ( opts, rst ) for rst in rsts ]
+        if opts.workers > 1 and len( work ) > 1:
+            pool = multiprocessing.Pool( min( opts.workers, len( work ) ) )
+            results = pool.map( merge_run, work, chunksize=1 )
+            pool.close()
+            pool.join()
         else:
-            _log.info( 'merged %d events with %d orphans for r%010d in %s' % ( nmerged, norphaned, startedAt, opts.downlink ) )
+            results = map( merge_run, work )
+
+        nfail = 0
+        for rst, status, msg in results:
+            _log.info( 'run %s: %s %s' % ( rst, status, msg ) )
+            if status != 'MERGED': nfail += 1
+        if nfail:
+            _log.error( '%d of %d runs were not merged' % ( nfail, len( results ) ) )
+            return 1
+        return 0
 
-            
     def main():
 
         # set basic logging configuration
@@ -489,6 +767,14 @@ if __name__ == '__main__':
                            help='file of decoded-datagram index records' )
         parser.add_option( '-e', '--evtidx', 
                            help='file of decoded-event index records' )
+        parser.add_option( '--dgmsrc', action='append',
+                           help='sorted index file or pattern to merge into the datagram index (may be repeated)' )
+        parser.add_option( '--evtsrc', action='append',
+                           help='sorted index file or pattern to merge into the event index (may be repeated)' )
+        parser.add_option( '--dgmchunks', action='append',
+                           help='unsorted per-chunk index file or pattern to merge into the datagram index (may be repeated)' )
+        parser.add_option( '--evtchunks', action='append',
+                           help='unsorted per-chunk index file or pattern to merge into the event index (may be repeated)' )
         parser.add_option( '-b', '--basedir',
                            help='base directory for downlink processing' )
         parser.add_option( '-o', '--outdir', default='.',
@@ -497,17 +783,30 @@ if __name__ == '__main__':
                            help='directory with list of forced (known-incomplete) runs' )
         parser.add_option( '--merge', dest='action', action='store_const', const=merge,
                            help='merge event index according to datagram index' )
+        parser.add_option( '--merge-all', dest='action', action='store_const', const=merge_all,
+                           help='merge every run start in the downlink directory' )
         parser.add_option( '-l', '--downlink', 
                            help='Downlink ID' )
+        parser.add_option( '-i', '--indir',
+                           help='downlink directory for --merge-all (default basedir/downlink)' )
+        parser.add_option( '-w', '--workers', type='int', default=4,
+                           help='number of runs to merge at once with --merge-all (%default)' )
+        parser.add_option( '--registry',
+                           help='delivered-span registry file (default basedir/delivered-spans.db)' )
+        parser.add_option( '--noregistry', action='store_true', default=False,
+                           help='find delivered spans from the span files instead of the registry; '
+                                'the merged spans are still registered (%default)' )
+        parser.add_option( '--loop', action='store_true', default=False,
+                           help='classify events one at a time instead of by column (%default)' )
         opts, args = parser.parse_args()
 
         # invoke the requested action
         if opts.action:
-            opts.action( opts )
+            return opts.action( opts )
         else:
             _log.warning( 'no action specified, nothing to do' )
 
-    main()
+    sys.exit( main() )
 
 
                              
@@ -55,6 +55,8 @@ if rows:
         cleanfiles = []
         cleanfiles += glob.glob( os.path.join( r.outbase, '*-%08x-*.evt' % r.startedat ) )
         cleanfiles += glob.glob( os.path.join( r.outbase, '*-%08x-*.idx' % r.startedat ) )
+        cleanfiles += glob.glob( os.path.join( r.outbase, '*-%08x-*.idxb' % r.startedat ) )
+        cleanfiles += glob.glob( os.path.join( r.outbase, '*-%08x-*.stats.json' % r.startedat ) )
         cleanfiles += glob.glob( os.path.join( r.outbase, '*', '*-%08x.idx' % r.startedat ) )
         cleanfiles += glob.glob( os.path.join( r.outbase, '*', 'r%010d-e*.idx' % r.startedat ) )
 
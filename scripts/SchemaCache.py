@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""Per-process cache of reflected database tables."""
+
+## @namespace SchemaCache
+#  @brief Reflect each database table at most once per process, and
+#  optionally reuse the reflected columns across processes.
+#
+#  Reflecting a table with SA.Table( ..., autoload=True ) takes several
+#  catalog queries.  table() returns the table already defined in the
+#  metadata if there is one, then a table rebuilt from the local cache file
+#  (see use()), and only reflects it from the database as a last resort.
+#
+#  The cache file holds the column names, types, primary-key and null flags
+#  of each table reflected through it, keyed by database and table name,
+#  together with the format and schema versions it was written with.  A
+#  cache written with a different version is ignored, so bumping
+#  SCHEMA_VERSION (or passing a different version to use()) forces every
+#  table to be reflected again.
+#
+#  Each cached table also carries a fingerprint of the columns the
+#  database reports for it (see fingerprint()), taken with a single query
+#  that returns no rows.  Before a cached table is used its fingerprint is
+#  taken again, and if a column has been added, dropped, renamed or
+#  retyped since, the table is reflected again and the cache updated.
+
+import cPickle, hashlib, logging, os
+
+import sqlalchemy as SA
+
+_log = logging.getLogger()
+
+## version of the cache-file layout
+CACHE_FORMAT = 2
+
+## default schema version; change it when the reflected tables change
+SCHEMA_VERSION = 1
+
+_cachefile = None
+_version = SCHEMA_VERSION
+_columns = {}
+
+def dbkey( db ):
+    """!@brief identify a database connection without its password"""
+    url = db.engine.url
+    return '%s://%s@%s/%s' % ( url.drivername, url.username, url.host, url.database )
+
+def use( cachefile, version = SCHEMA_VERSION ):
+    """!@brief read (and later update) reflected columns in a local cache file
+    @param[in] cachefile Pickle file of reflected columns.
+    @param[in] version Schema version the cache must have been written with.
+    """
+    global _cachefile, _version, _columns
+    _cachefile = cachefile
+    _version = version
+    _columns = {}
+    if not os.path.exists( cachefile ):
+        return
+    try:
+        cache = cPickle.load( open( cachefile, 'rb' ) )
+    except Exception, e:
+        _log.warning( 'SchemaCache::use: ignoring unreadable cache %s: %s' % ( cachefile, e ) )
+        return
+    if cache.get( 'format' ) != CACHE_FORMAT or cache.get( 'version' ) != version:
+        _log.info( 'SchemaCache::use: ignoring cache %s with format %s version %s' % \
+                   ( cachefile, cache.get( 'format' ), cache.get( 'version' ) ) )
+        return
+    _columns = cache[ 'tables' ]
+    _log.info( 'SchemaCache::use: loaded %d table definitions from %s' % ( len( _columns ), cachefile ) )
+
+def save():
+    """!@brief write the reflected columns to the cache file, if there is one"""
+    if not _cachefile:
+        return
+    tmpfile = '%s.%d.tmp' % ( _cachefile, os.getpid() )
+    try:
+        ofd = open( tmpfile, 'wb' )
+        cPickle.dump( { 'format' : CACHE_FORMAT, 'version' : _version, 'tables' : _columns }, ofd, 2 )
+        ofd.close()
+        os.rename( tmpfile, _cachefile )
+    except EnvironmentError, e:
+        _log.warning( 'SchemaCache::save: cannot write %s: %s' % ( _cachefile, e ) )
+
+def fingerprint( db, name ):
+    """!@brief hash of the columns of a database table as its driver describes them
+    @param[in] db A DbConfig object.
+    @param[in] name Table name.
+    """
+    result = db.engine.execute( 'SELECT * FROM %s WHERE 1 = 0' % name )
+    try:
+        desc = [ ( str( x[0] ).lower(), ) + tuple( x[1:] ) for x in result.cursor.description ]
+    finally:
+        result.close()
+    return hashlib.md5( repr( desc ) ).hexdigest()
+
+def table( db, name ):
+    """!@brief the SA.Table for a database table, reflecting it only if necessary
+    @param[in] db A DbConfig object.
+    @param[in] name Table name.
+    """
+    if name in db.metadata.tables:
+        return db.metadata.tables[ name ]
+
+    key = ( dbkey( db ), name )
+    current = None
+    if key in _columns:
+        cached, columns = _columns[ key ]
+        current = fingerprint( db, name )
+        if current != cached:
+            _log.info( 'SchemaCache::table: columns of %s have changed since they were cached' % name )
+        else:
+            try:
+                return SA.Table( name, db.metadata,
+                                 *[ SA.Column( cname, ctype, primary_key=pkey, nullable=nullable )
+                                    for cname, ctype, pkey, nullable in columns ] )
+            except Exception, e:
+                _log.warning( 'SchemaCache::table: cannot rebuild %s from cache: %s' % ( name, e ) )
+                if name in db.metadata.tables:
+                    db.metadata.remove( db.metadata.tables[ name ] )
+
+    tbl = SA.Table( name, db.metadata, autoload=True )
+    _log.info( 'SchemaCache::table: reflected %s' % name )
+    if current is None:
+        current = fingerprint( db, name )
+    _columns[ key ] = ( current, [ ( c.name, c.type, c.primary_key, c.nullable ) for c in tbl.columns ] )
+    save()
+    return tbl
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""Registry of event spans already delivered for each acquisition."""
+
+## @namespace SpanRegistry
+#  @brief Indexed record of the event spans delivered by each downlink.
+#
+#  MergeDatagrams writes the list of event spans it delivers for a run to
+#  <outbase>/<downlink>/<stream>/r<rst>-spans.txt (a pickled list of
+#  (seq0, seq1) tuples), and each later merge of the same run has to find
+#  and load every one of those files to avoid re-delivering events.  The
+#  registry keeps the same information in a single SQLite file in the
+#  output base, indexed on run start, so the lookup does not depend on the
+#  number of downlink directories retained.
+#
+#  The first time a registry is opened it is backfilled from the existing
+#  pickle files; that is the only time the span files are globbed.  After
+#  that the registry is authoritative: MergeDatagrams registers each run's
+#  spans as it delivers them (also with --noregistry, which only changes
+#  where the delivered spans are looked up), and a downlink that is rolled
+#  back or deleted must be dropped from it (drop(), or --drop on the
+#  command line).  The pickle files are still written, so a --backfill
+#  can always rebuild the registry from them; it reloads only the span
+#  files changed since they were registered and drops downlinks whose span
+#  files are gone.
+
+import bisect, cPickle, glob, logging, os, sqlite3
+
+_log = logging.getLogger()
+
+## default registry filename, relative to the output base
+REGISTRY_NAME = 'delivered-spans.db'
+
+## seconds to wait for another process's lock on the registry
+LOCK_TIMEOUT = 300.0
+
+_SCHEMA = ( "CREATE TABLE IF NOT EXISTS spans ( runstart INTEGER NOT NULL, downlink TEXT NOT NULL, "
+            "seq0 INTEGER NOT NULL, seq1 INTEGER NOT NULL )",
+            "CREATE INDEX IF NOT EXISTS spans_run ON spans ( runstart, seq0 )",
+            "CREATE INDEX IF NOT EXISTS spans_downlink ON spans ( downlink, runstart )",
+            "CREATE TABLE IF NOT EXISTS registry ( name TEXT PRIMARY KEY, value TEXT )",
+            "CREATE TABLE IF NOT EXISTS imports ( runstart INTEGER NOT NULL, downlink TEXT NOT NULL, "
+            "mtime REAL NOT NULL, PRIMARY KEY ( runstart, downlink ) )",
+            )
+
+def _spanfiles( basedir ):
+    # Map (runstart, downlink) to the list of span files under basedir
+    # (normally one, but a downlink may have merged a run in several streams).
+    files = {}
+    for spanfile in glob.glob( os.path.join( basedir, '*', '*', 'r??????????-spans.txt' ) ):
+        downlink = os.path.basename( os.path.dirname( os.path.dirname( spanfile ) ) )
+        rst = int( os.path.basename( spanfile )[1:11] )
+        files.setdefault( ( rst, downlink ), [] ).append( spanfile )
+    return files
+
+class SpanTree( object ):
+    """!@brief static interval tree over a list of (first, last) spans
+
+    The spans are kept sorted by first sequence number alongside the running
+    maximum of their last sequence numbers, so that both membership and
+    overlap queries are a binary search.
+    """
+    def __init__( self, spans ):
+        self.spans = sorted( spans )
+        self.__starts = [ x[0] for x in self.spans ]
+        self.__reach = []
+        reach = None
+        for x in self.spans:
+            reach = x[1] if reach is None else max( reach, x[1] )
+            self.__reach.append( reach )
+
+    def __len__( self ):
+        return len( self.spans )
+
+    def __nonzero__( self ):
+        return len( self.spans ) > 0
+
+    def overlapping( self, first, last ):
+        """!@brief spans sharing at least one sequence number with [first, last]"""
+        i0 = bisect.bisect_left( self.__reach, first )
+        i1 = bisect.bisect_right( self.__starts, last )
+        return [ x for x in self.spans[i0:i1] if x[1] >= first ]
+
+    def contains( self, seq ):
+        """!@brief is seq within any span?"""
+        return len( self.overlapping( seq, seq ) ) > 0
+
+class SpanRegistry( object ):
+    """!@brief SQLite-backed registry of delivered event spans"""
+
+    def __init__( self, dbfile, timeout=LOCK_TIMEOUT ):
+        """!@brief open (and create, if necessary) a span registry
+        @param[in] dbfile Registry filename.
+        @param[in] timeout Seconds to wait for a lock held by another process.
+        """
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect( dbfile, timeout=timeout, isolation_level=None )
+        for stmt in _SCHEMA:
+            self.conn.execute( stmt )
+
+    def close( self ):
+        self.conn.close()
+
+    def __getvalue( self, name ):
+        row = self.conn.execute( "SELECT value FROM registry WHERE name = ?", ( name, ) ).fetchone()
+        return row[0] if row else None
+
+    def backfilled( self ):
+        """!@brief has this registry been loaded from the existing pickle files?"""
+        return self.__getvalue( 'backfilled' ) is not None
+
+    def backfill( self, basedir, force=False ):
+        """!@brief load all r*-spans.txt files found under basedir into the registry
+        @param[in] basedir Output base containing <downlink>/<stream>/r<rst>-spans.txt files.
+        @param[in] force Reconcile even if the registry has already been backfilled.
+        @return Tuple of the numbers of span files loaded and of downlink runs dropped.
+
+        Span files not modified since their spans were registered are
+        skipped, and runs of downlinks with no span file left are dropped.
+        """
+        self.conn.execute( "BEGIN IMMEDIATE" )
+        try:
+            if self.backfilled() and not force:
+                self.conn.execute( "COMMIT" )
+                return 0, 0
+            files = _spanfiles( basedir )
+            known = dict( ( ( x[0], x[1] ), x[2] ) for x in
+                          self.conn.execute( "SELECT runstart, downlink, mtime FROM imports" ) )
+            registered = set( self.conn.execute( "SELECT DISTINCT runstart, downlink FROM spans" ) )
+            ndrop = 0
+            for runstart, downlink in ( registered | set( known ) ) - set( files ):
+                self.__drop( runstart, downlink )
+                ndrop += 1
+            nfile = 0
+            for ( runstart, downlink ), spanfiles in files.iteritems():
+                mtime = max( os.path.getmtime( x ) for x in spanfiles )
+                if known.get( ( runstart, downlink ), -1.0 ) >= mtime:
+                    continue
+                nfile += self.__load( runstart, downlink, spanfiles )
+            self.conn.execute( "INSERT OR REPLACE INTO registry ( name, value ) VALUES ( 'backfilled', ? )",
+                               ( os.path.abspath( basedir ), ) )
+            self.conn.execute( "COMMIT" )
+        except:
+            self.conn.execute( "ROLLBACK" )
+            raise
+        _log.info( 'SpanRegistry::backfill: loaded %d span files from %s, dropped %d downlink runs' % \
+                   ( nfile, basedir, ndrop ) )
+        return nfile, ndrop
+
+    def __load( self, runstart, downlink, spanfiles ):
+        # Replace the spans of a run and downlink with those in its span
+        # files, noting the files' modification time.  Return the number
+        # of files loaded.
+        spans = []
+        mtime = 0.0
+        for spanfile in spanfiles:
+            try:
+                mtime = max( mtime, os.path.getmtime( spanfile ) )
+                spans.extend( cPickle.load( open( spanfile ) ) )
+            except Exception, e:
+                _log.warning( 'SpanRegistry: cannot load %s: %s' % ( spanfile, e ) )
+                return 0
+        self.__replace( runstart, downlink, spans, mtime )
+        return len( spanfiles )
+
+    def __replace( self, runstart, downlink, spans, mtime ):
+        self.conn.execute( "DELETE FROM spans WHERE runstart = ? AND downlink = ?", ( runstart, downlink ) )
+        self.conn.executemany( "INSERT INTO spans ( runstart, downlink, seq0, seq1 ) VALUES ( ?, ?, ?, ? )",
+                               [ ( runstart, downlink, long( x[0] ), long( x[1] ) ) for x in spans ] )
+        self.conn.execute( "INSERT OR REPLACE INTO imports ( runstart, downlink, mtime ) VALUES ( ?, ?, ? )",
+                           ( runstart, downlink, mtime ) )
+
+    def __drop( self, runstart, downlink ):
+        self.conn.execute( "DELETE FROM spans WHERE runstart = ? AND downlink = ?", ( runstart, downlink ) )
+        self.conn.execute( "DELETE FROM imports WHERE runstart = ? AND downlink = ?", ( runstart, downlink ) )
+
+    def register( self, runstart, downlink, spans, spanfile ):
+        """!@brief record the spans delivered for a run by a downlink
+        @param[in] runstart Acquisition start time.
+        @param[in] downlink Downlink ID.
+        @param[in] spans List of (first, last) event sequence numbers.
+        @param[in] spanfile The span file just written with the same spans.
+
+        Any spans previously registered for the same run and downlink (e.g.
+        from an earlier execution of the same merge) are replaced.  The
+        span file's modification time is recorded, so that a later
+        backfill knows it is already loaded.
+        """
+        mtime = os.path.getmtime( spanfile )
+        self.conn.execute( "BEGIN IMMEDIATE" )
+        try:
+            self.__replace( runstart, str( downlink ), spans, mtime )
+            self.conn.execute( "COMMIT" )
+        except:
+            self.conn.execute( "ROLLBACK" )
+            raise
+        _log.info( 'SpanRegistry::register: %d spans for r%010d in %s' % ( len( spans ), runstart, downlink ) )
+
+    def drop( self, downlink, runstart=None ):
+        """!@brief forget the spans of a downlink that was rolled back or deleted
+        @param[in] downlink Downlink ID.
+        @param[in] runstart Acquisition start time (default all of the downlink's runs).
+        @return Number of runs dropped.
+        """
+        downlink = str( downlink )
+        self.conn.execute( "BEGIN IMMEDIATE" )
+        try:
+            if runstart is None:
+                runstarts = set( x[0] for x in self.conn.execute(
+                    "SELECT runstart FROM imports WHERE downlink = ? "
+                    "UNION SELECT runstart FROM spans WHERE downlink = ?", ( downlink, downlink ) ) )
+            else:
+                runstarts = [ runstart ]
+            for rst in runstarts:
+                self.__drop( rst, downlink )
+            self.conn.execute( "COMMIT" )
+        except:
+            self.conn.execute( "ROLLBACK" )
+            raise
+        _log.info( 'SpanRegistry::drop: %d runs of %s' % ( len( runstarts ), downlink ) )
+        return len( runstarts )
+
+    def delivered( self, runstart, exclude=None ):
+        """!@brief spans already delivered for a run
+        @param[in] runstart Acquisition start time.
+        @param[in] exclude Downlink ID whose spans should be ignored (normally the current one).
+        @return SpanTree of (first, last) spans.
+        """
+        if exclude is None:
+            rows = self.conn.execute( "SELECT seq0, seq1 FROM spans WHERE runstart = ? ORDER BY seq0",
+                                      ( runstart, ) )
+        else:
+            rows = self.conn.execute( "SELECT seq0, seq1 FROM spans WHERE runstart = ? AND downlink != ? "
+                                      "ORDER BY seq0", ( runstart, str( exclude ) ) )
+        return SpanTree( [ ( long( x[0] ), long( x[1] ) ) for x in rows ] )
+
+def open_registry( basedir, dbfile=None ):
+    """!@brief open the span registry for an output base, backfilling it if new
+    @param[in] basedir Output base directory.
+    @param[in] dbfile Registry filename (default basedir/REGISTRY_NAME).
+    """
+    if not dbfile:
+        dbfile = os.path.join( basedir, REGISTRY_NAME )
+    reg = SpanRegistry( dbfile )
+    if not reg.backfilled():
+        _log.info( 'backfilling span registry %s from %s' % ( dbfile, basedir ) )
+        reg.backfill( basedir )
+    return reg
+
+if __name__ == '__main__':
+
+    import pprint, sys
+
+    from quarks.cmdline.xoptparse import OptionParser
+
+    def main():
+        # set basic logging configuration
+        logging.basicConfig( format='%(asctime)s.%(msecs)03d %(levelname)-8s %(name)s: %(message)s',
+                             datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stdout )
+        logging.getLogger().setLevel( logging.INFO )
+
+        # parse command-line args
+        parser = OptionParser( usage='usage: %prog [options] -b basedir [runstart ...]' )
+        parser.add_option( '-b', '--basedir',
+                           help='output base directory' )
+        parser.add_option( '--registry',
+                           help='registry filename (default basedir/%s)' % REGISTRY_NAME )
+        parser.add_option( '--backfill', action='store_true', default=False,
+                           help='reconcile the registry with the existing span files' )
+        parser.add_option( '--drop', metavar='DOWNLINK',
+                           help='forget the spans of a rolled-back or deleted downlink (for the given runs, or all)' )
+        parser.add_option( '-x', '--exclude',
+                           help='downlink ID to exclude from the listing' )
+        opts, args = parser.parse_args()
+        if not opts.basedir:
+            parser.error( 'no output base directory specified' )
+
+        reg = SpanRegistry( opts.registry or os.path.join( opts.basedir, REGISTRY_NAME ) )
+        if opts.backfill or not reg.backfilled():
+            reg.backfill( opts.basedir, force=True )
+        if opts.drop:
+            if args:
+                for rst in args:
+                    reg.drop( opts.drop, int( rst ) )
+            else:
+                reg.drop( opts.drop )
+            reg.close()
+            return 0
+        for rst in args:
+            tree = reg.delivered( int( rst ), exclude=opts.exclude )
+            print 'r%010d: %s' % ( int( rst ), pprint.pformat( tree.spans ) )
+        reg.close()
+        return 0
+
+    sys.exit( main() )
@@ -61,6 +61,12 @@ for extension in ['.evt','.idx','.txt']:
     print (cmd)
     if run: os.system(cmd)
 
+# forget the event spans delivered by the earlier processing of the
+# downlink (the span registry is not rescanned for removed span files):
+cmd='python %s/scripts/SpanRegistry.py -b %s --drop %s' % (options['taskBase'],options['outputBase'],options['downlinkID'])
+print (cmd)
+if run: os.system(cmd)
+
 # remove locks:
 cmd='rm -rf %s/lock/halfpipe-%s' % (options['outputBase'],options['downlinkID'])
 print (cmd)
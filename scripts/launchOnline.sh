@@ -71,7 +71,8 @@ for f in `cat launch.txt`; do
     rstx=`basename $f .evt | awk -F- '{print $2}'`
     echo "trying to map $rstx..."
     rm -f aq_${rstx}.txt
-    ${taskBase}/scripts/AcqToAlgAndQueue.py --scid ${scid} --started 0x${rstx} -o aq_${rstx}.txt || exit 1
+    ${taskBase}/scripts/AcqToAlgAndQueue.py --scid ${scid} --started 0x${rstx} -o aq_${rstx}.txt \
+	--schemacache ${HALFPIPE_OUTPUTBASE}/schema-cache.pkl || exit 1
     if [ ! -f aq_${rstx}.txt ] ; then
 	echo "no key/alg/queue mapping for $rstx, removing $f"
 	rm -f $f
@@ -39,30 +39,270 @@ import quarks.legal.copyright
 #  We keep track of the run involved (there should be just one) by
 #  looking for lines beginning with "getLSEChunk: processing" since
 #  they contain the run number in hex.
+#
+#  A bad chunk can produce many thousands of identical exceptions, so
+#  they are counted in buckets by source, run and message template
+#  (the message with its numbers replaced by '#'). Only the first
+#  FIRST exceptions of a bucket are posted as they are; after that a
+#  halfPipe.chunkExceptionSummary message with the bucket's count is
+#  posted at most every INTERVAL seconds (checked as each line arrives),
+#  and once more at the end of the input. The totals go to the
+#  pipeline summary file, if there is one.
+#
+#  Other getLSEChunk progress lines are counted by their first word (see
+#  ChunkStats). At the end of the input these counts, the run breakdown of each
+#  of the chunk's per-run index files in $HP_OUTPUTDIR and the decode
+#  time and throughput are written as JSON to a .stats.json file next to
+#  each .idx file, and the chunk's totals go to the pipeline summary.
 
 
-import re, sys
+import glob, json, os, re, sys, time
 
 from ISOC import Log
 
+import IndexReader
+
+## Exceptions of each bucket posted individually.
+FIRST = 10
+
+## Minimum seconds between summaries of the same bucket.
+INTERVAL = 60.0
+
+## Exception sources, as they appear in the messages.
+SOURCES = ("DFI", "PktFile", "PktRetriever")
+
 def main(downlinkid, chunkid):
+    # Read line by line rather than with the file iterator's read-ahead
+    # and echo without buffering, so that the output keeps pace with
+    # getLSEChunk.exe.
     infile = sys.stdin
-    redflag = re.compile(r"\b(?:DFI|PktFile|PktRetriever)\s+exception\b")
+    outfile = os.fdopen(sys.stdout.fileno(), "w", 0)
+    redflag = re.compile(r"\b(%s)\s+exception\b" % "|".join(SOURCES))
     runline = re.compile(r"getLSEChunk: processing\s+[0-9A-Fa-f]+-([0-9A-Fa-f]+)-")
     run = "?"
-    for line in infile:
-        print line,
+    reporter = ExceptionReporter(downlinkid, chunkid)
+    stats = ChunkStats(downlinkid, chunkid)
+    for line in iter(infile.readline, ""):
+        outfile.write(line)
+        stats.lines += 1
+        reporter.tick()
         match = runline.match(line)
         if match:
             run = int(match.group(1), 16)
+            stats.runs[run] = stats.runs.get(run, 0) + 1
         match = redflag.search(line)
         if match:
-            logError(line.strip(), downlinkid, chunkid, str(run))
+            reporter.report(match.group(1), str(run), line.strip())
+        elif line.startswith("getLSEChunk:"):
+            stats.progress(line)
+    reporter.finish()
+    stats.finish(os.environ.get("HP_OUTPUTDIR"), reporter.totals())
     return 0
 
-def logError(text, downlinkid, chunkid, run):
+def logError(text, downlinkid, chunkid, run, evnt="halfPipe.chunkException"):
     tag = "downlink=%s;chunk=%s;run=%s" % (downlinkid, chunkid, run)
-    Log.error("halfPipe.chunkException", text, tgt=tag)
+    Log.error(evnt, text, tgt=tag)
+
+def template(text):
+    # The message with its numbers (decimal or hex, with or without 0x)
+    # replaced by '#', so that exceptions differing only in addresses,
+    # counts or times fall into the same bucket.
+    return _NUMBER.sub("#", text)
+
+_NUMBER = re.compile(r"\b(?:0[xX])?[0-9A-Fa-f]*[0-9][0-9A-Fa-f]*\b")
+
+class ExceptionReporter(object):
+    # Count exceptions in buckets keyed by (source, run, template), post
+    # the first few of each bucket and summaries of the rest.
+
+    def __init__(self, downlinkid, chunkid, first=FIRST, interval=INTERVAL):
+        self.downlinkid = downlinkid
+        self.chunkid = chunkid
+        self.first = first
+        self.interval = interval
+        # bucket key -> [count, count at the last summary, time of the last summary]
+        self.buckets = {}
+        self.nextTick = 0.0
+
+    def report(self, source, run, text):
+        key = (source, run, template(text))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [0, 0, time.time()]
+        bucket[0] += 1
+        if bucket[0] <= self.first:
+            logError(text, self.downlinkid, self.chunkid, run)
+            bucket[1] = bucket[0]
+        elif time.time() - bucket[2] >= self.interval:
+            self.summarize(key, bucket)
+
+    def tick(self):
+        # Post the summaries that have come due in any bucket, including
+        # ones no exception has arrived in since. Called for every input
+        # line, so the buckets are looked at no more than once a second.
+        now = time.time()
+        if now < self.nextTick:
+            return
+        self.nextTick = now + 1.0
+        for key in sorted(self.buckets):
+            bucket = self.buckets[key]
+            if bucket[0] > bucket[1] and now - bucket[2] >= self.interval:
+                self.summarize(key, bucket)
+
+    def summarize(self, key, bucket):
+        # Post the number of exceptions in a bucket not yet posted.
+        source, run, text = key
+        logError("%d more %s exceptions (%d in all) like: %s" %
+                 (bucket[0] - bucket[1], source, bucket[0], text),
+                 self.downlinkid, self.chunkid, run,
+                 evnt="halfPipe.chunkExceptionSummary")
+        bucket[1] = bucket[0]
+        bucket[2] = time.time()
+
+    def finish(self):
+        # Summarize what's left in every bucket and write the totals to
+        # the pipeline summary.
+        for key in sorted(self.buckets):
+            bucket = self.buckets[key]
+            if bucket[0] > bucket[1]:
+                self.summarize(key, bucket)
+        totals = self.totals()
+        setVariable("chunkExceptions", sum(totals.values()))
+        for source in SOURCES:
+            setVariable("chunkExceptions%s" % source, totals[source])
+        setVariable("chunkExceptionBuckets", len(self.buckets))
+
+    def totals(self):
+        # Number of exceptions from each source.
+        totals = dict((source, 0) for source in SOURCES)
+        for (source, run, text), bucket in self.buckets.iteritems():
+            totals[source] += bucket[0]
+        return totals
+
+class ChunkStats(object):
+    # Running counters for the decoding of one chunk.
+    #
+    # Progress lines ("getLSEChunk: ...") are counted by their first
+    # word; the numbers in them are not interpreted, since their formats
+    # aren't fixed. The lines saying which run is being processed are
+    # counted per run.
+
+    def __init__(self, downlinkid, chunkid):
+        self.downlinkid = downlinkid
+        self.chunkid = chunkid
+        self.started = time.time()
+        self.lines = 0
+        self.steps = {}
+        self.runs = {}
+
+    def progress(self, line):
+        text = line[len("getLSEChunk:"):].strip()
+        words = text.split(None, 1)
+        if words:
+            self.steps[words[0]] = self.steps.get(words[0], 0) + 1
+
+    def indexStats(self, idxfile):
+        # Datagrams and events per run from the DGM records (one per
+        # datagram) of an index file, and the number of EVT records.
+        runs = {}
+        for line in IndexReader.records(idxfile, "DGM"):
+            fields = line.split()
+            run = runs.setdefault(fields[1], {"datagrams": 0, "events": 0})
+            run["datagrams"] += 1
+            if len(fields) > 20:
+                run["events"] += int(fields[20])
+        evtrecords = 0
+        for line in IndexReader.records(idxfile, "EVT"):
+            evtrecords += 1
+        return runs, evtrecords
+
+    def finish(self, outdir, exceptions):
+        # Write a JSON stats file next to each of the chunk's index files
+        # in outdir and add the chunk's totals to the pipeline summary.
+        seconds = time.time() - self.started
+        common = {"downlink": self.downlinkid,
+                  "chunk": self.chunkid,
+                  "seconds": round(seconds, 3),
+                  "lines": self.lines,
+                  "steps": self.steps,
+                  "processing": dict((str(run), n) for run, n in self.runs.iteritems()),
+                  "exceptions": exceptions,
+                  }
+        totals = {"indices": 0, "datagrams": 0, "events": 0, "evtBytes": 0}
+        runstarts = set()
+        idxfiles = []
+        if outdir:
+            idxfiles = chunkIndices(outdir, self.chunkid)
+        for idxfile in idxfiles:
+            try:
+                runs, evtrecords = self.indexStats(idxfile)
+            except EnvironmentError, e:
+                print >>sys.stderr, "Couldn't read %s: %s" % (idxfile, e)
+                continue
+            stats = dict(common)
+            stats["index"] = os.path.basename(idxfile)
+            stats["evtRecords"] = evtrecords
+            stats["runs"] = runs
+            stats["datagrams"] = sum(run["datagrams"] for run in runs.itervalues())
+            stats["events"] = sum(run["events"] for run in runs.itervalues())
+            stats["eventsPerSecond"] = round(stats["events"] / max(seconds, 1e-3), 1)
+            evtfile = os.path.splitext(idxfile)[0] + ".evt"
+            if os.path.exists(evtfile):
+                stats["evtBytes"] = os.path.getsize(evtfile)
+                stats["evtMBps"] = round(stats["evtBytes"] / 1e6 / max(seconds, 1e-3), 3)
+                totals["evtBytes"] += stats["evtBytes"]
+            writeJson(statsFile(idxfile), stats)
+            totals["indices"] += 1
+            totals["datagrams"] += stats["datagrams"]
+            totals["events"] += stats["events"]
+            runstarts.update(runs)
+
+        setVariable("chunkSeconds", "%.3f" % seconds)
+        setVariable("chunkIndices", totals["indices"])
+        if totals["indices"]:
+            setVariable("chunkEvtBytes", totals["evtBytes"])
+            setVariable("chunkDatagrams", totals["datagrams"])
+            setVariable("chunkEvents", totals["events"])
+            setVariable("chunkRuns", len(runstarts))
+        return totals
+
+def chunkIndices(outdir, chunkid):
+    # The per-run index files getLSEChunk.exe wrote for a chunk, named
+    # ????????-<run start>-????-<chunk ID>.idx.
+    return sorted(glob.glob(os.path.join(outdir, "????????-????????-????-%s.idx" % chunkid)))
+
+def statsFile(idxfile):
+    # The stats file for a chunk: foo.idx -> foo.stats.json
+    return os.path.splitext(idxfile)[0] + ".stats.json"
+
+def writeJson(filename, data):
+    # Write data as compact JSON, replacing filename in one step.
+    tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        f = open(tmpfile, "w")
+        try:
+            json.dump(data, f, sort_keys=True, separators=(",", ":"))
+            f.write("\n")
+        finally:
+            f.close()
+        os.rename(tmpfile, filename)
+    except EnvironmentError, e:
+        print >>sys.stderr, "Couldn't write %s: %s" % (filename, e)
+
+def setVariable(name, value):
+    # Append a variable to the pipeline summary file, as
+    # pipeline.setVariable() does, if we're running in the pipeline.
+    summary = os.environ.get("PIPELINE_SUMMARY")
+    if not summary:
+        return
+    try:
+        f = open(summary, "a")
+        try:
+            f.write("Pipeline.%s: %s\n" % (name, value))
+        finally:
+            f.close()
+    except EnvironmentError, e:
+        print >>sys.stderr, "Couldn't write %s to %s: %s" % (name, summary, e)
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
@@ -64,35 +64,19 @@ fi
 mkdir ${PIPELINE_STREAM}
 echo "created working directory ${PIPELINE_STREAM}"
 
-# make a single datagram-index file for this rst
-# include all datagrams previously decoded
-echo "creating datagram index"
-time grep -h ^DGM ${HALFPIPE_OUTPUTBASE}/*/${PIPELINE_STREAM}/dgm-${HALFPIPE_RUNSTART}.idx | \
-    sort > ${PIPELINE_STREAM}/dgm-previous-${HALFPIPE_RUNSTART}.tmp
-
-time grep -h ^DGM *-${HALFPIPE_RUNSTART}-*.idx | \
-    sort > ${PIPELINE_STREAM}/dgm-current-${HALFPIPE_RUNSTART}.tmp
-
-time sort -u -b -k 2n,2 -k 5n,5 -k 6n,6 ${PIPELINE_STREAM}/dgm-*-${HALFPIPE_RUNSTART}.tmp > ${PIPELINE_STREAM}/dgm-${HALFPIPE_RUNSTART}.idx
-rm -vf ${PIPELINE_STREAM}/dgm-*-${HALFPIPE_RUNSTART}.tmp
-
-# make a single event-index file for this rst
-# include all events previously decoded
-echo "creating event index"
-time grep -h ^EVT ${HALFPIPE_OUTPUTBASE}/*/${PIPELINE_STREAM}/evt-${HALFPIPE_RUNSTART}.idx | \
-    sort -u -b -k 3g,3 -k 8n,8 > ${PIPELINE_STREAM}/evt-previous-${HALFPIPE_RUNSTART}.tmp
-
-time grep -h ^EVT *-${HALFPIPE_RUNSTART}-*.idx | \
-    sort -u -b -k 3g,3 -k 8n,8 > ${PIPELINE_STREAM}/evt-current-${HALFPIPE_RUNSTART}.tmp
-
-time sort -u -b -k 3g,3 -k 8n,8 ${PIPELINE_STREAM}/evt-*-${HALFPIPE_RUNSTART}.tmp > ${PIPELINE_STREAM}/evt-${HALFPIPE_RUNSTART}.idx
-rm -vf ${PIPELINE_STREAM}/evt-*-${HALFPIPE_RUNSTART}.tmp
-
-# run the merging application for each acquisition
+# merge the datagram and event indices for this rst, including everything
+# previously decoded, and run the merging application for each acquisition.
+# The previously-merged indices are already sorted, so MergeDatagrams.py merges
+# them as streams, together with the sorted records of this downlink's
+# per-chunk indices, and writes dgm-<rst>.idx and evt-<rst>.idx as it goes.
 echo "merging indices"
 time python $taskBase/scripts/MergeDatagrams.py \
     -d ${PIPELINE_STREAM}/dgm-${HALFPIPE_RUNSTART}.idx \
     -e ${PIPELINE_STREAM}/evt-${HALFPIPE_RUNSTART}.idx \
+    --dgmsrc "${HALFPIPE_OUTPUTBASE}/*/${PIPELINE_STREAM}/dgm-${HALFPIPE_RUNSTART}.idx" \
+    --dgmchunks "*-${HALFPIPE_RUNSTART}-*.idx" \
+    --evtsrc "${HALFPIPE_OUTPUTBASE}/*/${PIPELINE_STREAM}/evt-${HALFPIPE_RUNSTART}.idx" \
+    --evtchunks "*-${HALFPIPE_RUNSTART}-*.idx" \
     -o ${PIPELINE_STREAM} \
     -l ${HALFPIPE_DOWNLINKID} \
     -b ${HALFPIPE_OUTPUTBASE} --merge || exit 1
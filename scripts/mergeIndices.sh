@@ -75,7 +75,8 @@ ls $MOOT_ARCHIVE
 #ldd ${taskBase}/scripts/AcqSummary.py
 
 time python ${taskBase}/scripts/AcqSummary.py -p glastops -d $HALFPIPE_DOWNLINKID -k $l0key \
-    -i $HALFPIPE_OUTPUTBASE/$HALFPIPE_DOWNLINKID --load --retire --evttimes -f $HALFPIPE_OUTPUTBASE/force --moot || exit 1
+    -i $HALFPIPE_OUTPUTBASE/$HALFPIPE_DOWNLINKID --load --retire --evttimes -f $HALFPIPE_OUTPUTBASE/force --moot \
+    --schemacache $HALFPIPE_OUTPUTBASE/schema-cache.pkl || exit 1
 
 echo "AcqSummary passed"
 
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""Check IndexMerge.merge() against sort -u on index files like mergeEvt.sh's."""
+
+## @namespace test_IndexMerge
+#  @brief Merge a sorted, previously-merged index file with a per-chunk index
+#  file whose apid 956 and 957 records are interleaved, and compare the
+#  result with a first-wins sort -u of the same records.
+#
+#  Run as "python test_IndexMerge.py" from the scripts directory (or with it
+#  on PYTHONPATH); needs grep(1) and sort(1), as mergeEvt.sh does.
+
+import os, random, shutil, sys, tempfile, unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+import IndexMerge
+
+def dgm( seq, apid ):
+    return 'DGM: 300000000 2009-01-01T00:00:00.000000 77 %d %d 0 0 mode oa or ca cr plat orig crate ' \
+           '2009-01-01T00:00:00.000000 %d 2009-01-01T00:00:00.000000 %d 10 0 0\n' % ( apid, seq, seq, seq + 9 )
+
+def evt( seq, apid, tag = 0 ):
+    return 'EVT: 300000000 %d 0 0 0 0 %d %d 0 oa ca 0 %d 300000000-%d-%d.evt\n' % \
+           ( seq, apid, seq // 10, seq * 100, apid, tag )
+
+class IndexMergeTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp( prefix='test_IndexMerge.' )
+        rng = random.Random( 956 )
+        # previous merged index: sorted, overlapping the new chunks
+        self.previous = os.path.join( self.tmpdir, 'dgm-previous.idx' )
+        ofd = open( self.previous, 'w' )
+        ofd.writelines( [ dgm( seq, apid ) for apid in ( 956, 957 ) for seq in xrange( 0, 60 ) ] )
+        ofd.writelines( [ evt( seq, apid ) for seq in xrange( 0, 600 ) for apid in ( 956, 957 ) ] )
+        ofd.close()
+        # chunk indices: the two apids' records interleaved, each apid in
+        # order, and the second chunk overlapping the first
+        self.chunks = []
+        for chunk, seqs in ( ( 1, xrange( 40, 120 ) ), ( 2, xrange( 100, 160 ) ) ):
+            lines = []
+            for apid in ( 956, 957 ):
+                lines.append( [ ( dgm( seq, apid ), evt( seq, apid, chunk ) ) for seq in seqs ] )
+            name = os.path.join( self.tmpdir, '00000001-11e1a300-0000-%05d.idx' % chunk )
+            ofd = open( name, 'w' )
+            while lines[0] or lines[1]:
+                src = lines[ rng.randrange( 2 ) ] or lines[0] or lines[1]
+                ofd.writelines( src.pop( 0 ) )
+            ofd.close()
+            self.chunks.append( name )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir, ignore_errors=True )
+
+    def expected( self, prefix ):
+        # first-wins sort -u over the files in order of precedence
+        keyfunc = IndexMerge.RECORD_KEYS[ prefix ]
+        records = {}
+        for idxfile in [ self.previous ] + self.chunks:
+            for line in open( idxfile ):
+                if line.startswith( prefix ):
+                    records.setdefault( keyfunc( line.split() ), line )
+        return [ records[ key ] for key in sorted( records ) ]
+
+    def testMerge( self ):
+        for prefix in ( 'DGM', 'EVT' ):
+            merged = list( IndexMerge.merge( [ self.previous ], prefix, self.chunks ) )
+            self.assertEqual( merged, self.expected( prefix ) )
+
+    def testUnsortedInput( self ):
+        # a chunk passed as a sorted input is caught, not mis-merged
+        self.assertRaises( IndexMerge.IndexNotSorted, list,
+                           IndexMerge.merge( [ self.previous, self.chunks[0] ], 'DGM' ) )
+
+if __name__ == '__main__':
+    unittest.main()